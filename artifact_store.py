@@ -0,0 +1,360 @@
+#! /usr/bin/env python3
+'''
+Content-addressed cache of intermediate products, shared by parameter sweeps.
+
+merge_dir is named after reg_smoothness and sn_per_region, so every new S/N
+or smoothing value used to rerun the merge, the flux scaling and the crop,
+although only contour binning onward depends on them.  With
+
+    "artifact_store": true            ({parent_directory}/artifact_store)
+    "artifact_store": "/some/path"
+
+in config.json (or {"path": ..., "max_gb": 200} to bound its size), those
+stages first ask the store for their products.  The key of a product set is
+a sha256 over the stage, its tool parameters and the content hashes of its
+input files, so it does not depend on the directory the inputs live in.
+On a hit the products are hardlinked into place (copied if the store is on
+another file system); on a miss the stage runs and its products are saved.
+Products are copied into the store, where they are made read-only; on
+restore, products under LINK_MIN_BYTES (region files, which are checked
+and edited by hand) are copied too, so an in-place edit of a working file
+never changes what the store restores.
+A sweep over ten S/N values then merges, scales and crops once and runs ten
+contour binnings.  step3 stores fluximage and mkpsfmap products the same
+way, keyed on the evt2, aspect, bad-pixel and mask files, the band, binsize
+and CALDB version, so regenerating the deflare script after a GTI or region
+change reuses them.  The CALDB version is read when the script runs
+(--caldb), in the CIAO environment the tools use; while it is unknown the
+products are neither restored nor saved.
+
+With max_gb set, every save evicts the least recently used product sets
+(by the last restore or save of their key) until the store fits again.
+
+Layout of the store:
+
+    objects/ab/abcdef...     product files, by content hash (deduplicated)
+    keys/<key>.json          stage, parameters and {file name: object hash}
+    hash_index.json          content hashes of input files by path, size and mtime
+
+Generated scripts wrap a stage as
+
+    if python3 artifact_store.py restore ...; then echo restored; else
+        <stage commands>
+        python3 artifact_store.py save ...
+    fi
+
+(cache_begin/cache_end); Python stages use ArtifactStore directly.
+
+Usage:
+    python3 artifact_store.py restore --root R --stage S [--input F ...] [--param K=V ...] [--caldb] --output F ...
+    python3 artifact_store.py save    --root R --stage S [--input F ...] [--param K=V ...] [--caldb] --output F ...
+    python3 artifact_store.py key     --root R --stage S [--input F ...] [--param K=V ...] [--caldb]
+    python3 artifact_store.py evict   --root R --max-gb N
+'''
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+
+VERSION = 1
+HASH_CHUNK = 1 << 20
+# smaller products are restored as copies instead of hardlinks to the (read-only) objects
+LINK_MIN_BYTES = 1 << 20
+
+
+def store_root(config):
+    """Root of the store configured in config.json, or None when the store is off."""
+    setting = config.get('artifact_store')
+    if not setting:
+        return None
+    if isinstance(setting, dict):
+        setting = setting.get('path', True)
+    if isinstance(setting, str):
+        root = setting
+    else:
+        root = os.path.join(config['info_dict']['parent_directory'], 'artifact_store')
+    from helpers import abs_path
+    return abs_path(root)
+
+
+def store_limit(config):
+    """Size limit of the store in GB (config "artifact_store": {"max_gb": N}), or None."""
+    setting = config.get('artifact_store')
+    if isinstance(setting, dict) and setting.get('max_gb'):
+        return float(setting['max_gb'])
+    return None
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _place(source, target, link):
+    """Hardlink source to target when link is set and possible, else copy it (a new, writable file)."""
+    if link:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+
+
+def _write_json(path, data):
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+class ArtifactStore:
+    """Products of pipeline stages, stored once by content and keyed by their inputs and parameters."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.objects = os.path.join(self.root, 'objects')
+        self.keys = os.path.join(self.root, 'keys')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.keys, exist_ok=True)
+        self.index_path = os.path.join(self.root, 'hash_index.json')
+        self._index = None
+
+    # -- content hashes of inputs, cached by (size, mtime) -------------------------------------------
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path, 'r') as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        # merge with what other processes added meanwhile; a lost entry only costs a rehash
+        current = {}
+        try:
+            with open(self.index_path, 'r') as f:
+                current = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+        current.update(self._index)
+        _write_json(self.index_path, current)
+
+    def content_hash(self, path, digest=None):
+        """sha256 of a file, from the index when its size and mtime are unchanged (digest: known hash)."""
+        index = self._load_index()
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = index.get(path)
+        if digest is None and entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = digest or _file_hash(path)
+        index[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    # -- keys ------------------------------------------------------------------------------------------
+
+    def key(self, stage, inputs, params):
+        """Key of a stage run: stage, parameters and the content of every input, in order."""
+        self._load_index()
+        hashes = [self.content_hash(path) for path in inputs]
+        self._save_index()
+        document = json.dumps({'version': VERSION, 'stage': stage, 'params': params, 'inputs': hashes},
+                              sort_keys=True)
+        return hashlib.sha256(document.encode()).hexdigest()
+
+    def _manifest_path(self, key):
+        return os.path.join(self.keys, f'{key}.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    # -- products --------------------------------------------------------------------------------------
+
+    def restore(self, key, outputs):
+        """Link (or copy) the products of key to outputs (paths, matched by file name). False on a miss."""
+        manifest_path = self._manifest_path(key)
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return False
+        files = manifest['files']
+        if any(os.path.basename(path) not in files for path in outputs):
+            return False
+        for path in outputs:
+            digest = files[os.path.basename(path)]
+            source = self._object_path(digest)
+            if not os.path.exists(source):
+                return False
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp = f'{path}.restore{os.getpid()}'
+            _place(source, tmp, os.path.getsize(source) >= LINK_MIN_BYTES)
+            os.replace(tmp, path)
+            # the restored file is the object: remember its hash so it is not read again as an input
+            self.content_hash(path, digest)
+        self._save_index()
+        os.utime(manifest_path)         # last use, for eviction
+        return True
+
+    def save(self, key, stage, outputs, params=None):
+        """Store the products (files at outputs) under key."""
+        files = {}
+        for path in outputs:
+            digest = _file_hash(path)
+            target = self._object_path(digest)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp = f'{target}.tmp{os.getpid()}'
+                # a copy, so that only the store's file becomes read-only, never the working product
+                shutil.copyfile(path, tmp)
+                os.chmod(tmp, 0o444)
+                os.replace(tmp, target)
+            files[os.path.basename(path)] = digest
+            self.content_hash(path, digest)
+        self._save_index()
+        _write_json(self._manifest_path(key), {'stage': stage, 'params': params or {}, 'files': files,
+                                               'created': time.time()})
+
+    def evict(self, max_bytes):
+        """
+        Drop the least recently used keys until the objects they reference fit in max_bytes,
+        then the objects no key references. Returns (keys removed, bytes freed).
+        """
+        manifests = []
+        for name in os.listdir(self.keys):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.keys, name)
+            try:
+                with open(path, 'r') as f:
+                    files = json.load(f)['files']
+                manifests.append((os.stat(path).st_mtime, path, set(files.values())))
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+        manifests.sort(reverse=True)
+
+        sizes = {}
+        for digest in set().union(*(m[2] for m in manifests)):
+            try:
+                sizes[digest] = os.stat(self._object_path(digest)).st_size
+            except FileNotFoundError:
+                sizes[digest] = 0
+        kept, used, removed = set(), 0, 0
+        for _, path, digests in manifests:
+            extra = sum(sizes[d] for d in digests - kept)
+            if used + extra <= max_bytes:
+                kept |= digests
+                used += extra
+            else:
+                os.remove(path)
+                removed += 1
+
+        freed = 0
+        for prefix in os.listdir(self.objects):
+            directory = os.path.join(self.objects, prefix)
+            for digest in os.listdir(directory):
+                if digest not in kept and '.tmp' not in digest:
+                    path = os.path.join(directory, digest)
+                    freed += os.stat(path).st_size
+                    os.remove(path)
+        return removed, freed
+
+
+def _cli_args(root, stage, inputs, params, caldb=False):
+    args = ['--root', root, '--stage', stage] + (['--caldb'] if caldb else [])
+    for path in inputs:
+        args += ['--input', path]
+    for name, value in params.items():
+        args += ['--param', f'{name}={value}']
+    return ' '.join(shlex.quote(a) for a in args)
+
+
+def cache_begin(config, stage, inputs, params, outputs, caldb=False):
+    """
+    Shell lines that restore a stage's outputs from the store, or open the branch that runs it
+    (close it with cache_end).  Empty when the store is off.  With caldb the key includes the
+    CALDB version of the environment the script runs in.
+    """
+    root = store_root(config)
+    if root is None:
+        return ''
+    me = os.path.abspath(__file__)
+    outs = ' '.join(f'--output {shlex.quote(path)}' for path in outputs)
+    return (f'if python3 {me} restore {_cli_args(root, stage, inputs, params, caldb)} {outs}; then\n'
+            f'echo "{stage}: restored from the artifact store"\n'
+            f'else\n'
+            # a rerun must not write through hardlinks into the store
+            f'rm -f {" ".join(shlex.quote(path) for path in outputs)}\n')
+
+
+def cache_end(config, stage, inputs, params, outputs, caldb=False):
+    """Shell lines that save a stage's outputs (evicting down to the size limit) and close the cache_begin branch."""
+    root = store_root(config)
+    if root is None:
+        return ''
+    me = os.path.abspath(__file__)
+    outs = ' '.join(f'--output {shlex.quote(path)}' for path in outputs)
+    limit = store_limit(config)
+    evict = f' --max-gb {limit:g}' if limit else ''
+    return f'python3 {me} save {_cli_args(root, stage, inputs, params, caldb)} {outs}{evict}\nfi\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed store of pipeline products.')
+    parser.add_argument('command', choices=['restore', 'save', 'key', 'evict'])
+    parser.add_argument('--root', required=True, help='store directory')
+    parser.add_argument('--stage', default=None)
+    parser.add_argument('--input', action='append', default=[], help='input file (order matters)')
+    parser.add_argument('--param', action='append', default=[], help='tool parameter NAME=VALUE')
+    parser.add_argument('--output', action='append', default=[], help='product file')
+    parser.add_argument('--caldb', action='store_true',
+                        help='add the CALDB version of this environment to the key (no caching while unknown)')
+    parser.add_argument('--max-gb', type=float, default=None,
+                        help='size limit: after a save (or with evict) drop the least recently used products')
+    args = parser.parse_args()
+
+    params = dict(p.split('=', 1) for p in args.param)
+    store = ArtifactStore(args.root)
+    if args.command == 'evict':
+        if args.max_gb is None:
+            parser.error('evict needs --max-gb')
+        removed, freed = store.evict(args.max_gb * 2**30)
+        print(f'{removed} product sets evicted, {freed / 2**20:.1f} MB freed')
+        return
+    if args.stage is None:
+        parser.error(f'{args.command} needs --stage')
+    missing = [path for path in args.input if not os.path.exists(path)]
+    if missing:
+        # nothing to key on: a restore misses and the stage runs; its products are not saved
+        print(f'artifact store: missing input {missing[0]}', file=sys.stderr)
+        sys.exit(1 if args.command == 'restore' else 0)
+    if args.caldb:
+        from response_cache import caldb_version
+        params['caldb'] = caldb_version()
+        if params['caldb'] == 'unknown':
+            # $CALDB is not set here: a stale calibration must not be restored, nor saved under a vague key
+            print('artifact store: CALDB version unknown, not cached', file=sys.stderr)
+            sys.exit(1 if args.command == 'restore' else 0)
+    key = store.key(args.stage, args.input, params)
+    if args.command == 'key':
+        print(key)
+    elif args.command == 'restore':
+        sys.exit(0 if store.restore(key, args.output) else 1)
+    else:
+        store.save(key, args.stage, args.output, params)
+        if args.max_gb is not None:
+            store.evict(args.max_gb * 2**30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#! /usr/bin/env python3
+'''
+Reduce many clusters at once under one scheduler.
+
+A manifest lists the clusters.  `init` creates every cluster's configuration
+without prompts (step1_config.build_config) in its own state directory,
+{state_root}/{name}/, which holds its config.json and state store.  Every
+pipeline process of a cluster is started with PIPELINE_CONFIG pointing at
+that config.json, so the clusters share nothing but the machine.
+
+`run` asks pipeline_dag.py which nodes of each cluster are stale and runs
+them, one `pipeline_dag.py run --only NODE` per task.  All clusters share one
+budget of worker slots (--workers) and memory (--memory-gb):
+
+  * per-observation nodes (reprocess, deflare, spectra, fit) get up to one
+    slot per observation and are passed --workers accordingly; the other
+    nodes take one slot;
+  * each node has a memory estimate per slot, and a task waits while it
+    does not fit (unless nothing else is running);
+  * free slots go first to the cluster with the most estimated work left, so
+    long clusters start early and the short ones fill the gaps at the end.
+    The estimates start from NODE_COSTS and are replaced by the measured
+    time per observation once a node has finished for some cluster.
+
+A failed node stops its cluster only.  Logs are in {state_root}/{name}/logs/.
+
+Manifest (JSON):
+    {
+        "parent_directory": "/work/clusters",
+        "state_root": "/work/clusters/batch_state",
+        "defaults": {"native": {"deflare": true, "merge": true}},
+        "clusters": [
+            {"name": "perseus", "data": "/data/perseus", "sn_per_region": 70, "reg_smoothness": 100.0},
+            {"name": "a2029", "data": "/data/a2029", "sn_per_region": 50, "reg_smoothness": 30.0,
+             "config": {"trace": true}}
+        ]
+    }
+
+"defaults" and a cluster's "config" are top-level config.json sections
+(native, trace, fit settings in info_dict, ...) merged into its config.
+
+Usage:
+    python3 batch.py init MANIFEST [--reset]
+    python3 batch.py status MANIFEST
+    python3 batch.py run MANIFEST [--workers N] [--memory-gb M] [--until NODE] [--dry-run]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from helpers import REPO_DIR
+from pipeline_dag import ORDER
+
+# node: (minutes per observation, fixed minutes, memory GB per slot, one slot per observation)
+NODE_COSTS = {
+    'reprocess': (20.0, 0.0, 2.0, True),
+    'deflare': (15.0, 0.0, 2.0, True),
+    'merge': (3.0, 2.0, 4.0, False),
+    'flux': (0.0, 1.0, 2.0, False),
+    'crop': (0.0, 2.0, 2.0, False),
+    'contbin': (0.0, 20.0, 4.0, False),
+    'regions': (0.0, 2.0, 1.0, False),
+    'spectra': (10.0, 0.0, 2.0, True),
+    'fit': (5.0, 0.0, 1.0, True),
+    'maps': (0.0, 1.0, 2.0, False),
+}
+POLL = 1.0
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    for key in ('parent_directory', 'clusters'):
+        if key not in manifest:
+            raise ValueError(f'{path}: "{key}" missing from the manifest')
+    names = set()
+    for cluster in manifest['clusters']:
+        missing = [key for key in ('name', 'data', 'sn_per_region', 'reg_smoothness') if key not in cluster]
+        if missing:
+            raise ValueError(f'{path}: cluster {cluster.get("name", "?")} has no {", ".join(missing)}')
+        if cluster['name'] in names:
+            raise ValueError(f'{path}: cluster {cluster["name"]} listed twice')
+        names.add(cluster['name'])
+    manifest.setdefault('state_root', os.path.join(manifest['parent_directory'], 'batch_state'))
+    return manifest
+
+
+def config_path(manifest, cluster):
+    return os.path.join(os.path.abspath(manifest['state_root']), cluster['name'], 'config.json')
+
+
+def _merge_sections(config, sections):
+    for name, value in (sections or {}).items():
+        if isinstance(value, dict) and isinstance(config.get(name), dict):
+            config[name].update(value)
+        else:
+            config[name] = value
+
+
+def init_cluster(manifest, cluster, reset=False):
+    """Create the cluster's state directory and config (kept if it exists, unless reset). Returns its path."""
+    import state_store
+    from step1_config import build_config
+
+    path = config_path(manifest, cluster)
+    if os.path.exists(path) and not reset:
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    config = build_config(cluster['name'], int(cluster['sn_per_region']), float(cluster['reg_smoothness']),
+                          os.path.abspath(cluster['data']), os.path.abspath(manifest['parent_directory']))
+    _merge_sections(config, manifest.get('defaults'))
+    _merge_sections(config, cluster.get('config'))
+    state_store.save_config(config, None, config_path=path)
+    return path
+
+
+def cluster_env(path):
+    return dict(os.environ, PIPELINE_CONFIG=path)
+
+
+def stale_nodes(path, until=None):
+    """Nodes pipeline_dag.py would run for the cluster whose config is path, in order."""
+    out = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'pipeline_dag.py'), 'status', '--json'],
+                         env=cluster_env(path), cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    nodes = [step['node'] for step in json.loads(out.stdout)]
+    if until:
+        nodes = [node for node in nodes if ORDER.index(node) <= ORDER.index(until)]
+    return nodes
+
+
+class Cluster:
+    """One cluster's remaining nodes and its running task."""
+
+    def __init__(self, name, path, n_obs, nodes):
+        self.name = name
+        self.path = path
+        self.n_obs = max(n_obs, 1)
+        self.nodes = list(nodes)
+        self.task = None
+        self.failed = None
+        self.log_dir = os.path.join(os.path.dirname(path), 'logs')
+
+    def estimate(self, node, rates):
+        """Estimated CPU-minutes of node for this cluster."""
+        per_obs, fixed, _, _ = NODE_COSTS[node]
+        if node in rates:
+            return rates[node] * self.n_obs
+        return per_obs * self.n_obs + fixed
+
+    def remaining(self, rates):
+        return sum(self.estimate(node, rates) for node in self.nodes)
+
+
+def task_size(cluster, node, free_slots):
+    """(slots, memory GB) the next task would take."""
+    _, _, memory, per_obs = NODE_COSTS[node]
+    slots = max(min(cluster.n_obs, free_slots), 1) if per_obs else 1
+    return slots, memory * slots
+
+
+def start(cluster, node, slots):
+    os.makedirs(cluster.log_dir, exist_ok=True)
+    log = open(os.path.join(cluster.log_dir, f'batch_{node}.log'), 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'pipeline_dag.py'), 'run', '--only', node,
+                             '--workers', str(slots)],
+                            env=cluster_env(cluster.path), cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+    return {'node': node, 'proc': proc, 'log': log, 'slots': slots, 'started': time.monotonic()}
+
+
+def schedule(clusters, workers, memory_gb):
+    """Run every cluster's nodes within the shared budget. Returns {node: measured minutes per observation}."""
+    free_slots, free_memory = workers, memory_gb
+    rates, measured = {}, {}
+    running = []
+    while running or any(c.nodes and not c.failed for c in clusters):
+        ready = [c for c in clusters if c.nodes and c.task is None and not c.failed]
+        ready.sort(key=lambda c: -c.remaining(rates))
+        for cluster in ready:
+            if free_slots < 1:
+                break
+            node = cluster.nodes[0]
+            slots, memory = task_size(cluster, node, free_slots)
+            if memory > free_memory and running:
+                continue            # a smaller task of another cluster may still fit
+            cluster.task = start(cluster, node, slots)
+            cluster.task['memory'] = memory
+            free_slots -= slots
+            free_memory -= memory
+            running.append(cluster)
+            print(f'{cluster.name}: {node} started ({slots} slot{"s" if slots > 1 else ""}, '
+                  f'{cluster.remaining(rates):.0f} min of work left)')
+
+        time.sleep(POLL)
+        for cluster in list(running):
+            task = cluster.task
+            code = task['proc'].poll()
+            if code is None:
+                continue
+            task['log'].close()
+            wall = (time.monotonic() - task['started']) / 60.0
+            running.remove(cluster)
+            free_slots += task['slots']
+            free_memory += task['memory']
+            cluster.task = None
+            if code != 0:
+                cluster.failed = task['node']
+                print(f'{cluster.name}: {task["node"]} FAILED (exit {code}), see {task["log"].name}')
+                continue
+            cluster.nodes.pop(0)
+            # CPU-minutes per observation, averaged over the clusters that ran the node
+            cpu = wall * task['slots'] / cluster.n_obs
+            measured.setdefault(task['node'], []).append(cpu)
+            rates[task['node']] = sum(measured[task['node']]) / len(measured[task['node']])
+            print(f'{cluster.name}: {task["node"]} done in {wall:.1f} min')
+    return rates
+
+
+def load_clusters(manifest, until=None):
+    clusters = []
+    for entry in manifest['clusters']:
+        path = config_path(manifest, entry)
+        if not os.path.exists(path):
+            raise SystemExit(f'{entry["name"]} has no configuration yet: run `batch.py init` first')
+        with open(path, 'r') as f:
+            n_obs = len(json.load(f)['info_dict'].get('obs_ids', []))
+        clusters.append(Cluster(entry['name'], path, n_obs, stale_nodes(path, until)))
+    return clusters
+
+
+def _memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30 * 0.8
+    except (ValueError, OSError):
+        return 16.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline for many clusters under one scheduler.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_init = sub.add_parser('init', help='create each cluster configuration (no prompts)')
+    p_init.add_argument('manifest')
+    p_init.add_argument('--reset', action='store_true', help='recreate existing configurations (resets flags)')
+    p_status = sub.add_parser('status', help='stale nodes and estimated work per cluster')
+    p_status.add_argument('manifest')
+    p_run = sub.add_parser('run', help='run the stale nodes of every cluster')
+    p_run.add_argument('manifest')
+    p_run.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker slots shared by all clusters')
+    p_run.add_argument('--memory-gb', type=float, default=None,
+                       help='memory budget shared by all clusters (default: 80%% of RAM)')
+    p_run.add_argument('--until', choices=ORDER, help='stop every cluster after this node')
+    p_run.add_argument('--dry-run', action='store_true', help='print the plan and priorities only')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    if args.command == 'init':
+        for entry in manifest['clusters']:
+            print(f'{entry["name"]}: {init_cluster(manifest, entry, args.reset)}')
+        return
+
+    clusters = load_clusters(manifest, getattr(args, 'until', None))
+    if args.command == 'status' or args.dry_run:
+        for c in sorted(clusters, key=lambda c: -c.remaining({})):
+            print(f'{c.name:<16} {c.n_obs:>3} obs  ~{c.remaining({}):>6.0f} min  '
+                  f'{" ".join(c.nodes) if c.nodes else "up to date"}')
+        return
+
+    t0 = time.monotonic()
+    schedule(clusters, max(args.workers, 1), args.memory_gb or _memory_gb())
+    failed = [f'{c.name} ({c.failed})' for c in clusters if c.failed]
+    print(f'{len(clusters)} clusters in {(time.monotonic() - t0) / 60:.1f} min')
+    if failed:
+        print(f'Failed: {", ".join(failed)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
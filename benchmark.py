@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+'''
+Time the Python-side stages on synthetic datasets of several sizes.
+
+For each size a dataset is generated with synth_data.py (reused when it
+already exists with the same parameters), then the stages run in order, each
+in its own process so its peak RSS (VmHWM, not the inherited ru_maxrss) is
+its own:
+
+    deflare   deflare_engine.deflare on the event list, sources excluded
+    flux      step5 scale_flux on broad_flux.img / broad_thresh.img
+    masking   regions.crop_and_exclude: field box, point sources removed
+    contbin   contbin.run on the counts image broad_thresh.img
+    regions   reg_convert.convert_files on one polygon region per bin
+    maps      make_maps.write_maps from a fake fit-results table
+
+The report (JSON) records, per size and stage, the wall time of the stage
+call, the process peak RSS and the stage's own numbers (bins, factor...),
+plus the host and library versions.  --compare prints the ratios against a
+previous report and exits non-zero when a stage got slower than --threshold.
+
+Usage:
+    python3 benchmark.py run [--sizes 1e5,1e6] [--stages ...] [--work DIR] [--out report.json]
+                             [--compare old.json] [--threshold 1.2]
+    python3 benchmark.py compare old.json new.json [--threshold 1.2]
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from helpers import REPO_DIR, peak_rss_mb
+
+STAGES = ('deflare', 'flux', 'masking', 'contbin', 'regions', 'maps')
+CONTBIN_SN = 30
+CONTBIN_SMOOTH = 15.0
+
+
+def _stage_deflare(d):
+    import deflare_engine
+    return deflare_engine.deflare(os.path.join(d, 'acisf99999_repro_evt2.fits'), os.path.join(d, 'bench.gti'),
+                                  exclude=os.path.join(d, 'sources.reg'))
+
+
+def _stage_flux(d):
+    from step5_merge_data_flux import scale_flux
+    return {'factor': scale_flux(d)}
+
+
+def _stage_masking(d):
+    import regions
+    regions.crop_and_exclude(os.path.join(d, 'scaled_broad_flux.fits'), os.path.join(d, 'scaled_broad_flux_final.fits'),
+                             exclude=os.path.join(d, 'sources.reg'), include=os.path.join(d, 'field.reg'))
+    return {}
+
+
+def _stage_contbin(d):
+    import contbin
+    # counts, not the scaled flux: the synthetic flux map totals ~1e-6 and would never reach the S/N target
+    nbins = contbin.run(os.path.join(d, 'broad_thresh.img'), [CONTBIN_SN], CONTBIN_SMOOTH,
+                        constrainval=3.0, outdir=os.path.join(d, 'contbin'))
+    return {'bins': nbins[CONTBIN_SN]}
+
+
+def _stage_regions(d):
+    """One bounding-box polygon per bin stands in for the contbin make_region_files output."""
+    import numpy as np
+    from astropy.io import fits
+    import regions
+    import reg_convert
+
+    with fits.open(os.path.join(d, 'contbin', 'contbin_binmap.fits')) as hdul:
+        header, binmap = hdul[0].header, hdul[0].data
+    outreg = os.path.join(d, 'contbin', 'outreg')
+    os.makedirs(outreg, exist_ok=True)
+    jj, ii = np.nonzero(binmap >= 0)
+    bins = binmap[jj, ii]
+    files = []
+    for b in np.unique(bins):
+        sel = bins == b
+        x0, y0 = regions.image_to_physical(header, ii[sel].min() + 0.5, jj[sel].min() + 0.5)
+        x1, y1 = regions.image_to_physical(header, ii[sel].max() + 1.5, jj[sel].max() + 1.5)
+        path = os.path.join(outreg, f'xaf_{b}.reg')
+        with open(path, 'w') as f:
+            f.write(f'polygon({x0},{y0},{x1},{y0},{x1},{y1},{x0},{y1})\n')
+        files.append(path)
+    t0 = time.monotonic()
+    reg_convert.convert_files(os.path.join(d, 'scaled_broad_flux_final.fits'), files, os.path.join(outreg, 'sex'))
+    return {'files': len(files), 'convert_seconds': round(time.monotonic() - t0, 4)}
+
+
+def _stage_maps(d):
+    import xspec_fit
+    import make_maps
+    from astropy.io import fits
+
+    binmap = os.path.join(d, 'contbin', 'contbin_binmap.fits')
+    nbins = int(fits.getdata(binmap).max()) + 1
+    fake = xspec_fit.FakeBackend()
+    fake.setup({'band': (0.5, 7.0)})
+    results = {b: dict(fake.fit({'bin': b, 'spectra': [], 'attempt': 1}), attempts=1) for b in range(nbins)}
+    table = os.path.join(d, 'contbin', 'fit_results.fits')
+    xspec_fit.write_results(table, {b: [] for b in results}, results)
+    t0 = time.monotonic()
+    make_maps.write_maps(binmap, table, os.path.join(d, 'parameter_maps.fits'))
+    return {'bins': nbins, 'paint_seconds': round(time.monotonic() - t0, 4)}
+
+
+def run_stage(name, dataset):
+    """Run one stage in this process; returns its record."""
+    t0 = time.monotonic()
+    extra = globals()[f'_stage_{name}'](dataset)
+    record = {'seconds': round(time.monotonic() - t0, 4), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+    record.update({k: v for k, v in (extra or {}).items() if isinstance(v, (int, float, str))})
+    return record
+
+
+def ensure_dataset(work, n_events, seed):
+    import synth_data
+
+    d = os.path.join(work, f'events_{n_events:.0e}'.replace('+', ''))
+    manifest = os.path.join(d, 'manifest.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            m = json.load(f)
+        if m['events_requested'] == n_events and m['seed'] == seed:
+            return d, m
+    return d, synth_data.generate(d, n_events, seed=seed)
+
+
+def environment():
+    import numpy
+    import astropy
+    return {'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'cpus': os.cpu_count(), 'numpy': numpy.__version__, 'astropy': astropy.__version__}
+
+
+def run(sizes, stages, work, seed=1):
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'results': {}}
+    for n_events in sizes:
+        d, manifest = ensure_dataset(work, n_events, seed)
+        key = f'{n_events:.0e}'.replace('+', '')
+        report['results'][key] = {'dataset': manifest, 'stages': {}}
+        print(f"{key}: {manifest['events_written']} events, {manifest['image_size']}^2 pixels")
+        for name in STAGES:
+            if name not in stages:
+                continue
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'stage', name, d],
+                                  capture_output=True, text=True, cwd=REPO_DIR)
+            if proc.returncode != 0:
+                record = {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'failed'}
+            else:
+                record = json.loads(proc.stdout.strip().splitlines()[-1])
+            report['results'][key]['stages'][name] = record
+            print(f"  {name:8} " + (f"{record['seconds']:9.3f}s {record['peak_rss_mb']:9.1f} MB"
+                                     if 'error' not in record else f"failed: {record['error']}"))
+    return report
+
+
+def compare(old, new, threshold=1.2):
+    """Print new/old ratios; returns the (size, stage) pairs slower than threshold."""
+    slower = []
+    print(f"{'size':>6} {'stage':8} {'old s':>9} {'new s':>9} {'ratio':>6} {'old MB':>8} {'new MB':>8}")
+    for size, entry in new['results'].items():
+        before = old['results'].get(size, {}).get('stages', {})
+        for stage, record in entry['stages'].items():
+            prev = before.get(stage)
+            if not prev or 'error' in prev or 'error' in record:
+                continue
+            ratio = record['seconds'] / prev['seconds'] if prev['seconds'] else float('inf')
+            mark = ' slower' if ratio > threshold else ''
+            print(f"{size:>6} {stage:8} {prev['seconds']:9.3f} {record['seconds']:9.3f} {ratio:6.2f} "
+                  f"{prev['peak_rss_mb']:8.1f} {record['peak_rss_mb']:8.1f}{mark}")
+            if ratio > threshold:
+                slower.append((size, stage))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Python-side stages on synthetic data.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='generate datasets and time the stages')
+    p_run.add_argument('--sizes', default='1e5,1e6', help='comma-separated event counts (default 1e5,1e6)')
+    p_run.add_argument('--stages', default=','.join(STAGES), help='comma-separated stages to run')
+    p_run.add_argument('--work', default=os.path.join(REPO_DIR, 'bench_data'), help='dataset directory')
+    p_run.add_argument('--seed', type=int, default=1)
+    p_run.add_argument('--out', default='benchmark_report.json', help='report file')
+    p_run.add_argument('--compare', help='previous report to compare with')
+    p_run.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+
+    p_cmp = sub.add_parser('compare', help='compare two reports')
+    p_cmp.add_argument('old')
+    p_cmp.add_argument('new')
+    p_cmp.add_argument('--threshold', type=float, default=1.2)
+
+    p_stage = sub.add_parser('stage', help=argparse.SUPPRESS)
+    p_stage.add_argument('name', choices=STAGES)
+    p_stage.add_argument('dataset')
+    args = parser.parse_args()
+
+    if args.command == 'stage':
+        print(json.dumps(run_stage(args.name, args.dataset)))
+        return
+
+    if args.command == 'run':
+        sizes = [int(float(s)) for s in args.sizes.split(',')]
+        report = run(sizes, args.stages.split(','), args.work, args.seed)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Report written to {args.out}')
+        if not args.compare:
+            return
+        old_path, new = args.compare, report
+    else:
+        old_path = args.old
+        with open(args.new) as f:
+            new = json.load(f)
+    with open(old_path) as f:
+        old = json.load(f)
+    if compare(old, new, args.threshold):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
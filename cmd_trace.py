@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+'''
+Trace the CIAO tool calls of the generated shell scripts.
+
+With "trace": true in config.json the script generators (steps 2-8 and the
+job_runner jobs) wrap every tool call in
+
+    python3 cmd_trace.py run --trace FILE --step STEP [--obs OBS_ID] -c 'original command'
+
+which runs the command through bash unchanged, exits with its exit code, and
+appends one JSON line to the trace: start/end time, wall and CPU time, peak
+RSS, bytes read/written (the difference of /proc/self/io, which includes the
+reaped child), exit code, tool, step and obs_id.  Shell bookkeeping
+(cd, echo, pwd, ls, punlearn, export, ...) and the update_flag.py calls are
+left as they are.
+
+`report` aggregates a trace into per-step and per-tool totals, the slowest
+calls, and a critical path: steps run one after another, observations within
+a step may run in parallel, so the path is the slowest observation of each
+step.
+
+The trace is {script_dir}/logs/trace.jsonl unless --trace is given.
+
+Usage:
+    python3 cmd_trace.py run --step STEP [--obs OBS_ID] [--trace FILE] -c 'command'
+    python3 cmd_trace.py report [--trace FILE] [--top N]
+'''
+import argparse
+import json
+import os
+import re
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+TRACER = os.path.abspath(__file__)
+UNTRACED = {'cd', 'echo', 'pwd', 'ls', 'punlearn', 'export', 'source', 'conda', 'set', 'mkdir',
+            'rm', 'mv', 'cp', 'sleep', 'kill', 'wait', 'true', 'false',
+            'if', 'then', 'else', 'elif', 'fi', 'for', 'do', 'done'}
+
+
+def tracing_enabled(config):
+    """True if config.json asks for traced scripts."""
+    return bool(config.get('trace', False))
+
+
+def trace_path(config):
+    from helpers import abs_path
+    return os.path.join(abs_path(config['info_dict']['script_dir']), 'logs', 'trace.jsonl')
+
+
+def _tool(command):
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        words = command.split()
+    return os.path.basename(words[0]) if words else ''
+
+
+def should_trace(line):
+    """True for lines that run a tool, False for shell bookkeeping."""
+    stripped = line.strip()
+    if not stripped or stripped.startswith('#') or TRACER in stripped:
+        return False
+    if stripped.endswith('&') or '$!' in stripped:
+        return False
+    if 'update_flag.py' in stripped or 'artifact_store.py' in stripped:
+        return False
+    first = stripped.split()[0]
+    return first not in UNTRACED and '=' not in first
+
+
+def traced(command, step, obs_id=None, trace_file=None):
+    """command wrapped in the tracer (each line of a multi-line command separately)."""
+    out = []
+    for line in command.split('\n'):
+        if not should_trace(line):
+            out.append(line)
+            continue
+        obs = f' --obs {obs_id}' if obs_id else ''
+        trace = f' --trace {trace_file}' if trace_file else ''
+        out.append(f'python3 {TRACER} run --step {step}{obs}{trace} -c {shlex.quote(line.strip())}')
+    return '\n'.join(out)
+
+
+def trace_commands(commands, step, obs_id, config):
+    """Wrap a job's command list when tracing is on; unchanged otherwise."""
+    if not tracing_enabled(config):
+        return list(commands)
+    return [traced(command, step, obs_id, trace_path(config)) for command in commands]
+
+
+def trace_script(path, step, config):
+    """
+    Rewrite a generated script with its tool calls traced (no-op unless tracing is on).
+    The obs_id of a line is taken from the last `cd` into an observation folder, or from the line itself.
+    """
+    if not tracing_enabled(config):
+        return
+    obs_ids = [str(obs_id) for obs_id in config['info_dict'].get('obs_ids', [])]
+    token = re.compile(r'(?<!\d)(' + '|'.join(map(re.escape, obs_ids)) + r')(?!\d)') if obs_ids else None
+    trace_file = trace_path(config)
+    current = None
+    with open(path, 'r') as f:
+        lines = f.read().split('\n')
+    out = []
+    for line in lines:
+        words = line.strip().split()
+        if words[:1] == ['cd']:
+            target = os.path.basename(words[1].rstrip('/')) if len(words) > 1 else ''
+            current = target if target in obs_ids else None
+        obs_id = current
+        if obs_id is None and token is not None:
+            match = token.search(line)
+            obs_id = match.group(1) if match else None
+        out.append(traced(line, step, obs_id, trace_file))
+    with open(path, 'w') as f:
+        f.write('\n'.join(out))
+
+
+def _proc_io():
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key.strip()] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def run(command, step, obs_id, trace_file):
+    """Run command through bash, append its record to trace_file, return its exit code."""
+    io0 = _proc_io()
+    ru0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    t0 = time.monotonic()
+    code = subprocess.call(['bash', '-c', command])
+    wall = time.monotonic() - t0
+    ru1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io1 = _proc_io()
+
+    record = {
+        'step': step, 'obs_id': obs_id, 'tool': _tool(command), 'command': command,
+        'start': round(start, 3), 'end': round(start + wall, 3), 'wall': round(wall, 3),
+        'user': round(ru1.ru_utime - ru0.ru_utime, 3), 'sys': round(ru1.ru_stime - ru0.ru_stime, 3),
+        # ru_maxrss of children: the largest child, in kB on Linux
+        'max_rss_mb': round(ru1.ru_maxrss / 1024.0, 1),
+        'read_bytes': io1.get('read_bytes', 0) - io0.get('read_bytes', 0),
+        'write_bytes': io1.get('write_bytes', 0) - io0.get('write_bytes', 0),
+        'rchar': io1.get('rchar', 0) - io0.get('rchar', 0),
+        'wchar': io1.get('wchar', 0) - io0.get('wchar', 0),
+        'exit': code, 'host': socket.gethostname(), 'cwd': os.getcwd(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+    # one write per record on an O_APPEND file, so concurrent jobs don't interleave lines
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(fd)
+    return code
+
+
+def load_trace(path):
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue     # a line cut short by a killed job
+    return records
+
+
+def _totals(records, key):
+    totals = {}
+    for r in records:
+        t = totals.setdefault(key(r), {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_mb': 0.0,
+                                       'read_bytes': 0, 'write_bytes': 0, 'failed': 0})
+        t['calls'] += 1
+        t['wall'] += r['wall']
+        t['cpu'] += r['user'] + r['sys']
+        t['max_rss_mb'] = max(t['max_rss_mb'], r['max_rss_mb'])
+        t['read_bytes'] += r['read_bytes']
+        t['write_bytes'] += r['write_bytes']
+        t['failed'] += r['exit'] != 0
+    return totals
+
+
+def critical_path(records):
+    """[(step, slowest obs_id, its wall time, summed wall time of the step)] in order of first start."""
+    steps = {}
+    for r in records:
+        s = steps.setdefault(r['step'], {'first': r['start'], 'obs': {}})
+        s['first'] = min(s['first'], r['start'])
+        s['obs'][r['obs_id']] = s['obs'].get(r['obs_id'], 0.0) + r['wall']
+    path = []
+    for step, s in sorted(steps.items(), key=lambda item: item[1]['first']):
+        obs_id, wall = max(s['obs'].items(), key=lambda item: item[1])
+        path.append((step, obs_id, wall, sum(s['obs'].values())))
+    return path
+
+
+def _print_totals(title, totals):
+    print(f"\n{title:<20} {'calls':>6} {'wall s':>10} {'cpu s':>10} {'peak MB':>8} {'read MB':>9} "
+          f"{'write MB':>9} {'failed':>6}")
+    for name, t in sorted(totals.items(), key=lambda item: -item[1]['wall']):
+        print(f"{str(name):<20} {t['calls']:>6} {t['wall']:>10.1f} {t['cpu']:>10.1f} {t['max_rss_mb']:>8.0f} "
+              f"{t['read_bytes'] / 2**20:>9.1f} {t['write_bytes'] / 2**20:>9.1f} {t['failed']:>6}")
+
+
+def report(records, top=10):
+    _print_totals('step', _totals(records, lambda r: r['step']))
+    _print_totals('tool', _totals(records, lambda r: r['tool']))
+    _print_totals('step/obs_id', _totals(records, lambda r: f"{r['step']}/{r['obs_id'] or '-'}"))
+
+    print("\nslowest calls")
+    for r in sorted(records, key=lambda r: -r['wall'])[:top]:
+        print(f"{r['wall']:>10.1f}s  {r['step']:<10} {r['obs_id'] or '-':<8} {r['command'][:90]}")
+
+    path = critical_path(records)
+    print(f"\ncritical path {sum(p[2] for p in path):.1f}s (serial total {sum(p[3] for p in path):.1f}s)")
+    for step, obs_id, wall, total in path:
+        print(f"  {step:<12} {obs_id or '-':<8} {wall:>10.1f}s of {total:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace generated CIAO commands and report on the trace.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_run = sub.add_parser('run', help='run one command and record it')
+    p_run.add_argument('--step', required=True)
+    p_run.add_argument('--obs', default=None)
+    p_run.add_argument('--trace', default=None)
+    p_run.add_argument('-c', dest='shell_command', required=True, help='command line, run with bash -c')
+    p_report = sub.add_parser('report', help='per-step, per-tool and critical-path summary')
+    p_report.add_argument('--trace', default=None)
+    p_report.add_argument('--top', type=int, default=10, help='number of slowest calls listed')
+    args = parser.parse_args()
+
+    trace_file = args.trace
+    if trace_file is None:
+        from helpers import load_config
+        trace_file = trace_path(load_config())
+
+    if args.command == 'run':
+        sys.exit(run(args.shell_command, args.step, args.obs, trace_file))
+    report(load_trace(trace_file), args.top)
+
+
+if __name__ == '__main__':
+    main()
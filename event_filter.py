@@ -0,0 +1,417 @@
+#! /usr/bin/env python3
+'''
+Single-pass event filtering: several dmcopy-style products from one read.
+
+step3 filters each event list three times (exclude sources, energy band, GTI),
+every time reading and writing the whole file.  This engine memory-maps the
+EVENTS table once, walks it in row chunks and, for every requested product,
+evaluates its filter as vectorized masks.  Only the columns named in the
+filters are decoded (straight from the raw big-endian records); the selected
+rows are copied to the outputs as raw records, so the other columns are never
+converted.  Masks shared between products (the same region, say) are computed
+once per chunk.
+
+Supported filters, in dmcopy syntax ([...][...] or comma separated):
+
+    sky=region(file)  exclude sky=region(file)   spatial, physical x/y
+    energy=500:7000   pi=1:548   ccd_id=0:3   ccd_id=0,1,2,3   status=0
+    time=lo:hi        @file.gti                   time, first GTI block of the file
+
+Outputs keep the primary header, the EVENTS header (NAXIS2 updated) and every
+other extension of the input.  A data subspace (DSS) entry is added for each
+filter (DSTYP/DSVAL/DSFORM/DSUNIT, to every DSS component), and a time
+filter intersects the GTI extensions and updates ONTIME/LIVETIME/EXPOSURE,
+as dmcopy does.
+
+Usage:
+    python3 event_filter.py infile --out "[exclude sky=region(src.reg)]" nosrc.evt \\
+                                   --out "[exclude sky=region(src.reg)][energy=500:7000]" band.evt
+'''
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+
+import regions
+from fits_stream import RecordWriter
+
+CHUNK_ROWS = 500_000
+DSS_UNITS = {'energy': ('eV', 'E'), 'pi': ('chan', 'J'), 'pha': ('adu', 'J'), 'ccd_id': ('', 'I'),
+             'status': ('', 'X'), 'time': ('s', 'D')}
+
+_dss_re = re.compile(r'^(\d*)DSTYP(\d+)$')
+
+
+def _split_top(text, sep=','):
+    """Split on sep outside parentheses."""
+    parts, depth, cur = [], 0, []
+    for ch in text:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        if ch == sep and depth == 0:
+            parts.append(''.join(cur))
+            cur = []
+        else:
+            cur.append(ch)
+    parts.append(''.join(cur))
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _ranges(text):
+    """'500:7000' / '0,1,2' / '4:' -> [(lo, hi)] (None for open ends)."""
+    out = []
+    for part in text.split(','):
+        part = part.strip()
+        if ':' in part:
+            lo, hi = part.split(':', 1)
+            out.append((float(lo) if lo.strip() else None, float(hi) if hi.strip() else None))
+        else:
+            out.append((float(part), float(part)))
+    return out
+
+
+def parse_filter(spec):
+    """
+    '[exclude sky=region(a.reg)][energy=500:7000]' -> list of filter dicts
+    {'kind': 'region'|'range'|'gti', 'column', 'value', 'exclude', 'text'}.
+    """
+    filters = []
+    for group in re.findall(r'\[([^\]]*)\]', spec) or [spec]:
+        tokens = _split_top(group)
+        # 'ccd_id=0,1,2' splits into 'ccd_id=0', '1', '2'; glue bare values back on
+        merged = []
+        for token in tokens:
+            if merged and '=' not in token and not token.startswith('@') and re.match(r'^[\d.:\-+eE]+$', token):
+                merged[-1] += ',' + token
+            else:
+                merged.append(token)
+        for token in merged:
+            if token.startswith('@'):
+                filters.append({'kind': 'gti', 'column': 'time', 'value': token[1:], 'exclude': False,
+                                'text': token})
+                continue
+            exclude = token.lower().startswith('exclude ')
+            body = token[8:].strip() if exclude else token
+            column, value = [s.strip() for s in body.split('=', 1)]
+            column = column.lower()
+            match = re.match(r'^region\((.*)\)$', value, re.IGNORECASE)
+            if match:
+                filters.append({'kind': 'region', 'column': column, 'value': match.group(1).strip(),
+                                'exclude': exclude, 'text': token})
+            else:
+                filters.append({'kind': 'range', 'column': column, 'value': value, 'ranges': _ranges(value),
+                                'exclude': exclude, 'text': token})
+    return filters
+
+
+def read_gti_file(path):
+    """Sorted, merged START/STOP of the first GTI block of a file."""
+    from astropy.io import fits
+    with fits.open(path) as hdul:
+        for hdu in hdul[1:]:
+            if hasattr(hdu, 'columns') and 'START' in hdu.columns.names:
+                start = np.asarray(hdu.data['START'], dtype=float)
+                stop = np.asarray(hdu.data['STOP'], dtype=float)
+                break
+        else:
+            raise ValueError(f'No GTI table in {path}')
+    return merge_intervals(start, stop)
+
+
+def merge_intervals(start, stop):
+    order = np.argsort(start)
+    start, stop = start[order], stop[order]
+    out_start, out_stop = [], []
+    for s, e in zip(start, stop):
+        if out_stop and s <= out_stop[-1]:
+            out_stop[-1] = max(out_stop[-1], e)
+        else:
+            out_start.append(s)
+            out_stop.append(e)
+    return np.array(out_start), np.array(out_stop)
+
+
+def intersect_intervals(a, b):
+    """Intersection of two sorted, merged interval lists."""
+    i = j = 0
+    out_start, out_stop = [], []
+    while i < len(a[0]) and j < len(b[0]):
+        lo, hi = max(a[0][i], b[0][j]), min(a[1][i], b[1][j])
+        if lo < hi:
+            out_start.append(lo)
+            out_stop.append(hi)
+        if a[1][i] < b[1][j]:
+            i += 1
+        else:
+            j += 1
+    return np.array(out_start), np.array(out_stop)
+
+
+def in_intervals(t, start, stop):
+    idx = np.searchsorted(start, t, side='right') - 1
+    ok = idx >= 0
+    ok[ok] = t[ok] < stop[idx[ok]]
+    return ok
+
+
+class Column:
+    """Decoder for one column of the raw records: the big-endian field plus TSCAL/TZERO."""
+
+    def __init__(self, header, name):
+        self.field = None
+        for key, value in header.items():
+            if key.startswith('TTYPE') and str(value).strip().lower() == name:
+                n = key[5:]
+                self.field = str(value).strip()
+                self.scale = header.get(f'TSCAL{n}', 1.0)
+                self.zero = header.get(f'TZERO{n}', 0.0)
+                self.form = str(header[f'TFORM{n}']).strip().upper()
+        if self.field is None:
+            raise KeyError(f'No column {name} in the event table')
+
+    def decode(self, records):
+        raw = records[self.field]
+        if self.form.endswith('X'):
+            # bit columns: keep the bytes, filters compare them as a whole
+            return raw
+        if self.scale != 1.0 or self.zero != 0.0:
+            return raw.astype(np.float64) * self.scale + self.zero
+        return raw
+
+
+class Product:
+    """One output file: its filters and writer."""
+
+    def __init__(self, spec, path):
+        self.spec = spec
+        self.path = path
+        self.filters = parse_filter(spec)
+        self.writer = None
+        self.extensions = []
+        self.rows = 0
+
+
+def event_records(hdul, path):
+    """(header, big-endian record dtype, read-only memmap of the raw rows) of the EVENTS table of an open file."""
+    events = hdul['EVENTS']
+    dtype = events.data.dtype.newbyteorder('>') if events.data.dtype.byteorder == '<' else events.data.dtype
+    raw = np.memmap(path, dtype=dtype, mode='r', offset=events.fileinfo()['datLoc'],
+                    shape=(events.header['NAXIS2'],))
+    return events.header, dtype, raw
+
+
+def _region_shapes(path, header):
+    shapes = regions.parse_region_file(path)
+    return regions.to_physical(shapes, regions.event_wcs(header))
+
+
+def range_mask(values, ranges):
+    if values.ndim > 1:
+        # bit column: only exact '0' (all bits clear) is meaningful
+        values = np.where(values.reshape(len(values), -1).any(axis=1), 1, 0)
+    keep = np.zeros(len(values), dtype=bool)
+    for lo, hi in ranges:
+        m = np.ones(len(values), dtype=bool)
+        if lo is not None:
+            m &= values >= lo
+        if hi is not None:
+            m &= values <= hi
+        keep |= m
+    return keep
+
+
+def _next_dss_index(header):
+    used = [int(m.group(2)) for m in map(_dss_re.match, header.keys()) if m]
+    return max(used, default=0) + 1
+
+
+def _dss_prefixes(header):
+    prefixes = {m.group(1) for m in map(_dss_re.match, header.keys()) if m}
+    return sorted(prefixes, key=lambda p: int(p or 1)) or ['']
+
+
+def add_subspace(header, product, shapes_by_file):
+    """Record product's filters as data subspace keywords in header (every DSS component)."""
+    for f in product.filters:
+        if f['kind'] == 'gti':
+            continue        # the time subspace refers to the GTI extensions, which are intersected instead
+        if f['kind'] == 'region':
+            shapes = shapes_by_file[f['value']]
+            if f['exclude']:
+                value = 'field()&' + regions.format_region([dict(s, exclude=not s['exclude']) for s in shapes])
+            else:
+                value = regions.format_region(shapes)
+            column, unit, form = 'sky', 'physical', 'DD'
+        else:
+            column = f['column']
+            unit, form = DSS_UNITS.get(column, ('', 'D'))
+            value = ('!' if f['exclude'] else '') + f['value']
+        n = None
+        for key, val in header.items():
+            m = _dss_re.match(key)
+            if m and m.group(1) == '' and str(val).strip().lower() == column and f['kind'] != 'region':
+                n = int(m.group(2))      # tighten the existing range entry of this column
+        n = n or _next_dss_index(header)
+        for prefix in _dss_prefixes(header):
+            header[f'{prefix}DSTYP{n}'] = column
+            header[f'{prefix}DSVAL{n}'] = value
+            header[f'{prefix}DSFORM{n}'] = form
+            if unit:
+                header[f'{prefix}DSUNIT{n}'] = unit
+
+
+def _time_filters(product):
+    out = None
+    for f in product.filters:
+        if f['kind'] == 'gti':
+            g = read_gti_file(f['value'])
+        elif f['kind'] == 'range' and f['column'] == 'time' and not f['exclude']:
+            lo, hi = f['ranges'][0]
+            g = (np.array([lo if lo is not None else -np.inf]), np.array([hi if hi is not None else np.inf]))
+        else:
+            continue
+        out = g if out is None else intersect_intervals(out, g)
+    return out
+
+
+def other_extensions(hdul, events_index, gti, header):
+    """
+    The input's extensions after EVENTS, with GTI tables intersected with the time filter gti
+    (if any); ONTIME/LIVETIME/EXPOSURE and the per-ccd times of the events header are scaled to match.
+    """
+    from astropy.io import fits
+
+    out, first_ratio = [], None
+    for k, hdu in enumerate(hdul):
+        if k in (0, events_index):
+            continue
+        hdu = hdu.copy()
+        is_gti = hdu.header.get('HDUCLAS1', '').strip().upper() == 'GTI' or hdu.name.startswith('GTI')
+        if gti is not None and is_gti:
+            before = merge_intervals(np.asarray(hdu.data['START'], float), np.asarray(hdu.data['STOP'], float))
+            start, stop = intersect_intervals(before, gti)
+            ontime_before = float(np.sum(before[1] - before[0]))
+            ontime = float(np.sum(stop - start))
+            cols = [fits.Column(name='START', format='D', unit='s', array=start),
+                    fits.Column(name='STOP', format='D', unit='s', array=stop)]
+            new = fits.BinTableHDU.from_columns(cols, name=hdu.name)
+            for card in hdu.header.cards:
+                if card.keyword not in new.header and not card.keyword.startswith(('TTYPE', 'TFORM', 'TUNIT')):
+                    new.header.append(card)
+            hdu = new
+            ratio = ontime / ontime_before if ontime_before else 0.0
+            if first_ratio is None:
+                first_ratio = ratio      # the first GTI block is the one ONTIME refers to
+            ccd = hdu.header.get('CCD_ID')
+            if ccd is not None and f'ONTIME{ccd}' in header:
+                header[f'ONTIME{ccd}'] = ontime
+                for key in (f'LIVTIME{ccd}', f'EXPOSUR{ccd}'):
+                    if key in header:
+                        header[key] = header[key] * ratio
+        out.append(hdu)
+    if first_ratio is not None:
+        for key in ('ONTIME', 'LIVETIME', 'EXPOSURE'):
+            if key in header:
+                header[key] = header[key] * first_ratio
+    return out
+
+
+def filter_events(infile, products, chunk_rows=CHUNK_ROWS):
+    """
+    Write every (filter spec, outfile) product of infile in one pass over its EVENTS table.
+    Returns {outfile: rows written}.
+    """
+    from astropy.io import fits
+
+    products = [Product(spec, path) for spec, path in products]
+    with fits.open(infile, memmap=True) as hdul:
+        events_index = hdul.index_of('EVENTS')
+        header, dtype, raw = event_records(hdul, infile)
+        nrows = len(raw)
+
+        columns, shapes_by_file, gtis = {}, {}, {}
+        for p in products:
+            for f in p.filters:
+                if f['kind'] == 'region':
+                    for name in ('x', 'y'):
+                        columns.setdefault(name, Column(header, name))
+                    if f['value'] not in shapes_by_file:
+                        shapes_by_file[f['value']] = _region_shapes(f['value'], header)
+                else:
+                    columns.setdefault(f['column'], Column(header, f['column']))
+            gtis[p.path] = _time_filters(p)
+
+        for p in products:
+            out_header = header.copy()
+            add_subspace(out_header, p, shapes_by_file)
+            p.extensions = other_extensions(hdul, events_index, gtis[p.path], out_header)
+            p.writer = RecordWriter(p.path, out_header, dtype, hdul[0].header)
+
+        try:
+            for start in range(0, nrows, chunk_rows):
+                chunk = raw[start:start + chunk_rows]
+                decoded, masks = {}, {}
+
+                def values(name):
+                    if name not in decoded:
+                        decoded[name] = columns[name].decode(chunk)
+                    return decoded[name]
+
+                for p in products:
+                    keep = np.ones(len(chunk), dtype=bool)
+                    regions_last = []
+                    for f in p.filters:
+                        if f['kind'] == 'region':
+                            regions_last.append(f)
+                            continue
+                        if f['kind'] == 'gti' or (f['column'] == 'time' and not f['exclude']):
+                            key = ('time', p.path)
+                            if key not in masks:
+                                masks[key] = in_intervals(np.asarray(values('time'), float), *gtis[p.path])
+                        else:
+                            key = ('range', f['column'], f['value'], f['exclude'])
+                            if key not in masks:
+                                m = range_mask(values(f['column']), f['ranges'])
+                                masks[key] = ~m if f['exclude'] else m
+                        keep &= masks[key]
+                    for f in regions_last:
+                        key = ('region', f['value'])
+                        if key not in masks:
+                            masks[key] = regions.contains(shapes_by_file[f['value']],
+                                                          np.asarray(values('x'), float),
+                                                          np.asarray(values('y'), float))
+                        keep &= ~masks[key] if f['exclude'] else masks[key]
+                    p.writer.write_records(chunk[keep])
+                    p.rows += int(keep.sum())
+        finally:
+            for p in products:
+                p.writer.close()
+
+        for p in products:
+            with fits.open(p.path, mode='append') as out:
+                for hdu in p.extensions:
+                    out.append(hdu)
+    return {p.path: p.rows for p in products}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write several filtered event files in one pass.')
+    parser.add_argument('infile', help='event file')
+    parser.add_argument('--out', nargs=2, action='append', required=True, metavar=('FILTER', 'OUTFILE'),
+                        help='dmcopy-style filter and output file; repeat for more products')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='events read per chunk')
+    args = parser.parse_args()
+
+    t0 = time.monotonic()
+    rows = filter_events(args.infile, [tuple(o) for o in args.out], args.chunk_rows)
+    for path, n in rows.items():
+        print(f'{n} events -> {path}')
+    print(f'{os.path.basename(args.infile)} filtered in {time.monotonic() - t0:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
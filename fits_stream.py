@@ -0,0 +1,84 @@
+'''
+Write FITS binary tables in row chunks, without holding the table in memory.
+
+astropy needs the whole table to write a BinTableHDU.  The writers here write
+the header (with NAXIS2 = 0), append each chunk of rows as big-endian
+records, and on close pad the data and patch NAXIS2, so tables of 10^8 events
+can be written in constant memory.  Further HDUs (GTI, ...) can be appended
+with astropy afterwards.
+
+    with TableWriter(path, [('time', 'D', 's'), ('x', 'E', 'pixel')], extname='EVENTS') as w:
+        w.write({'time': t, 'x': x})
+
+RecordWriter takes a finished table header and raw records instead, e.g. to
+copy selected rows of an existing table without decoding them.
+'''
+import numpy as np
+
+BLOCK = 2880
+
+
+class RecordWriter:
+    """Stream raw records (matching `header`) into a new FITS file after `primary_header`."""
+
+    def __init__(self, path, header, dtype, primary_header=None):
+        from astropy.io import fits
+
+        if header.get('PCOUNT', 0):
+            raise ValueError('Tables with variable-length columns cannot be streamed')
+        self.header = header.copy()
+        self.header['NAXIS2'] = 0
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+
+        primary = fits.PrimaryHDU(header=primary_header)
+        self.f = open(path, 'wb')
+        self.f.write(primary.header.tostring().encode('ascii'))
+        self.header_offset = self.f.tell()
+        self.f.write(self.header.tostring().encode('ascii'))
+
+    def write_records(self, records):
+        """Append rows given as an array of self.dtype records."""
+        np.asarray(records, dtype=self.dtype).tofile(self.f)
+        self.rows += len(records)
+
+    def close(self):
+        if self.f is None:
+            return
+        size = self.rows * self.dtype.itemsize
+        self.f.write(b'\0' * (-size % BLOCK))
+        self.header['NAXIS2'] = self.rows
+        self.f.seek(self.header_offset)
+        self.f.write(self.header.tostring().encode('ascii'))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TableWriter(RecordWriter):
+    """Stream rows, given column by column, into a new FITS file holding an empty primary HDU and one table."""
+
+    def __init__(self, path, columns, extname='EVENTS', header=None, primary_header=None):
+        from astropy.io import fits
+
+        cols = [fits.Column(name=name, format=fmt, unit=unit, array=np.zeros(0))
+                for name, fmt, unit in columns]
+        table = fits.BinTableHDU.from_columns(cols, name=extname)
+        # header: {keyword: value or (value, comment)}
+        for key, value in (header or {}).items():
+            table.header[key] = value
+        self.names = [name for name, _, _ in columns]
+        super().__init__(path, table.header, table.data.dtype.newbyteorder('>'), primary_header)
+
+    def write(self, columns):
+        """Append rows given as {name: array} (all arrays the same length)."""
+        n = len(columns[self.names[0]])
+        records = np.empty(n, dtype=self.dtype)
+        for name in self.names:
+            records[name] = columns[name]
+        self.write_records(records)
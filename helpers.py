@@ -1,19 +1,41 @@
+import copy
 import json
 import os
-import shutil
-from glob import glob
 
 # Get the directory where this file lives (repo root)
 REPO_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_PATH = os.path.join(REPO_DIR, "config.json")
+# PIPELINE_CONFIG selects another cluster's config.json (batch.py runs each cluster with its own)
+CONFIG_PATH = os.path.abspath(os.environ.get("PIPELINE_CONFIG", os.path.join(REPO_DIR, "config.json")))
+# (size, mtime_ns) and parsed content of the last config.json read by this process
+_config_cache = {'key': None, 'config': None}
+
 def load_config():
-    """Load config.json from the repo directory."""
-    with open(CONFIG_PATH, "r") as f:
-        return json.load(f)
-def save_config(config):
-    """Save config.json to the repo directory."""
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(config, f, indent=4)
+    """Load config.json from the repo directory (parsed again only when the file changed)."""
+    st = os.stat(CONFIG_PATH)
+    key = (st.st_size, st.st_mtime_ns)
+    if _config_cache['key'] != key:
+        with open(CONFIG_PATH, "r") as f:
+            _config_cache['config'] = json.load(f)
+        _config_cache['key'] = key
+    # callers modify and save the dict they get
+    return copy.deepcopy(_config_cache['config'])
+def save_config(config, replace=False):
+    """
+    Save config through the state store, which exports config.json.  Only the keys changed since
+    this process loaded the config are written (all of them with replace), so concurrent flag
+    updates are kept.
+    """
+    import state_store
+    state_store.save_config(config, None if replace else _config_cache['config'])
+
+def set_flag(flag):
+    """Mark a processing flag as done (one transaction in the state store, exported to config.json)."""
+    import state_store
+    state_store.set_flag(flag)
+
+def use_native(config, stage):
+    """True if config.json asks for the in-process Python engine of a stage instead of the CIAO tools."""
+    return bool(config.get('native', {}).get(stage, False))
 
 def abs_path(path):
     """Convert relative path to absolute (relative to repo root)."""
@@ -21,6 +43,20 @@ def abs_path(path):
         return path
     return os.path.abspath(os.path.join(REPO_DIR, path))
 
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    # VmHWM belongs to this process image; ru_maxrss also counts the parent's peak inherited over fork+exec
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
 def pad_string(string):
     length = len(string)
     n = 5 - length
@@ -30,22 +66,19 @@ def pad_string(string):
 
 
 def get_obs_mode(obs_id):
-    """Get observation mode (VFAINT/FAINT) for an obs_id."""
-    # If dmkeypar not available, default to FAINT
-    if shutil.which("dmkeypar") is None:
-        return "FAINT"
+    """Get observation mode (VFAINT/FAINT) for an obs_id, from the observation catalog."""
+    import obs_catalog
+    from stage_inputs import staging_dir
 
     config = load_config()
-    cluster_dir = abs_path(config["info_dict"]["cluster_directory"])
-    
-    pattern = os.path.join(cluster_dir, str(obs_id), "primary", "*evt2.fits.gz")
-    matches = glob(pattern)
-    if not matches:
+    evt2 = obs_catalog.evt2_path(abs_path(config["info_dict"]["cluster_directory"]), obs_id,
+                                 staging_dir(config))
+    if evt2 is None:
         return "FAINT"  # Default if file not found
 
-    evt2 = matches[0]
-    out = os.popen(f"dmkeypar {evt2} DATAMODE echo+").read().split()
-    return out[0] if out else "FAINT"
+    keywords = obs_catalog.lookup(evt2, config)
+    mode = (keywords or {}).get("DATAMODE")
+    return mode.strip() if mode else "FAINT"
 
 
 # ACIS chip IDs: I = 0,1,2,3 ; S = 4,5,6,7,8,9 (used for ccd_id filter to exclude chip gaps/other array)
@@ -57,14 +90,14 @@ def get_ccd_filter(evt_path):
     """
     Return ccd_id filter string for merge_obs: "0:3" (ACIS-I) or "4:9" (ACIS-S).
     Uses the chip array that has more chips in this observation (same logic as ClusterPyXT).
-    Reads DETNAM from the event file header (e.g. "ACIS-0123" -> ACIS-I -> "0:3").
+    Reads DETNAM from the event file header (e.g. "ACIS-0123" -> ACIS-I -> "0:3") via the observation catalog.
     """
-    try:
-        from astropy.io import fits
-        with fits.open(evt_path) as hdul:
-            detnam = (hdul[1].header.get("DETNAM") or hdul[0].header.get("DETNAM") or "").strip().upper()
-    except Exception:
+    import obs_catalog
+
+    keywords = obs_catalog.lookup(evt_path)
+    if keywords is None:
         return "0:3"  # default to ACIS-I if unreadable
+    detnam = (keywords.get("DETNAM") or "").strip().upper()
 
     if not detnam.startswith("ACIS-"):
         return "0:3"
@@ -0,0 +1,185 @@
+#! /usr/bin/env python3
+'''
+Run the per-observation CIAO commands of step2/step3 in parallel.
+
+step2_repro.py and step3_primary_deflare.py write one serial shell script that
+walks every obs_id in turn.  This runner builds one independent job per obs_id
+from the same command lists and runs the jobs in a bounded process pool, so a
+cluster finishes in roughly the time of its slowest observation.
+
+Every worker gets its own PFILES parameter directory (and tmp dir), so the
+`punlearn ardlib` / `acis_set_ardlib` calls of concurrent jobs don't collide.
+Each job's output goes to its own log file; exit codes and wall times are
+written to summary.json next to the logs, and each job's status and timing
+to the state store (`state_store.py status --step STAGE`).
+
+Usage:
+    python3 job_runner.py repro   [--workers N]
+    python3 job_runner.py deflare [--workers N]
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from helpers import load_config, abs_path, set_flag, use_native
+from cmd_trace import trace_commands
+import state_store
+
+STAGE_FLAGS = {
+    'repro': 'reprocessed',
+    'deflare': 'flare_filtered',
+}
+
+# Set per worker process by _init_worker
+_worker_dirs = None
+
+
+def _init_worker(root):
+    global _worker_dirs
+    work = tempfile.mkdtemp(prefix=f'worker_{os.getpid()}_', dir=root)
+    pfiles = os.path.join(work, 'pfiles')
+    tmp = os.path.join(work, 'tmp')
+    os.makedirs(pfiles)
+    os.makedirs(tmp)
+    _worker_dirs = (pfiles, tmp)
+
+
+def make_job(name, commands, cwd, setup=None):
+    """A job is a list of shell commands run in cwd after the optional setup lines."""
+    return {'name': str(name), 'commands': list(commands), 'cwd': cwd, 'setup': list(setup or [])}
+
+
+def job_script(job, pfiles_dir, tmp_dir):
+    """Bash source for one job, with a private PFILES user directory."""
+    lines = list(job['setup'])
+    # Keep the system parameter path set up by CIAO, replace only the user part.
+    lines.append(f'export PFILES="{pfiles_dir};${{PFILES#*;}}"')
+    lines.append(f'export ASCDS_WORK_PATH={tmp_dir}')
+    lines.append(f'export TMPDIR={tmp_dir}')
+    lines.append(f'cd {job["cwd"]}')
+    lines.append('set -e')
+    lines.extend(job['commands'])
+    return '\n'.join(lines) + '\n'
+
+
+def _run_job(job, log_dir, step=None):
+    pfiles_dir, tmp_dir = _worker_dirs
+    log_path = os.path.join(log_dir, f'{job["name"]}.log')
+    if step:
+        state_store.mark(step, 'running', job['name'], log_path)
+    started = time.time()
+    t0 = time.monotonic()
+    with open(log_path, 'w') as log:
+        proc = subprocess.run(['bash', '-c', job_script(job, pfiles_dir, tmp_dir)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    if step:
+        state_store.mark(step, 'done' if proc.returncode == 0 else 'failed', job['name'], log_path)
+    return {
+        'name': job['name'],
+        'returncode': proc.returncode,
+        'wall_time': time.monotonic() - t0,
+        'started': started,
+        'log': log_path,
+        'worker': os.getpid(),
+    }
+
+
+def run_jobs(jobs, workers=None, log_dir='.', step=None):
+    """
+    Run jobs in a pool of at most `workers` processes (recording each job's status under step, if given).
+    Returns one result dict per job (name, returncode, wall_time, started, log, worker),
+    in the order the jobs were given.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    root = tempfile.mkdtemp(prefix='job_runner_')
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(jobs), 1)),
+                                 initializer=_init_worker, initargs=(root,)) as pool:
+            futures = {pool.submit(_run_job, job, log_dir, step): job['name'] for job in jobs}
+            for future in as_completed(futures):
+                result = future.result()
+                results[result['name']] = result
+                status = 'ok' if result['returncode'] == 0 else f'FAILED ({result["returncode"]})'
+                print(f'{result["name"]}: {status} in {result["wall_time"]:.1f}s, log: {result["log"]}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    ordered = [results[job['name']] for job in jobs]
+    with open(os.path.join(log_dir, 'summary.json'), 'w') as f:
+        json.dump(ordered, f, indent=4)
+    return ordered
+
+
+def repro_jobs(config):
+    """One chandra_repro job per obs_id (same commands as preprocess_data.sh)."""
+    from step2_repro import repro_commands, CONDA_SETUP
+    from obs_catalog import scan_observations
+    from stage_inputs import stage, staging_dir, full_copies
+    input_directory = abs_path(config['info_dict']['cluster_directory'])
+    if staging_dir(config):
+        stage(config)
+        if full_copies(config):
+            input_directory = staging_dir(config)
+    scan_observations(config)
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    reppro_dir_relative = os.path.relpath(reppro_dir, input_directory)
+    return [
+        make_job(obs_id, trace_commands(repro_commands(obs_id, reppro_dir, reppro_dir_relative),
+                                        'reprocess', obs_id, config),
+                 input_directory, setup=CONDA_SETUP)
+        for obs_id in config['info_dict']['obs_ids']
+    ]
+
+
+def deflare_jobs(config):
+    """One deflare/point-source job per reprocessed obs_id (same commands as deflare_point_sources.sh)."""
+    from step3_primary_deflare import deflare_commands, obs_folders
+    from obs_catalog import scan_observations
+    scan_observations(config)
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    jobs = []
+    for folder in obs_folders(reppro_dir):
+        obs_dir = os.path.join(reppro_dir, folder)
+        commands = deflare_commands(folder, obs_dir, use_native(config, 'deflare'),
+                                    use_native(config, 'filter'), config)
+        jobs.append(make_job(folder, trace_commands(commands, 'deflare', folder, config), obs_dir))
+    return jobs
+
+
+STAGE_JOBS = {
+    'repro': repro_jobs,
+    'deflare': deflare_jobs,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run per-observation CIAO jobs in parallel.')
+    parser.add_argument('stage', choices=sorted(STAGE_JOBS))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='maximum number of concurrent jobs (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    jobs = STAGE_JOBS[args.stage](config)
+    log_dir = os.path.join(abs_path(config['info_dict']['script_dir']), 'logs', args.stage)
+
+    t0 = time.monotonic()
+    results = run_jobs(jobs, workers=args.workers, log_dir=log_dir, step=args.stage)
+    failed = [r['name'] for r in results if r['returncode'] != 0]
+    print(f'{len(results)} jobs finished in {time.monotonic() - t0:.1f}s')
+
+    if failed:
+        print(f'Failed: {", ".join(failed)} (see logs in {log_dir})')
+        raise SystemExit(1)
+    set_flag(STAGE_FLAGS[args.stage])
+
+
+if __name__ == '__main__':
+    main()
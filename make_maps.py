@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+'''
+Paint the per-bin fit results of xspec_fit.py into parameter maps.
+
+contbin_binmap.fits is loaded once and every map is a single lookup
+values[binmap]: one table entry per bin, with NaN for pixels outside the bins
+(binmap -1) and for bins that were not fitted or whose fit failed.
+
+Maps (each with _LO and _HI maps from the 90% bounds):
+
+    TEMPERATURE      kT (keV)
+    ABUNDANCE        Z (solar)
+    PSEUDO_PRESSURE  kT * sqrt(norm / area)
+    PSEUDO_ENTROPY   kT * (norm / area)^(-1/3)
+
+area is the number of pixels in the bin.  The pseudo-quantity bounds combine
+the kT and norm bounds that push the quantity the same way, so they are
+conservative.  All maps go into one multi-extension FITS file,
+{map_file_dir}/parameter_maps_sn{sn}_smooth{smooth}.fits, with the WCS of the
+bin map.
+
+Usage:
+    python3 make_maps.py [--results fit_results.fits] [--binmap contbin_binmap.fits] [--output file]
+'''
+import argparse
+import os
+import time
+
+import numpy as np
+
+from helpers import load_config, abs_path, set_flag
+
+STATUS_OK = 0
+
+
+def bin_values(results, nbins):
+    """{column: array indexed by bin (length nbins + 1, last entry NaN)} from the results table."""
+    ok = results['STATUS'] == STATUS_OK
+    bins = np.asarray(results['BIN'])[ok]
+    keep = bins < nbins
+    bins = bins[keep]
+    table = {}
+    for name in results.columns.names:
+        if name in ('BIN', 'STATUS'):
+            continue
+        values = np.full(nbins + 1, np.nan)
+        values[bins] = np.asarray(results[name], dtype=float)[ok][keep]
+        table[name] = values
+    return table
+
+
+def quantities(values, area):
+    """(name, value, lower, upper) for every map, as arrays over bins."""
+    kt, kt_lo, kt_hi = values['KT'], values['KT_LO'], values['KT_HI']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = np.sqrt(values['NORM'] / area)
+        density_lo = np.sqrt(values['NORM_LO'] / area)
+        density_hi = np.sqrt(values['NORM_HI'] / area)
+        entropy = kt * density ** (-2.0 / 3.0)
+        entropy_lo = kt_lo * density_hi ** (-2.0 / 3.0)
+        entropy_hi = kt_hi * density_lo ** (-2.0 / 3.0)
+    return [
+        ('TEMPERATURE', kt, kt_lo, kt_hi),
+        ('ABUNDANCE', values['Z'], values['Z_LO'], values['Z_HI']),
+        ('PSEUDO_PRESSURE', kt * density, kt_lo * density_lo, kt_hi * density_hi),
+        ('PSEUDO_ENTROPY', entropy, entropy_lo, entropy_hi),
+    ]
+
+
+def make_maps(binmap, header, results):
+    """List of ImageHDUs, one per map and bound, painted with values[binmap]."""
+    from astropy.io import fits
+
+    nbins = int(binmap.max()) + 1 if binmap.size and binmap.max() >= 0 else 0
+    # pixels outside every bin index the trailing NaN entry
+    index = np.where(binmap >= 0, binmap, nbins)
+    area = np.bincount(index.ravel(), minlength=nbins + 1).astype(float)
+    area[nbins] = np.nan
+
+    values = bin_values(results, nbins)
+    hdus = []
+    for name, value, lower, upper in quantities(values, area):
+        for suffix, per_bin in (('', value), ('_LO', lower), ('_HI', upper)):
+            hdu = fits.ImageHDU(per_bin.astype(np.float32)[index], header=header, name=name + suffix)
+            hdus.append(hdu)
+    return hdus
+
+
+def map_path(config):
+    info = config['info_dict']
+    return os.path.join(abs_path(info['map_file_dir']),
+                        f"parameter_maps_sn{info['sn_per_region']}_smooth{info['reg_smoothness']}.fits")
+
+
+def write_maps(binmap_path, results_path, output):
+    from astropy.io import fits
+
+    with fits.open(binmap_path) as hdul:
+        header = hdul[0].header.copy()
+        binmap = np.asarray(hdul[0].data, dtype=np.int64)
+    for key in ('BITPIX', 'BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    with fits.open(results_path) as hdul:
+        results = hdul[1].data
+        hdus = make_maps(binmap, header, results)
+
+    primary = fits.PrimaryHDU()
+    primary.header['BINMAP'] = (os.path.basename(binmap_path), 'contour bin map')
+    primary.header['RESULTS'] = (os.path.basename(results_path), 'fit results table')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    fits.HDUList([primary] + hdus).writeto(output, overwrite=True)
+    return [hdu.name for hdu in hdus]
+
+
+def main(argv=None):
+    from step9_pre_fitting import contbin_dir
+
+    parser = argparse.ArgumentParser(description='Build parameter maps from the per-bin fit results.')
+    parser.add_argument('--results', default=None, help='fit results table (default: fit_results.fits)')
+    parser.add_argument('--binmap', default=None, help='bin map (default: contbin_binmap.fits)')
+    parser.add_argument('--output', default=None, help='output file (default: in map_file_dir)')
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    binmap = args.binmap or os.path.join(contbin_dir(config), 'contbin_binmap.fits')
+    results = args.results or os.path.join(contbin_dir(config), 'fit_results.fits')
+    output = args.output or map_path(config)
+
+    t0 = time.monotonic()
+    names = write_maps(binmap, results, output)
+    print(f'{len(names)} maps written to {output} in {time.monotonic() - t0:.2f}s')
+    set_flag('maps_created')
+
+
+if __name__ == '__main__':
+    main()
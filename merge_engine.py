@@ -0,0 +1,413 @@
+#! /usr/bin/env python3
+'''
+Merge observations into broad-band counts, exposure and flux images in NumPy.
+
+step4 runs `merge_obs @clean_evt.list ... bin=1 bands=broad`, which reprojects
+and bins the observations one after another.  This engine reads the same list
+(with its [ccd_id=...] filters) and works per observation in parallel worker
+processes:
+
+  * the events passing the list filter and the broad band (500-7000 eV) are
+    reprojected from the observation's sky x/y to the sky pixels of the first
+    observation (its tangent point, as merge_obs does) and binned at 1 pixel;
+  * the observation's fluximage exposure map from step 3
+    ({obs_id}_0.5-7_thresh.expmap) is reprojected to the same grid by nearest
+    neighbour, in blocks of rows.
+
+Each worker returns only the box of the common grid its exposure map covers;
+the boxes are summed into the two accumulators as they arrive, so memory is
+the full grid plus one box per worker.  As merge_obs does, pixels with less
+than 1.5% of the maximum exposure are zeroed, and the outputs are
+broad_thresh.img, broad_thresh.expmap and broad_flux.img (counts / exposure)
+in merge_dir, with the sky WCS and the physical (LTV) transform of the
+reference observation.
+
+Usage:
+    python3 merge_engine.py [--list clean_evt.list] [--outdir DIR] [--workers N] [--thresh 0.015]
+'''
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+
+import numpy as np
+
+import event_filter
+import regions
+
+BAND = '[energy=500:7000]'
+EXPMAP_THRESH = 0.015
+CHUNK_ROWS = 1_000_000
+TILE_ROWS = 256
+
+
+def read_list(path):
+    """[(event file, filter spec)] from a merge_obs @list ('file[ccd_id=0:3]' per line)."""
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            bracket = line.find('[')
+            if bracket < 0:
+                entries.append((line, ''))
+            else:
+                entries.append((line[:bracket], line[bracket:]))
+    return entries
+
+
+def expmap_path(evt_path):
+    """The step3 fluximage exposure map next to an event file."""
+    obs_dir = os.path.dirname(os.path.abspath(evt_path))
+    for pattern in ('*_0.5-7_thresh.expmap', '*broad_thresh.expmap'):
+        found = sorted(glob(os.path.join(obs_dir, pattern)))
+        if found:
+            return found[0]
+    raise FileNotFoundError(f'No exposure map next to {evt_path} (run fluximage in step 3 first)')
+
+
+def reference_wcs(evt_path):
+    """WCS of the sky x/y columns of the reference observation."""
+    from astropy.io import fits
+    with fits.open(evt_path, memmap=True) as hdul:
+        return regions.event_wcs(hdul['EVENTS'].header)
+
+
+def obs_box(evt_path, ref_wcs):
+    """
+    (x0, y0, nx, ny): the box of reference sky pixels covered by the observation's exposure map.
+    Sky pixels are centred on integers, so the box spans x0 + 0.5 to x0 + nx + 0.5.
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    with fits.open(expmap_path(evt_path), memmap=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        rows = np.flatnonzero(np.any(data > 0, axis=1))
+        cols = np.flatnonzero(np.any(data > 0, axis=0))
+        if not len(rows):
+            raise ValueError(f'Exposure map of {evt_path} is empty')
+        exp_wcs = WCS(header, naxis=2)
+    # pixel edges of the exposed part, in array index coordinates
+    i = np.array([cols[0] - 0.5, cols[-1] + 0.5, cols[0] - 0.5, cols[-1] + 0.5])
+    j = np.array([rows[0] - 0.5, rows[0] - 0.5, rows[-1] + 0.5, rows[-1] + 0.5])
+    ra, dec = exp_wcs.all_pix2world(i, j, 0)
+    x, y = ref_wcs.all_world2pix(ra, dec, 1)
+    x0, y0 = int(np.floor(x.min() - 0.5)) - 1, int(np.floor(y.min() - 0.5)) - 1
+    return x0, y0, int(np.ceil(x.max() - 0.5)) + 1 - x0, int(np.ceil(y.max() - 0.5)) + 1 - y0
+
+
+def union_box(boxes):
+    x0 = min(b[0] for b in boxes)
+    y0 = min(b[1] for b in boxes)
+    x1 = max(b[0] + b[2] for b in boxes)
+    y1 = max(b[1] + b[3] for b in boxes)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def _same_frame(a, b):
+    return (np.allclose(a.wcs.crval, b.wcs.crval, rtol=0, atol=1e-12)
+            and np.allclose(a.wcs.crpix, b.wcs.crpix) and np.allclose(a.wcs.cdelt, b.wcs.cdelt))
+
+
+def bin_events(evt_path, spec, ref_wcs, box, chunk_rows=CHUNK_ROWS):
+    """Counts (ny, nx) in box of the events passing spec and the broad band. Returns (counts, events, exposure)."""
+    from astropy.io import fits
+
+    x0, y0, nx, ny = box
+    filters = event_filter.parse_filter(spec + BAND)
+    for f in filters:
+        if f['kind'] != 'range':
+            raise ValueError(f'Only column range filters are supported in merge lists: {f["text"]}')
+    counts = np.zeros(ny * nx, dtype=np.int64)
+    with fits.open(evt_path, memmap=True) as hdul:
+        header, _, raw = event_filter.event_records(hdul, evt_path)
+        exposure = float(header.get('EXPOSURE', 0.0))
+        obs_wcs = regions.event_wcs(header)
+        same = _same_frame(obs_wcs, ref_wcs)
+        columns = {name: event_filter.Column(header, name) for name in {f['column'] for f in filters} | {'x', 'y'}}
+        for start in range(0, len(raw), chunk_rows):
+            chunk = raw[start:start + chunk_rows]
+            keep = np.ones(len(chunk), dtype=bool)
+            for f in filters:
+                m = event_filter.range_mask(columns[f['column']].decode(chunk), f['ranges'])
+                keep &= ~m if f['exclude'] else m
+            x = np.asarray(columns['x'].decode(chunk)[keep], dtype=float)
+            y = np.asarray(columns['y'].decode(chunk)[keep], dtype=float)
+            if not same:
+                ra, dec = obs_wcs.all_pix2world(x, y, 1)
+                x, y = ref_wcs.all_world2pix(ra, dec, 1)
+            i = np.floor(x - 0.5 - x0).astype(np.int64)
+            j = np.floor(y - 0.5 - y0).astype(np.int64)
+            inside = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)
+            counts += np.bincount(j[inside] * nx + i[inside], minlength=ny * nx)
+    return counts.reshape(ny, nx).astype(np.float32), int(counts.sum()), exposure
+
+
+def reproject_expmap(evt_path, ref_wcs, box, tile_rows=TILE_ROWS):
+    """The observation's exposure map resampled (nearest neighbour) onto box of the reference sky pixels."""
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    x0, y0, nx, ny = box
+    out = np.zeros((ny, nx), dtype=np.float32)
+    with fits.open(expmap_path(evt_path), memmap=True) as hdul:
+        data = hdul[0].data
+        exp_wcs = WCS(hdul[0].header, naxis=2)
+        eny, enx = data.shape
+        xs = x0 + 1.0 + np.arange(nx)
+        for start in range(0, ny, tile_rows):
+            ys = y0 + 1.0 + np.arange(start, min(start + tile_rows, ny))
+            x, y = np.meshgrid(xs, ys)
+            ra, dec = ref_wcs.all_pix2world(x.ravel(), y.ravel(), 1)
+            i, j = exp_wcs.all_world2pix(ra, dec, 0)
+            i = np.rint(i).astype(np.int64)
+            j = np.rint(j).astype(np.int64)
+            ok = (i >= 0) & (i < enx) & (j >= 0) & (j < eny)
+            tile = np.zeros(x.size, dtype=np.float32)
+            tile[ok] = data[j[ok], i[ok]]
+            out[start:start + len(ys)] = tile.reshape(len(ys), nx)
+    return out
+
+
+def contribution(evt_path, spec, ref_wcs, box):
+    """One observation's (box, counts, exposure map, n events, EXPOSURE) on the reference grid."""
+    counts, n_events, exposure = bin_events(evt_path, spec, ref_wcs, box)
+    return box, counts, reproject_expmap(evt_path, ref_wcs, box), n_events, exposure
+
+
+def _box_task(args):
+    return obs_box(*args)
+
+
+def image_header(ref_wcs, grid, exposure):
+    """Sky WCS and physical transform of the merged images (grid = (x0, y0, nx, ny) in reference sky pixels)."""
+    from astropy.io import fits
+
+    x0, y0, _, _ = grid
+    ltv1, ltv2 = float(-x0), float(-y0)
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = ref_wcs.wcs.ctype
+    header['CRVAL1'], header['CRVAL2'] = ref_wcs.wcs.crval
+    header['CRPIX1'], header['CRPIX2'] = ref_wcs.wcs.crpix[0] + ltv1, ref_wcs.wcs.crpix[1] + ltv2
+    header['CDELT1'], header['CDELT2'] = ref_wcs.wcs.cdelt
+    header['CUNIT1'] = header['CUNIT2'] = 'deg'
+    header['LTM1_1'], header['LTM2_2'] = 1.0, 1.0
+    header['LTV1'], header['LTV2'] = ltv1, ltv2
+    header['WCSNAMEP'] = 'PHYSICAL'
+    header['CTYPE1P'], header['CTYPE2P'] = 'x', 'y'
+    header['CRPIX1P'] = header['CRPIX2P'] = 0.5
+    header['CRVAL1P'], header['CRVAL2P'] = x0 + 0.5, y0 + 0.5
+    header['CDELT1P'] = header['CDELT2P'] = 1.0
+    header['EXPOSURE'] = (exposure, 'summed exposure of the merged observations')
+    return header
+
+
+def write_images(outdir, counts, expmap, header, thresh=EXPMAP_THRESH):
+    """Apply the exposure threshold and write broad_thresh.img/.expmap and broad_flux.img."""
+    from astropy.io import fits
+
+    low = expmap < thresh * float(expmap.max()) if expmap.size else np.zeros(expmap.shape, bool)
+    counts[low] = 0
+    expmap[low] = 0
+    flux = np.zeros_like(expmap)
+    np.divide(counts, expmap, out=flux, where=expmap > 0)
+    os.makedirs(outdir, exist_ok=True)
+    for name, data, unit in (('broad_thresh.img', counts, 'counts'),
+                             ('broad_thresh.expmap', expmap, 'cm**2 s'),
+                             ('broad_flux.img', flux, 'photon/cm**2/s')):
+        h = header.copy()
+        h['BUNIT'] = unit
+        fits.writeto(os.path.join(outdir, name), data, h, overwrite=True)
+
+
+def contributions_dir(outdir):
+    """Where --incremental keeps the per-observation contributions: next to the merge directory."""
+    return os.path.abspath(outdir).rstrip(os.sep) + '_contributions'
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def fingerprint(evt_path, spec):
+    """What a contribution depends on: the event file, its exposure map, the filter and the band."""
+    return {'evt': _file_stamp(evt_path), 'expmap': _file_stamp(expmap_path(evt_path)), 'spec': spec + BAND}
+
+
+def _entry_key(evt_path, spec):
+    """Name of a contribution: changes whenever the observation has to be binned again."""
+    return hashlib.sha1(json.dumps(fingerprint(evt_path, spec)).encode()).hexdigest()[:16]
+
+
+def _wcs_state(wcs):
+    return {'ctype': list(wcs.wcs.ctype), 'crval': list(wcs.wcs.crval),
+            'crpix': list(wcs.wcs.crpix), 'cdelt': list(wcs.wcs.cdelt)}
+
+
+def _wcs_from_state(state):
+    from astropy.wcs import WCS
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = state['ctype']
+    wcs.wcs.crval = state['crval']
+    wcs.wcs.crpix = state['crpix']
+    wcs.wcs.cdelt = state['cdelt']
+    return wcs
+
+
+# sums and member list of an incremental merge, in one file so they are always replaced together
+STATE_FILE = 'merge_state.npz'
+# the separate files of earlier versions, read once if there is no STATE_FILE yet
+LEGACY_STATE = ('merge_state.json', 'counts.npy', 'expmap.npy')
+
+
+def load_state(keep):
+    """(state, counts, expmap) of the contributions kept in keep, or None if there are none."""
+    path = os.path.join(keep, STATE_FILE)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            return json.loads(str(saved['state'])), saved['counts'], saved['expmap']
+    legacy = [os.path.join(keep, name) for name in LEGACY_STATE]
+    if not all(os.path.exists(p) for p in legacy):
+        return None
+    with open(legacy[0], 'r') as f:
+        state = json.load(f)
+    return state, np.load(legacy[1]), np.load(legacy[2])
+
+
+def save_state(keep, state, counts, expmap):
+    """Accumulators and the state that describes them, replaced atomically in one file."""
+    os.makedirs(keep, exist_ok=True)
+    path = os.path.join(keep, STATE_FILE)
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        np.savez(f, state=np.array(json.dumps(state)), counts=counts, expmap=expmap)
+    os.replace(tmp, path)
+    for name in LEGACY_STATE:
+        if os.path.exists(os.path.join(keep, name)):
+            os.remove(os.path.join(keep, name))
+
+
+def _grow(data, grid, new_grid):
+    """data on grid, zero-padded to new_grid (which contains grid)."""
+    if grid == new_grid:
+        return data
+    x0, y0, nx, ny = grid
+    gx0, gy0, gnx, gny = new_grid
+    out = np.zeros((gny, gnx), dtype=data.dtype)
+    out[y0 - gy0:y0 - gy0 + ny, x0 - gx0:x0 - gx0 + nx] = data
+    return out
+
+
+def _add_box(acc, grid, box, data, sign=1.0):
+    gx0, gy0, _, _ = grid
+    x0, y0, nx, ny = box
+    acc[y0 - gy0:y0 - gy0 + ny, x0 - gx0:x0 - gx0 + nx] += sign * data
+
+
+def merge(entries, outdir, workers=None, thresh=EXPMAP_THRESH, keep=None):
+    """
+    Merge [(event file, filter spec)] into outdir. Returns (observations binned, observations removed).
+
+    With keep (a directory), every observation's contribution and the unthresholded sums are kept
+    there.  A later merge then bins only the observations that are new or whose files changed, and
+    subtracts the contributions of the ones that left the list; the reference frame stays the one
+    of the first merge.
+    """
+    if not entries:
+        raise ValueError('Nothing to merge: the merge list is empty')
+    workers = workers or os.cpu_count() or 1
+    loaded = load_state(keep) if keep else None
+    if loaded is None:
+        state = {'ref': _wcs_state(reference_wcs(entries[0][0])), 'grid': None, 'members': {}}
+        counts = expmap = None
+    else:
+        state, counts, expmap = loaded
+    ref_wcs = _wcs_from_state(state['ref'])
+    grid = tuple(state['grid']) if state['grid'] else None
+    members = state['members']
+
+    wanted = {_entry_key(path, spec): (path, spec) for path, spec in entries}
+    removed = [k for k in members if k not in wanted]
+    added = [k for k in wanted if k not in members]
+
+    for k in removed:
+        m = members.pop(k)
+        with np.load(os.path.join(keep, f'{k}.npz')) as old:
+            _add_box(counts, grid, tuple(m['box']), old['counts'], -1.0)
+            _add_box(expmap, grid, tuple(m['box']), old['expmap'], -1.0)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        boxes = list(pool.map(_box_task, [(wanted[k][0], ref_wcs) for k in added]))
+        new_grid = union_box(boxes + ([grid] if grid else []))
+        if grid is None:
+            counts = np.zeros((new_grid[3], new_grid[2]), dtype=np.float64)
+            expmap = np.zeros((new_grid[3], new_grid[2]), dtype=np.float64)
+        else:
+            counts, expmap = _grow(counts, grid, new_grid), _grow(expmap, grid, new_grid)
+        grid = new_grid
+
+        tasks = [(k, (wanted[k][0], wanted[k][1], ref_wcs, box)) for k, box in zip(added, boxes)]
+        # at most `workers` boxes in flight; each is added as soon as it is done
+        pending = {}
+        while tasks or pending:
+            while tasks and len(pending) < workers:
+                k, task = tasks.pop(0)
+                pending[pool.submit(contribution, *task)] = k
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = pending.pop(future)
+                box, c, e, n_events, exposure = future.result()
+                _add_box(counts, grid, box, c)
+                _add_box(expmap, grid, box, e)
+                members[k] = {'evt': wanted[k][0], 'spec': wanted[k][1], 'box': list(box), 'events': n_events, 'exposure': exposure}
+                if keep:
+                    os.makedirs(keep, exist_ok=True)
+                    np.savez(os.path.join(keep, f'{k}.npz'), counts=c, expmap=e)
+
+    state['grid'] = list(grid)
+    if keep:
+        save_state(keep, state, counts, expmap)
+        # only now that the state no longer lists them
+        for k in removed:
+            os.remove(os.path.join(keep, f'{k}.npz'))
+    total_exposure = sum(m['exposure'] for m in members.values())
+    write_images(outdir, counts.astype(np.float32), expmap.astype(np.float32),
+                 image_header(ref_wcs, grid, total_exposure), thresh)
+    return len(added), len(removed)
+
+
+def main():
+    from helpers import load_config, abs_path, peak_rss_mb
+
+    parser = argparse.ArgumentParser(description='Reproject and merge observations without merge_obs.')
+    parser.add_argument('--list', default=None, help='merge list (default: {reppro_dir}/clean_evt.list)')
+    parser.add_argument('--outdir', default=None, help='output directory (default: merge_dir)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: number of CPUs)')
+    parser.add_argument('--thresh', type=float, default=EXPMAP_THRESH,
+                        help='zero pixels below this fraction of the maximum exposure')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep per-observation contributions next to the output directory and '
+                             'rebin only observations that were added or changed')
+    args = parser.parse_args()
+
+    config = load_config()
+    list_path = args.list or os.path.join(abs_path(config['info_dict']['reppro_dir']), 'clean_evt.list')
+    outdir = args.outdir or abs_path(config['info_dict']['merge_dir'])
+
+    t0 = time.monotonic()
+    entries = read_list(list_path)
+    keep = contributions_dir(outdir) if args.incremental else None
+    binned, removed = merge(entries, outdir, args.workers, args.thresh, keep)
+    print(f'Merged {len(entries)} observations into {outdir} ({binned} binned, {removed} removed) in '
+          f'{time.monotonic() - t0:.1f}s, peak RSS {peak_rss_mb():.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#! /usr/bin/env python3
+'''
+Header-only catalog of the observations' event files.
+
+Script generation used to ask every event file for one keyword at a time
+(`dmkeypar` through os.popen for DATAMODE, astropy for DETNAM).  This module
+reads the primary and EVENTS headers of each file once, without touching the
+event data (gzip files are only decompressed up to the end of the EVENTS
+header), and keeps the keywords below in a sidecar index:
+
+    DATAMODE, DETNAM, EXPOSURE, ONTIME, RA_NOM, DEC_NOM, NAXIS2 (number of events)
+
+The index is {script_dir}/obs_catalog.json, keyed by absolute path and
+checked against each file's size and mtime, so a changed file is rescanned
+and everything else is answered without opening it.  helpers.get_obs_mode
+and helpers.get_ccd_filter read from it.
+
+Usage:
+    python3 obs_catalog.py [--workers N]
+'''
+import argparse
+import gzip
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+from helpers import load_config, abs_path, REPO_DIR
+
+KEYWORDS = ('OBS_ID', 'DATAMODE', 'DETNAM', 'EXPOSURE', 'ONTIME', 'RA_NOM', 'DEC_NOM', 'NAXIS2')
+BLOCK = 2880
+CARD = 80
+
+# (index path, {path: entry}, dirty) of this process
+_cache = {'path': None, 'entries': None, 'dirty': False}
+
+
+def _value(text):
+    """Python value of the value field of a header card."""
+    text = text.strip()
+    if text.startswith("'"):
+        out, i = [], 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    out.append("'")
+                    i += 2
+                    continue
+                break
+            out.append(text[i])
+            i += 1
+        return ''.join(out).rstrip()
+    token = text.split('/', 1)[0].strip()
+    if token in ('T', 'F'):
+        return token == 'T'
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token.replace('D', 'E'))
+    except ValueError:
+        return token or None
+
+
+def _read_header(f):
+    """Cards of the next header in f as a dict, or None at end of file."""
+    header = {}
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            return None
+        text = block.decode('ascii', errors='replace')
+        for k in range(0, BLOCK, CARD):
+            card = text[k:k + CARD]
+            key = card[:8].strip()
+            if key == 'END':
+                return header
+            if card[8:10] == '= ' and key not in header:
+                header[key] = _value(card[10:])
+
+
+def _data_size(header):
+    naxis = header.get('NAXIS', 0)
+    if not naxis:
+        return 0
+    n = 1
+    for axis in range(1, naxis + 1):
+        n *= header.get(f'NAXIS{axis}', 0)
+    size = abs(header.get('BITPIX', 8)) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + n)
+    return -(-size // BLOCK) * BLOCK
+
+
+def read_keywords(path):
+    """KEYWORDS from the primary and EVENTS headers (EVENTS wins), reading headers only."""
+    opener = gzip.open if path.endswith('.gz') else open
+    found = {}
+    with opener(path, 'rb') as f:
+        primary = _read_header(f)
+        if primary is None:
+            raise OSError(f'{path} is not a FITS file')
+        found.update(primary)
+        # walk the extensions until the event table (normally the first one)
+        size = _data_size(primary)
+        while True:
+            if size:
+                f.seek(size, os.SEEK_CUR)
+            header = _read_header(f)
+            if header is None:
+                break
+            if header.get('EXTNAME', '').upper() == 'EVENTS':
+                found.update(header)
+                break
+            size = _data_size(header)
+    return {key: found.get(key) for key in KEYWORDS}
+
+
+def index_path(config=None):
+    config = config or load_config()
+    script_dir = config['info_dict'].get('script_dir')
+    return os.path.join(abs_path(script_dir) if script_dir else REPO_DIR, 'obs_catalog.json')
+
+
+def _entries(path):
+    if _cache['path'] != path:
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        _cache.update(path=path, entries=entries, dirty=False)
+    return _cache['entries']
+
+
+def save_index():
+    """Write the index back if this process added or refreshed entries."""
+    if not _cache['dirty']:
+        return
+    path = _cache['path']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(_cache['entries'], f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+    _cache['dirty'] = False
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def headers(paths, workers=None, config=None):
+    """{path: keywords} for every readable path, scanning only files missing from or stale in the index."""
+    entries = _entries(index_path(config))
+    out, todo = {}, []
+    for path in map(os.path.abspath, paths):
+        try:
+            size, mtime = _stat_key(path)
+        except OSError:
+            continue
+        entry = entries.get(path)
+        if entry and entry['size'] == size and entry['mtime_ns'] == mtime:
+            out[path] = entry['keywords']
+        else:
+            todo.append((path, size, mtime))
+
+    def scan(item):
+        try:
+            return item, read_keywords(item[0])
+        except OSError:
+            return item, None
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=workers or min(16, len(todo))) as pool:
+            for (path, size, mtime), keywords in pool.map(scan, todo):
+                if keywords is None:
+                    continue
+                entries[path] = {'size': size, 'mtime_ns': mtime, 'keywords': keywords}
+                out[path] = keywords
+        _cache['dirty'] = True
+        save_index()
+    return out
+
+
+def lookup(path, config=None):
+    """Keywords of one file, or None if it can't be read."""
+    return headers([path], workers=1, config=config).get(os.path.abspath(path))
+
+
+def evt2_path(cluster_dir, obs_id, staged_dir=None):
+    """
+    Primary evt2 file of an obs_id in the download directory, or None.  With staged_dir
+    (stage_inputs.py) the uncompressed copy is preferred while it is newer than the download.
+    """
+    matches = glob(os.path.join(cluster_dir, str(obs_id), 'primary', '*evt2.fits.gz'))
+    if staged_dir and matches:
+        staged = os.path.join(staged_dir, str(obs_id), 'primary', os.path.basename(matches[0])[:-len('.gz')])
+        if os.path.exists(staged) and os.path.getmtime(staged) >= os.path.getmtime(matches[0]):
+            return staged
+    return matches[0] if matches else None
+
+
+def scan_observations(config=None, workers=None):
+    """Index the primary evt2 of every obs_id in parallel. Returns {obs_id: keywords or None}."""
+    from stage_inputs import staging_dir
+
+    config = config or load_config()
+    cluster_dir = abs_path(config['info_dict']['cluster_directory'])
+    staged = staging_dir(config)
+    files = {str(obs_id): evt2_path(cluster_dir, obs_id, staged) for obs_id in config['info_dict']['obs_ids']}
+    found = headers([path for path in files.values() if path], workers, config)
+    return {obs_id: found.get(os.path.abspath(path)) if path else None for obs_id, path in files.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan the observation headers into the catalog index.')
+    parser.add_argument('--workers', type=int, default=None, help='files read in parallel')
+    args = parser.parse_args()
+
+    config = load_config()
+    catalog = scan_observations(config, args.workers)
+    print(f"{'obs_id':>8} {'DATAMODE':>9} {'DETNAM':>12} {'EXPOSURE':>10} {'ONTIME':>10} "
+          f"{'RA_NOM':>10} {'DEC_NOM':>10} {'events':>10}")
+    for obs_id, keywords in catalog.items():
+        if keywords is None:
+            print(f'{obs_id:>8} (no evt2 file)')
+            continue
+        print(f"{obs_id:>8} {keywords['DATAMODE'] or '':>9} {keywords['DETNAM'] or '':>12} "
+              f"{keywords['EXPOSURE'] or 0:>10.0f} {keywords['ONTIME'] or 0:>10.0f} "
+              f"{keywords['RA_NOM'] or 0:>10.5f} {keywords['DEC_NOM'] or 0:>10.5f} {keywords['NAXIS2'] or 0:>10}")
+    print(f'Index: {index_path(config)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+'''
+Long-lived pipeline driver: every step in one interpreter.
+
+pipeline_dag.py starts a new interpreter for every step generator, each of
+which imports astropy again, and every generated script ends with one more
+`python3 update_flag.py FLAG` per flag (per observation in step2).  This
+driver plans the same nodes with the same fingerprints (pipeline_dag.plan),
+but:
+
+  * imports each step module on first use and calls its main() in this
+    process, so astropy, numpy and the step modules are imported once per
+    run, and not at all for `status`;
+  * keeps the parsed config.json (helpers.load_config) and the observation
+    header index (obs_catalog) in memory from one stage to the next;
+  * runs the generated scripts with their update_flag.py lines taken out and
+    sets those flags in the state store itself once the script succeeded
+    (a script now fails with its last tool's exit code, not update_flag's);
+  * runs the per-observation stages with --workers through
+    job_runner.main in this process.
+
+The CIAO tools the scripts call still run as their own processes.  Run it
+from the repository directory.
+
+Usage:
+    python3 -m pipeline status [--hash] [--json]
+    python3 -m pipeline run [--hash] [--dry-run] [--force NODE] [--until NODE] [--only NODE] [--workers N]
+'''
+import importlib
+import os
+import re
+import sys
+
+from helpers import load_config, abs_path
+import pipeline_dag
+import state_store
+
+FLAG_LINE = re.compile(r'^python3 \S*update_flag\.py (\S+)\s*$')
+
+
+def run_main(module, argv=()):
+    """Call module.main in this interpreter, with argv when it takes one. Returns the exit code."""
+    import traceback
+
+    main = importlib.import_module(module).main
+    try:
+        if main.__code__.co_argcount:
+            main(list(argv))
+        else:
+            main()
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            return exc.code or 0
+        print(exc.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def run_script(path):
+    """Run a generated script without its update_flag.py calls, then set those flags. Returns the exit code."""
+    import subprocess
+    import tempfile
+
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    flags = []
+    for match in filter(None, map(FLAG_LINE.match, lines)):
+        if match.group(1) not in flags:
+            flags.append(match.group(1))
+    fd, body = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'.{os.path.basename(path)}.', suffix='.sh')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(line for line in lines if not FLAG_LINE.match(line))
+        code = subprocess.call(['bash', body])
+    finally:
+        os.remove(body)
+    if code != 0:
+        return code
+    for flag in flags:
+        try:
+            state_store.set_flag(flag, must_exist=True)
+        except KeyError:
+            print(f'Flag {flag} not found in config.json')
+            return 1
+    return 0
+
+
+def run_node(config, name, workers=None):
+    """pipeline_dag.run_node, with the generators and job_runner called in this process."""
+    generator, script, _, _, _, _, runner_stage = pipeline_dag.NODES[name]
+    missing = pipeline_dag.missing_input(config, name)
+    if missing:
+        print(f'{name}: missing input {missing}')
+        return 1
+    if runner_stage and workers:
+        return run_main('job_runner', [runner_stage, '--workers', str(workers)])
+    options = ['--workers', str(workers)] if workers and name in pipeline_dag.WORKER_OPTION else []
+    code = run_main(os.path.splitext(generator)[0], options)
+    if code != 0 or script is None:
+        return code
+    return run_script(os.path.join(abs_path(config['info_dict']['script_dir']), script))
+
+
+def main(argv=None):
+    args = pipeline_dag.build_parser('Run the pipeline steps in one long-lived process.').parse_args(argv)
+
+    config = load_config()
+    state = pipeline_dag.load_state(config)
+    steps = pipeline_dag.plan(config, state, args.hash, args.force)
+    if args.command == 'status':
+        pipeline_dag.print_status(steps, args.json)
+        return 0
+    steps = pipeline_dag.select(steps, args.only, args.until)
+    return pipeline_dag.execute(config, state, steps, args.hash, args.workers, args.dry_run, runner=run_node)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
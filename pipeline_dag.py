@@ -0,0 +1,374 @@
+#! /usr/bin/env python3
+'''
+Dependency-aware runner for steps 2-9, the spectral fits and the maps.
+
+The `flags` in config.json only record that a step ran once.  This module
+describes every step as a node with declared inputs, outputs and config
+parameters, fingerprints them, and reruns only the nodes whose inputs or
+parameters changed since their last successful run, plus everything
+downstream of them.
+
+Fingerprints use file size + mtime as the fast path.  With --hash a sha256 of
+the content is also recorded, and a file whose mtime changed but whose content
+did not (e.g. it was touched or copied) is not treated as changed.
+
+The last successful fingerprints, and the status and wall time of every node
+run, are kept in the state store (state_store.py); a pipeline_state.json
+left by older versions is imported once.  Flags are still set so the existing
+scripts keep working.
+
+pipeline.py (`python3 -m pipeline`) runs the same plan with every step in
+one process.
+
+Usage:
+    python3 pipeline_dag.py status [--hash] [--json]
+    python3 pipeline_dag.py run [--hash] [--dry-run] [--force NODE] [--until NODE] [--only NODE] [--workers N]
+'''
+import argparse
+import hashlib
+import json
+import os
+import sys
+from glob import glob
+
+from helpers import load_config, abs_path, set_flag, REPO_DIR
+import state_store
+
+HASH_CHUNK = 1 << 20
+
+
+def _obs_dirs(info):
+    reppro_dir = abs_path(info['reppro_dir'])
+    return [(str(obs_id), os.path.join(reppro_dir, str(obs_id))) for obs_id in info['obs_ids']]
+
+
+def _contbin_dir(info):
+    return os.path.join(abs_path(info['spec_file_dir']),
+                        f"contbin_sn{info['sn_per_region']}_smooth{info['reg_smoothness']}")
+
+
+def _reprocess_io(info):
+    cluster_dir = abs_path(info['cluster_directory'])
+    inputs = []
+    for obs_id in info['obs_ids']:
+        inputs += sorted(glob(os.path.join(cluster_dir, str(obs_id), 'primary', '*evt2.fits*')))
+    outputs = [os.path.join(d, f'acisf{obs_id}_repro_evt2.fits') for obs_id, d in _obs_dirs(info)]
+    return inputs, outputs
+
+
+def _deflare_io(info):
+    inputs = [os.path.join(d, f'acisf{obs_id}_repro_evt2.fits') for obs_id, d in _obs_dirs(info)]
+    outputs = []
+    for obs_id, d in _obs_dirs(info):
+        outputs += [os.path.join(d, f'acisf{obs_id}_clean_evt.fits'),
+                    os.path.join(d, f'{obs_id}_background_clean.evt')]
+    return inputs, outputs
+
+
+def _merge_io(info):
+    inputs = [os.path.join(d, f'acisf{obs_id}_clean_evt.fits') for obs_id, d in _obs_dirs(info)]
+    merge_dir = abs_path(info['merge_dir'])
+    outputs = [os.path.join(merge_dir, name)
+               for name in ('broad_thresh.img', 'broad_thresh.expmap', 'broad_flux.img')]
+    return inputs, outputs
+
+
+def _flux_io(info):
+    merge_dir = abs_path(info['merge_dir'])
+    inputs = [os.path.join(merge_dir, name)
+              for name in ('broad_thresh.img', 'broad_thresh.expmap', 'broad_flux.img')]
+    return inputs, [os.path.join(merge_dir, 'scaled_broad_flux.fits')]
+
+
+def _crop_io(info):
+    merge_dir = abs_path(info['merge_dir'])
+    region_dir = abs_path(info['region_file_dir'])
+    inputs = [os.path.join(merge_dir, name)
+              for name in ('broad_thresh.img', 'broad_thresh.expmap', 'scaled_broad_flux.fits')]
+    inputs += [os.path.join(region_dir, name) for name in ('src_0.5-7-nps-noem.reg', 'min_xy.reg')]
+    # square.reg is optional: step6 only crops when it exists
+    square = os.path.join(region_dir, 'square.reg')
+    if os.path.exists(square):
+        inputs.append(square)
+    outputs = [os.path.join(abs_path(info['map_file_dir']), 'scaled_broad_flux_final.fits'),
+               os.path.join(region_dir, 'broad_src_0.5-7.reg')]
+    return inputs, outputs
+
+
+def _contbin_io(info):
+    inputs = [os.path.join(abs_path(info['map_file_dir']), 'scaled_broad_flux_final.fits')]
+    return inputs, [os.path.join(_contbin_dir(info), 'contbin_binmap.fits'),
+                    os.path.join(_contbin_dir(info), 'outreg')]
+
+
+def _regions_io(info):
+    inputs = [os.path.join(abs_path(info['merge_dir']), 'scaled_broad_flux_final.fits'),
+              os.path.join(_contbin_dir(info), 'outreg')]
+    return inputs, [os.path.join(_contbin_dir(info), 'outreg', 'sex')]
+
+
+def _spectra_io(info):
+    inputs = [os.path.join(_contbin_dir(info), 'outreg', 'sex')]
+    for obs_id, d in _obs_dirs(info):
+        inputs += [os.path.join(d, f'acisf{obs_id}_clean_evt.fits'),
+                   os.path.join(d, f'{obs_id}_background_clean.evt')]
+    return inputs, [os.path.join(_contbin_dir(info), 'spectra')]
+
+
+def _fit_io(info):
+    return [os.path.join(_contbin_dir(info), 'spectra')], [os.path.join(_contbin_dir(info), 'fit_results.fits')]
+
+
+def _maps_io(info):
+    inputs = [os.path.join(_contbin_dir(info), 'contbin_binmap.fits'),
+              os.path.join(_contbin_dir(info), 'fit_results.fits')]
+    maps = f"parameter_maps_sn{info['sn_per_region']}_smooth{info['reg_smoothness']}.fits"
+    return inputs, [os.path.join(abs_path(info['map_file_dir']), maps)]
+
+
+# name: (generator, generated script or None, upstream nodes, io function, params, flag, job_runner stage)
+NODES = {
+    'reprocess': ('step2_repro.py', 'preprocess_data.sh', [], _reprocess_io,
+                  ['obs_ids'], 'reprocessed', 'repro'),
+    'deflare': ('step3_primary_deflare.py', 'deflare_point_sources.sh', ['reprocess'], _deflare_io,
+                ['obs_ids'], 'flare_filtered', 'deflare'),
+    'merge': ('step4_merge_data.py', 'merge_data.sh', ['deflare'], _merge_io,
+              ['obs_ids', 'merge_dir'], 'merge_data', None),
+    'flux': ('step5_merge_data_flux.py', None, ['merge'], _flux_io,
+             ['merge_dir'], 'flux_maps', None),
+    'crop': ('step6_crop_and_nopointsource.py', 'crop_data.sh', ['flux'], _crop_io,
+             ['merge_dir', 'region_file_dir', 'map_file_dir'], 'remove_point_source', None),
+    'contbin': ('step7_countour_bin.py', 'contour_binning.sh', ['crop'], _contbin_io,
+                ['sn_per_region', 'reg_smoothness', 'spec_file_dir'], 'contour_binning', None),
+    'regions': ('step8_regCoordChange.py', 'regCoordChange.sh', ['contbin'], _regions_io,
+                ['sn_per_region', 'reg_smoothness', 'merge_dir'], 'convert_region_coordinates', None),
+    'spectra': ('step9_pre_fitting.py', None, ['regions'], _spectra_io,
+                ['sn_per_region', 'reg_smoothness', 'obs_ids'], 'extract_spectra', None),
+    'fit': ('xspec_fit.py', None, ['spectra'], _fit_io,
+            ['nh', 'redshift', 'abundance_table', 'fit_band'], 'xspec_fitting', None),
+    'maps': ('make_maps.py', None, ['fit'], _maps_io,
+             ['map_file_dir'], 'maps_created', None),
+}
+# generators that take --workers for their own process pools
+WORKER_OPTION = {'spectra', 'fit'}
+ORDER = ['reprocess', 'deflare', 'merge', 'flux', 'crop', 'contbin', 'regions', 'spectra', 'fit', 'maps']
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(path, content=False):
+    """
+    Fingerprint of a file or directory: {'size', 'mtime'} and, when content is True, 'sha256'.
+    Directories are fingerprinted by their (sorted) file listing. Returns None if path is missing.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        entries = {}
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_file():
+                entries[entry.name] = fingerprint(entry.path, content)
+        h = hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+        return {'dir': h}
+    st = os.stat(path)
+    fp = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if content:
+        fp['sha256'] = _file_hash(path)
+    return fp
+
+
+def same_file(old, new, path, content=False):
+    """Compare a stored fingerprint with the current one, falling back to the content hash."""
+    if old is None or new is None:
+        return old == new
+    if 'dir' in old or 'dir' in new:
+        return old.get('dir') == new.get('dir')
+    if old['size'] != new['size']:
+        return False
+    if old['mtime'] == new['mtime']:
+        return True
+    if content and 'sha256' in old:
+        return old['sha256'] == (new.get('sha256') or _file_hash(path))
+    return False
+
+
+def legacy_state_path(config):
+    return os.path.join(abs_path(config['info_dict']['script_dir']), 'pipeline_state.json')
+
+
+def load_state(config):
+    """{node: fingerprint record} from the state store (imported from pipeline_state.json the first time)."""
+    state = state_store.load_fingerprints()
+    legacy = legacy_state_path(config)
+    if not state and os.path.exists(legacy):
+        with open(legacy, 'r') as f:
+            state = json.load(f)
+        for name, node_record in state.items():
+            state_store.save_fingerprints(name, node_record)
+    return state
+
+
+def save_state(state, name):
+    """Store the record of one node (a transaction of its own, so parallel runs don't clobber each other)."""
+    state_store.save_fingerprints(name, state[name])
+
+
+def node_params(config, name):
+    info = config['info_dict']
+    return {key: info.get(key) for key in NODES[name][4]}
+
+
+def why_stale(config, state, name, content=False):
+    """Reason the node must run, or None if it is up to date with its inputs and params."""
+    info = config['info_dict']
+    inputs, outputs = NODES[name][3](info)
+    record = state.get(name)
+    if record is None:
+        return 'never run'
+    if record['params'] != node_params(config, name):
+        return 'parameters changed'
+    missing = [path for path in outputs if not os.path.exists(path)]
+    if missing:
+        return f'missing output {missing[0]}'
+    if sorted(record['inputs']) != sorted(inputs):
+        return 'input list changed'
+    for path in inputs:
+        if not same_file(record['inputs'][path], fingerprint(path), path, content):
+            return f'input changed: {path}'
+    return None
+
+
+def plan(config, state, content=False, force=()):
+    """Ordered list of (node, reason) to run: stale nodes plus everything downstream."""
+    to_run = {}
+    for name in ORDER:
+        upstream = [up for up in NODES[name][2] if up in to_run]
+        if name in force:
+            to_run[name] = 'forced'
+        elif upstream:
+            to_run[name] = f'upstream {upstream[0]} reruns'
+        else:
+            reason = why_stale(config, state, name, content)
+            if reason:
+                to_run[name] = reason
+    return [(name, to_run[name]) for name in ORDER if name in to_run]
+
+
+def record(config, state, name, content=False):
+    inputs, outputs = NODES[name][3](config['info_dict'])
+    state[name] = {
+        'params': node_params(config, name),
+        'inputs': {path: fingerprint(path, content) for path in inputs},
+        'outputs': {path: fingerprint(path) for path in outputs},
+    }
+
+
+def missing_input(config, name):
+    """First declared input of the node that does not exist, or None."""
+    inputs, _ = NODES[name][3](config['info_dict'])
+    return next((path for path in inputs if not os.path.exists(path)), None)
+
+
+def run_node(config, name, workers=None):
+    """Regenerate the step's script and run it. Returns the exit code."""
+    import subprocess
+
+    generator, script, _, _, _, _, runner_stage = NODES[name]
+    missing = missing_input(config, name)
+    if missing:
+        print(f'{name}: missing input {missing}')
+        return 1
+    if runner_stage and workers:
+        return subprocess.call([sys.executable, os.path.join(REPO_DIR, 'job_runner.py'),
+                                runner_stage, '--workers', str(workers)])
+    options = ['--workers', str(workers)] if workers and name in WORKER_OPTION else []
+    code = subprocess.call([sys.executable, os.path.join(REPO_DIR, generator)] + options)
+    if code != 0 or script is None:
+        return code
+    return subprocess.call(['bash', os.path.join(abs_path(config['info_dict']['script_dir']), script)])
+
+
+def build_parser(description, commands=('status', 'run')):
+    """Command-line options shared by this runner and the long-lived driver (pipeline.py)."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('command', choices=list(commands))
+    parser.add_argument('--hash', action='store_true',
+                        help='compare content hashes when size/mtime differ')
+    parser.add_argument('--dry-run', action='store_true', help='print the plan without running it')
+    parser.add_argument('--force', action='append', default=[], choices=ORDER,
+                        help='rerun this node (and its downstream nodes) regardless of fingerprints')
+    parser.add_argument('--until', choices=ORDER, help='stop after this node')
+    parser.add_argument('--only', choices=ORDER,
+                        help='run just this node, stale or not (the caller has decided, as batch.py does)')
+    parser.add_argument('--json', action='store_true', help='status: print the plan as JSON')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='run per-obs stages through job_runner.py (and the spectra/fit pools) '
+                             'with this many workers')
+    return parser
+
+
+def print_status(steps, as_json=False):
+    if as_json:
+        print(json.dumps([{'node': name, 'reason': reason} for name, reason in steps]))
+        return
+    stale = dict(steps)
+    for name in ORDER:
+        print(f'{name:10s} {"stale: " + stale[name] if name in stale else "up to date"}')
+
+
+def select(steps, only=None, until=None):
+    """The planned steps restricted by --only and --until."""
+    if only:
+        steps = [(only, dict(steps).get(only, 'requested'))]
+    if until:
+        steps = [step for step in steps if ORDER.index(step[0]) <= ORDER.index(until)]
+    return steps
+
+
+def execute(config, state, steps, content=False, workers=None, dry_run=False, runner=run_node):
+    """
+    Run the steps in order with runner(config, name, workers), recording each success.
+    Stops at the first failure; returns its exit code (0 when every step ran).
+    """
+    if not steps:
+        print('Everything is up to date')
+        return 0
+    for name, reason in steps:
+        print(f'{name}: {reason}')
+        if dry_run:
+            continue
+        state_store.mark(name, 'running', message=reason)
+        code = runner(config, name, workers)
+        if code != 0:
+            state_store.mark(name, 'failed', message=f'exit code {code}')
+            print(f'{name} failed with exit code {code}; downstream steps not run')
+            return code
+        record(config, state, name, content)
+        save_state(state, name)
+        state_store.mark(name, 'done')
+        set_flag(NODES[name][5])
+    return 0
+
+
+def main():
+    args = build_parser('Rerun only the pipeline steps whose inputs changed.').parse_args()
+
+    config = load_config()
+    state = load_state(config)
+    steps = plan(config, state, args.hash, args.force)
+    if args.command == 'status':
+        print_status(steps, args.json)
+        return
+    code = execute(config, state, select(steps, args.only, args.until), args.hash, args.workers, args.dry_run)
+    if code != 0:
+        sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
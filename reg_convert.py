@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+'''
+Convert the contour-bin region files from physical pixels to WCS
+(sexagesimal) without Xvfb, ds9 or XPA.
+
+The WCS of scaled_broad_flux_final.fits is loaded once, every vertex of every
+outreg/xaf_N.reg is converted in a single vectorized pixel -> world call, and
+the outreg/sex/xaf_N.reg files are written in parallel.  The output follows
+what ds9 writes for "regions format ciao / system wcs / skyformat
+sexagesimal": a CIAO header line and hh:mm:ss.ssss / +dd:mm:ss.sss vertices.
+
+Usage:
+    python3 reg_convert.py scaled_broad_flux_final.fits outreg_dir [--workers N]
+'''
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import numpy as np
+
+import regions
+
+HEADER = '# Region file format: CIAO version 1.0\n'
+RA_DECIMALS = 4
+DEC_DECIMALS = 3
+
+_shape_re = re.compile(r'^\s*([+\-!]?)\s*(\w+)\s*\((.*)\)')
+
+
+def _sexagesimal(values, decimals, signed, wrap=None):
+    """Format degrees (or hours) as [+-]dd:mm:ss.sss with carry-safe rounding."""
+    values = np.asarray(values, dtype=float)
+    scale = 10 ** decimals
+    total = np.round(np.abs(values) * 3600 * scale).astype(np.int64)
+    if wrap:
+        total %= wrap * 3600 * scale
+    whole, frac = np.divmod(total, scale)
+    d, rest = np.divmod(whole, 3600)
+    m, sec = np.divmod(rest, 60)
+    out = []
+    for v, dd, mm, ss, ff in zip(values, d, m, sec, frac):
+        sign = ('-' if v < 0 else '+') if signed else ''
+        out.append(f'{sign}{dd:02d}:{mm:02d}:{ss:02d}.{ff:0{decimals}d}')
+    return out
+
+
+def format_ra(ra_deg):
+    return _sexagesimal(np.mod(ra_deg, 360.0) / 15.0, RA_DECIMALS, signed=False, wrap=24)
+
+
+def format_dec(dec_deg):
+    return _sexagesimal(dec_deg, DEC_DECIMALS, signed=True)
+
+
+def read_shapes(path):
+    """(sign, shape, [x1, y1, x2, y2, ...]) for every shape line of a physical region file."""
+    shapes = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            match = _shape_re.match(line)
+            if not match:
+                continue
+            sign, name, args = match.groups()
+            shapes.append((sign, name.lower(), [float(v) for v in args.split(',') if v.strip()]))
+    return shapes
+
+
+def convert_files(image, reg_files, out_dir, workers=None):
+    """Convert physical-coordinate polygon region files into out_dir. Returns the written paths."""
+    from astropy.io import fits
+
+    wcs = regions.physical_wcs(fits.getheader(image))
+    parsed = [read_shapes(path) for path in reg_files]
+
+    xs, ys = [], []
+    for shapes in parsed:
+        for _, name, params in shapes:
+            if name != 'polygon':
+                raise ValueError(f'Only polygon regions are converted, got {name}')
+            xs.append(params[0::2])
+            ys.append(params[1::2])
+    if xs:
+        ra, dec = wcs.all_pix2world(np.concatenate(xs), np.concatenate(ys), 1)
+        ra_str, dec_str = format_ra(ra), format_dec(dec)
+    else:
+        ra_str, dec_str = [], []
+
+    texts = []
+    k = 0
+    for shapes in parsed:
+        lines = [HEADER]
+        for sign, name, params in shapes:
+            n = len(params) // 2
+            coords = ','.join(f'{ra_str[k + v]},{dec_str[k + v]}' for v in range(n))
+            k += n
+            lines.append(f"{'-' if sign in ('-', '!') else ''}{name}({coords})\n")
+        texts.append(''.join(lines))
+
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = [os.path.join(out_dir, os.path.basename(path)) for path in reg_files]
+
+    def write(item):
+        path, text = item
+        with open(path, 'w') as f:
+            f.write(text)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(write, zip(outputs, texts)))
+    return outputs
+
+
+def region_files(out_reg_dir):
+    """xaf_N.reg files in bin order."""
+    files = glob(os.path.join(out_reg_dir, 'xaf_*.reg'))
+    return sorted(files, key=lambda p: int(re.search(r'xaf_(\d+)\.reg$', p).group(1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert contour-bin regions to WCS without ds9.')
+    parser.add_argument('image', help='image whose WCS defines the conversion (scaled_broad_flux_final.fits)')
+    parser.add_argument('out_reg_dir', help='directory holding xaf_N.reg; results go to its sex/ subdirectory')
+    parser.add_argument('--workers', type=int, default=None, help='threads used to write the files')
+    args = parser.parse_args()
+
+    files = region_files(args.out_reg_dir)
+    outputs = convert_files(args.image, files, os.path.join(args.out_reg_dir, 'sex'), args.workers)
+    print(f'Converted {len(outputs)} region files')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+'''
+CIAO/ds9 region files in Python.
+
+Parses the region files the pipeline uses (wavdetect ellipses, hand made
+circles/boxes/polygons in physical or WCS coordinates) and tests event
+positions or image pixels against them with vectorized NumPy geometry, so a
+region filter does not need a dmcopy pass over the data.
+
+Region semantics follow CIAO: the region is the union of the included shapes
+minus every excluded shape ("-shape" or "!shape").  A file with only excluded
+shapes means "everything except them".
+
+Image masks are rasterized shape by shape inside each shape's bounding box,
+so thousands of wavdetect ellipses cost O(total area) rather than
+O(N shapes x image pixels).  Masks can be cached on disk, keyed by the region
+file content and the image geometry.
+
+Usage (step6, replaces the dmcopy region filters on the merged images):
+    python3 regions.py crop infile outfile [--exclude reg] [--include reg] [--cache-dir dir]
+'''
+import argparse
+import hashlib
+import os
+import re
+
+import numpy as np
+
+WORLD_SYSTEMS = {'fk5', 'icrs', 'j2000', 'fk4', 'b1950'}
+SKIP_SYSTEMS = {'physical', 'image', 'linear'}
+SHAPES = {'circle', 'ellipse', 'box', 'rotbox', 'polygon', 'annulus'}
+
+_shape_re = re.compile(r'^\s*([+\-!]?)\s*(\w+)\s*\((.*)\)')
+
+
+def _parse_length(token, world):
+    """Length in degrees for world shapes (arcsec " / arcmin ' / deg d), else pixels."""
+    token = token.strip()
+    if token.endswith('"'):
+        return float(token[:-1]) / 3600.0
+    if token.endswith("'"):
+        return float(token[:-1]) / 60.0
+    if token.endswith('d') and world:
+        return float(token[:-1])
+    return float(token)
+
+
+def _parse_coord(token, is_ra):
+    """Coordinate token: sexagesimal (hh:mm:ss / dd:mm:ss), decimal degrees or pixels."""
+    token = token.strip().rstrip('d')
+    if ':' not in token:
+        return float(token)
+    sign = -1.0 if token.startswith('-') else 1.0
+    parts = [abs(float(p)) for p in token.lstrip('+-').split(':')]
+    value = parts[0] + parts[1] / 60.0 + (parts[2] / 3600.0 if len(parts) > 2 else 0.0)
+    return sign * value * (15.0 if is_ra else 1.0)
+
+
+def parse_region_string(text):
+    """
+    Parse region text into a list of shapes.
+    Each shape is a dict: {'shape', 'exclude', 'world', 'params'}.
+    For world shapes centres are in degrees and lengths in degrees;
+    for physical shapes everything is in physical (sky) pixels.
+    """
+    shapes = []
+    system_world = False
+    for raw in text.splitlines():
+        line = raw.split('#', 1)[0].strip()
+        if not line or line.startswith('global'):
+            continue
+        for part in line.split(';'):
+            part = part.strip()
+            if not part:
+                continue
+            if part.lower() in WORLD_SYSTEMS:
+                system_world = True
+                continue
+            if part.lower() in SKIP_SYSTEMS:
+                system_world = False
+                continue
+            match = _shape_re.match(part)
+            if not match:
+                continue
+            sign, name, args = match.groups()
+            name = name.lower()
+            if name not in SHAPES:
+                raise ValueError(f'Unsupported region shape: {name}')
+            tokens = [t for t in args.split(',') if t.strip()]
+            world = system_world or any(':' in t for t in tokens[:2])
+            if name == 'polygon':
+                params = [_parse_coord(t, is_ra=(i % 2 == 0) and world) for i, t in enumerate(tokens)]
+            else:
+                params = [_parse_coord(tokens[0], is_ra=world), _parse_coord(tokens[1], is_ra=False)]
+                params += [_parse_length(t, world) for t in tokens[2:]]
+                if name in ('ellipse', 'box', 'rotbox') and len(tokens) >= 5:
+                    # rotation angle is never a length
+                    params[-1] = float(tokens[-1])
+            shapes.append({'shape': 'box' if name == 'rotbox' else name,
+                           'exclude': sign in ('-', '!'),
+                           'world': world,
+                           'params': params})
+    return shapes
+
+
+def parse_region_file(path):
+    """Parse a CIAO or ds9 region file."""
+    with open(path, 'r') as f:
+        return parse_region_string(f.read())
+
+
+def event_wcs(header, xcol='x', ycol='y'):
+    """astropy WCS mapping the sky x/y columns of an event table to world coordinates."""
+    from astropy.wcs import WCS
+    idx = {}
+    for key, value in header.items():
+        if key.startswith('TTYPE') and str(value).strip().lower() in (xcol, ycol):
+            idx[str(value).strip().lower()] = key[5:]
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = [header[f'TCTYP{idx[xcol]}'], header[f'TCTYP{idx[ycol]}']]
+    wcs.wcs.crval = [header[f'TCRVL{idx[xcol]}'], header[f'TCRVL{idx[ycol]}']]
+    wcs.wcs.crpix = [header[f'TCRPX{idx[xcol]}'], header[f'TCRPX{idx[ycol]}']]
+    wcs.wcs.cdelt = [header[f'TCDLT{idx[xcol]}'], header[f'TCDLT{idx[ycol]}']]
+    return wcs
+
+
+def to_physical(shapes, wcs):
+    """
+    Convert world shapes to physical pixel shapes using `wcs` (physical pixel -> world).
+    Assumes north-up sky pixels, as for Chandra sky coordinates, so angles carry over.
+    """
+    scale = np.sqrt(abs(np.linalg.det(wcs.pixel_scale_matrix)))
+    out = []
+    for shape in shapes:
+        if not shape['world']:
+            out.append(shape)
+            continue
+        p = list(shape['params'])
+        if shape['shape'] == 'polygon':
+            ra, dec = np.array(p[0::2]), np.array(p[1::2])
+            x, y = wcs.all_world2pix(ra, dec, 1)
+            params = list(np.ravel(np.column_stack([x, y])))
+        else:
+            x, y = wcs.all_world2pix([p[0]], [p[1]], 1)
+            n_len = {'circle': 1, 'annulus': len(p) - 2, 'ellipse': 2, 'box': 2}[shape['shape']]
+            lengths = [v / scale for v in p[2:2 + n_len]]
+            params = [float(x[0]), float(y[0])] + lengths + p[2 + n_len:]
+        out.append(dict(shape, world=False, params=params))
+    return out
+
+
+def _inside(shape, x, y):
+    p = shape['params']
+    name = shape['shape']
+    if name == 'polygon':
+        px, py = np.array(p[0::2]), np.array(p[1::2])
+        inside = np.zeros(np.shape(x), dtype=bool)
+        j = len(px) - 1
+        for i in range(len(px)):
+            # even-odd rule, one vectorized test per edge
+            crosses = (py[i] > y) != (py[j] > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xint = (px[j] - px[i]) * (y - py[i]) / (py[j] - py[i]) + px[i]
+            inside ^= crosses & (x < xint)
+            j = i
+        return inside
+    dx, dy = x - p[0], y - p[1]
+    if name == 'circle':
+        return dx * dx + dy * dy <= p[2] * p[2]
+    if name == 'annulus':
+        r2 = dx * dx + dy * dy
+        return (r2 >= p[2] * p[2]) & (r2 <= p[-1] * p[-1])
+    theta = np.deg2rad(p[4] if len(p) > 4 else 0.0)
+    u = dx * np.cos(theta) + dy * np.sin(theta)
+    v = -dx * np.sin(theta) + dy * np.cos(theta)
+    if name == 'ellipse':
+        return (u / p[2]) ** 2 + (v / p[3]) ** 2 <= 1.0
+    if name == 'box':
+        return (np.abs(u) <= p[2] / 2.0) & (np.abs(v) <= p[3] / 2.0)
+    raise ValueError(f'Unsupported region shape: {name}')
+
+
+def bounding_box(shape):
+    """(xmin, xmax, ymin, ymax) of a physical shape."""
+    p = shape['params']
+    if shape['shape'] == 'polygon':
+        return min(p[0::2]), max(p[0::2]), min(p[1::2]), max(p[1::2])
+    if shape['shape'] in ('box', 'ellipse'):
+        theta = np.deg2rad(p[4] if len(p) > 4 else 0.0)
+        c, s = abs(np.cos(theta)), abs(np.sin(theta))
+        if shape['shape'] == 'box':
+            rx = 0.5 * (p[2] * c + p[3] * s)
+            ry = 0.5 * (p[2] * s + p[3] * c)
+        else:
+            rx = np.hypot(p[2] * c, p[3] * s)
+            ry = np.hypot(p[2] * s, p[3] * c)
+        return p[0] - rx, p[0] + rx, p[1] - ry, p[1] + ry
+    r = p[-1]
+    return p[0] - r, p[0] + r, p[1] - r, p[1] + r
+
+
+def _in_bbox(shape, x, y):
+    xmin, xmax, ymin, ymax = bounding_box(shape)
+    return np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+
+
+def contains(shapes, x, y):
+    """Boolean array: which (x, y) physical positions are inside the region."""
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    include = [s for s in shapes if not s['exclude']]
+    exclude = [s for s in shapes if s['exclude']]
+    inside = np.zeros(x.shape, dtype=bool) if include else np.ones(x.shape, dtype=bool)
+    for shape in include:
+        sel = _in_bbox(shape, x, y)
+        inside[sel] |= _inside(shape, x[sel], y[sel])
+    for shape in exclude:
+        sel = _in_bbox(shape, x, y)
+        inside[sel] &= ~_inside(shape, x[sel], y[sel])
+    return inside
+
+
+def physical_transform(header):
+    """(LTM1_1, LTM2_2, LTV1, LTV2): image = LTM * physical + LTV."""
+    return (header.get('LTM1_1', 1.0), header.get('LTM2_2', 1.0),
+            header.get('LTV1', 0.0), header.get('LTV2', 0.0))
+
+
+def physical_to_image(header, x, y):
+    ltm1, ltm2, ltv1, ltv2 = physical_transform(header)
+    return np.asarray(x) * ltm1 + ltv1, np.asarray(y) * ltm2 + ltv2
+
+
+def image_to_physical(header, i, j):
+    ltm1, ltm2, ltv1, ltv2 = physical_transform(header)
+    return (np.asarray(i) - ltv1) / ltm1, (np.asarray(j) - ltv2) / ltm2
+
+
+def physical_wcs(header):
+    """astropy WCS mapping the physical (sky) pixels of an image to world coordinates."""
+    from astropy.wcs import WCS
+    ltm1, ltm2, ltv1, ltv2 = physical_transform(header)
+    wcs = WCS(header, naxis=2).deepcopy()
+    wcs.wcs.crpix = [(wcs.wcs.crpix[0] - ltv1) / ltm1, (wcs.wcs.crpix[1] - ltv2) / ltm2]
+    if wcs.wcs.has_cd():
+        wcs.wcs.cd = wcs.wcs.cd * np.array([[ltm1, ltm2], [ltm1, ltm2]])
+    else:
+        wcs.wcs.cdelt = [wcs.wcs.cdelt[0] * ltm1, wcs.wcs.cdelt[1] * ltm2]
+    return wcs
+
+
+def _image_bbox(shape, header, ny, nx):
+    """Index ranges (j0, j1, i0, i1) of the image pixels a physical shape can touch."""
+    xmin, xmax, ymin, ymax = bounding_box(shape)
+    i_lo, j_lo = physical_to_image(header, xmin, ymin)
+    i_hi, j_hi = physical_to_image(header, xmax, ymax)
+    i_lo, i_hi = sorted((float(i_lo), float(i_hi)))
+    j_lo, j_hi = sorted((float(j_lo), float(j_hi)))
+    # image pixel k (1-based) has its centre at k and lives at array index k-1
+    i0, i1 = max(int(np.floor(i_lo)) - 1, 0), min(int(np.ceil(i_hi)), nx)
+    j0, j1 = max(int(np.floor(j_lo)) - 1, 0), min(int(np.ceil(j_hi)), ny)
+    return j0, j1, i0, i1
+
+
+def _rasterize(shape, header, out):
+    ny, nx = out.shape
+    j0, j1, i0, i1 = _image_bbox(shape, header, ny, nx)
+    if j1 <= j0 or i1 <= i0:
+        return
+    jj, ii = np.mgrid[j0 + 1:j1 + 1, i0 + 1:i1 + 1]
+    x, y = image_to_physical(header, ii, jj)
+    out[j0:j1, i0:i1] |= _inside(shape, x, y)
+
+
+def mask(shapes, shape, header):
+    """
+    Boolean image mask (True inside the region) for an image of `shape` (ny, nx).
+    Shapes must be physical (see to_physical); pixels are tested at their centres.
+    """
+    include = [s for s in shapes if not s['exclude']]
+    exclude = [s for s in shapes if s['exclude']]
+    inside = np.zeros(shape, dtype=bool)
+    for s in include:
+        _rasterize(s, header, inside)
+    if not include:
+        inside[:] = True
+    if exclude:
+        excluded = np.zeros(shape, dtype=bool)
+        for s in exclude:
+            _rasterize(s, header, excluded)
+        inside &= ~excluded
+    return inside
+
+
+def region_mask(path, shape, header, cache_dir=None):
+    """
+    Mask of a region file on an image, cached in cache_dir when given.
+    The cache key covers the region file content and the image geometry.
+    """
+    geometry = [shape] + [header.get(k) for k in ('LTM1_1', 'LTM2_2', 'LTV1', 'LTV2',
+                                                   'CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2',
+                                                   'CDELT1', 'CDELT2', 'CD1_1', 'CD2_2')]
+    cache_file = None
+    if cache_dir:
+        with open(path, 'rb') as f:
+            key = hashlib.sha256(f.read() + repr(geometry).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f'{key}.npy')
+        if os.path.exists(cache_file):
+            return np.unpackbits(np.load(cache_file), count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+    shapes = to_physical(parse_region_file(path), physical_wcs(header))
+    result = mask(shapes, shape, header)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, np.packbits(result))
+    return result
+
+
+def format_region(shapes):
+    """CIAO region string (physical coordinates) for data subspace keywords."""
+    parts = []
+    for s in shapes:
+        values = ','.join(f'{v:.10g}' for v in s['params'])
+        parts.append(f"{'!' if s['exclude'] else ''}{s['shape']}({values})")
+    return '&'.join(parts)
+
+
+def crop_header(header, i0, j0, nx, ny):
+    """Header of the sub-image starting at array index (j0, i0), with WCS and physical keys shifted."""
+    header = header.copy()
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    for key, offset in (('CRPIX1', i0), ('CRPIX2', j0), ('CRPIX1P', i0), ('CRPIX2P', j0),
+                        ('LTV1', i0), ('LTV2', j0)):
+        if key in header:
+            header[key] = header[key] - offset
+        elif key.startswith('LTV'):
+            header[key] = -float(offset)
+    return header
+
+
+def crop_and_exclude(infile, outfile, exclude=None, include=None, cache_dir=None):
+    """
+    One in-memory pass equivalent to
+
+        dmcopy "infile[exclude sky=region(exclude)]" tmp
+        dmcopy "tmp[sky=region(include)]" outfile
+
+    Pixels inside `exclude` and outside `include` are set to 0, the image is cropped to the
+    bounding box of `include`, and DSTYP1/DSVAL1 describe the region, as dmcopy writes them.
+    """
+    from astropy.io import fits
+
+    with fits.open(infile, memmap=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        ny, nx = data.shape
+        wcs = physical_wcs(header)
+
+        keep = np.ones((ny, nx), dtype=bool)
+        shapes = []
+        if include:
+            inc = to_physical(parse_region_file(include), wcs)
+            keep &= region_mask(include, (ny, nx), header, cache_dir)
+            shapes += inc
+        if exclude:
+            exc = to_physical(parse_region_file(exclude), wcs)
+            keep &= ~region_mask(exclude, (ny, nx), header, cache_dir)
+            shapes += [dict(s, exclude=not s['exclude']) for s in exc]
+
+        j0, j1, i0, i1 = 0, ny, 0, nx
+        if include:
+            boxes = [_image_bbox(s, header, ny, nx) for s in inc if not s['exclude']]
+            if boxes:
+                j0, j1 = min(b[0] for b in boxes), max(b[1] for b in boxes)
+                i0, i1 = min(b[2] for b in boxes), max(b[3] for b in boxes)
+
+        out = np.where(keep[j0:j1, i0:i1], data[j0:j1, i0:i1], 0).astype(data.dtype, copy=False)
+        out_header = crop_header(header, i0, j0, i1 - i0, j1 - j0)
+
+    if shapes:
+        region = format_region(shapes)
+        if not include:
+            region = f'field()&{region}'
+        out_header['DSTYP1'] = 'sky'
+        out_header['DSVAL1'] = region
+        out_header['DSFORM1'] = 'DD'
+        out_header['DSUNIT1'] = 'physical'
+    fits.writeto(outfile, out, out_header, overwrite=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Region filtering of images without dmcopy.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    crop = sub.add_parser('crop', help='exclude and/or crop an image with region files')
+    crop.add_argument('infile')
+    crop.add_argument('outfile')
+    crop.add_argument('--exclude', help='region whose pixels are set to 0')
+    crop.add_argument('--include', help='region to keep; the image is cropped to its bounding box')
+    crop.add_argument('--cache-dir', help='directory for cached region masks')
+    args = parser.parse_args()
+
+    if args.command == 'crop':
+        crop_and_exclude(args.infile, args.outfile, args.exclude, args.include, args.cache_dir)
+        print(f'Wrote {args.outfile}')
+
+
+if __name__ == '__main__':
+    main()
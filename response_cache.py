@@ -0,0 +1,241 @@
+'''
+Shared ARF/RMF responses for neighbouring contour bins.
+
+Hundreds of small contour bins on the same chips get nearly identical
+responses, so instead of one weighted specextract per (bin, obs_id) the sky is
+cut into a coarse grid of cells (in the physical frame of the merged image).
+One response is made per (obs_id, cell) and cached; each bin then gets its
+ARF/RMF as the average of the cells it covers, weighted by the counts of the
+merged broad_thresh.img inside the bin.
+
+Cell responses are made with specextract at the cell centre (weight=no,
+refcoord) and cached under
+
+    {cache_dir}/{caldb_version}/{obs_id}/{inputs}/cell{size}_{cx}_{cy}.arf/.rmf
+
+so the cache is keyed by obs_id, grid cell and calibration version, and by
+{inputs}, a hash of the size and mtime of the observation's event, bad-pixel
+and aspect files: a reprocessed observation gets new cell responses.  When the
+cell ARFs under a bin differ from their weighted mean by more than the
+tolerance, the bin falls back to an exact per-bin specextract.  The bins are
+combined in a process pool, in chunks of COMBINE_CHUNK pairs of the same
+observation.
+
+Config keys (info_dict, all optional):
+    exact_responses      true to skip the grid and run specextract per bin (default false)
+    response_cell_size   cell size in physical pixels (default 64)
+    response_tolerance   maximum relative ARF deviation within a bin (default 0.05)
+'''
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import regions
+from helpers import abs_path
+
+CELL_SIZE = 64
+TOLERANCE = 0.05
+# (bin, obs_id) pairs combined per pool task
+COMBINE_CHUNK = 32
+
+# structural keywords that from_columns writes itself
+_TABLE_KEYS = ('XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'TFIELDS', 'TTYPE', 'TFORM',
+               'TUNIT', 'TDIM', 'TNULL', 'TSCAL', 'TZERO', 'THEAP', 'EXTNAME', 'COMMENT', 'HISTORY')
+
+
+def caldb_version():
+    """CALDB version string, from $CALDB when available."""
+    caldb = os.environ.get('CALDB')
+    if caldb:
+        path = os.path.join(caldb, 'docs', 'chandra', 'caldb_version', 'caldb_version.fits')
+        try:
+            from astropy.io import fits
+            with fits.open(path) as hdul:
+                return str(hdul[1].data['CALDB_VER'][-1]).strip()
+        except (OSError, KeyError, IndexError):
+            pass
+    return os.environ.get('CALDB_VERSION', 'unknown')
+
+
+def settings(config):
+    info = config['info_dict']
+    return (bool(info.get('exact_responses', False)),
+            int(info.get('response_cell_size', CELL_SIZE)),
+            float(info.get('response_tolerance', TOLERANCE)))
+
+
+def cache_dir(config):
+    return os.path.join(abs_path(config['info_dict']['spec_file_dir']), 'response_cache')
+
+
+def bin_cell_weights(binmap_path, thresh_path, cell_size=CELL_SIZE):
+    """
+    For every bin, the grid cells it covers and their weights (merged counts inside bin and cell).
+    Returns {bin: (cells (k, 2) int array, weights (k,) array)}.
+    """
+    from astropy.io import fits
+
+    with fits.open(binmap_path) as hdul:
+        bh = hdul[0].header
+        binmap = hdul[0].data.astype(np.int64)
+    with fits.open(thresh_path, memmap=True) as hdul:
+        th = hdul[0].header
+        thresh = hdul[0].data
+
+        jj, ii = np.nonzero(binmap >= 0)
+        bins = binmap[jj, ii]
+        px, py = regions.image_to_physical(bh, ii + 1, jj + 1)
+        ti, tj = regions.physical_to_image(th, px, py)
+        ti = np.rint(ti).astype(np.int64) - 1
+        tj = np.rint(tj).astype(np.int64) - 1
+        ok = (ti >= 0) & (ti < thresh.shape[1]) & (tj >= 0) & (tj < thresh.shape[0])
+        weight = np.zeros(len(bins))
+        weight[ok] = thresh[tj[ok], ti[ok]]
+
+    cx = np.floor(px / cell_size).astype(np.int64)
+    cy = np.floor(py / cell_size).astype(np.int64)
+    keys, inverse = np.unique(np.stack([bins, cx, cy], axis=1), axis=0, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=weight, minlength=len(keys))
+    # bins without counts fall back to equal weights per pixel
+    npix = np.bincount(inverse.ravel(), minlength=len(keys))
+
+    out = {}
+    for b in np.unique(keys[:, 0]):
+        sel = keys[:, 0] == b
+        w = sums[sel] if sums[sel].sum() > 0 else npix[sel].astype(float)
+        out[int(b)] = (keys[sel, 1:], w)
+    return out
+
+
+def input_fingerprint(paths):
+    """Short hash of the path, size and mtime of the files an observation's cell responses are made from."""
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            stamps.append([os.path.abspath(path), None, None])
+    return hashlib.sha1(json.dumps(stamps).encode()).hexdigest()[:16]
+
+
+def cell_root(cache, calver, obs_id, inputs, cell, cell_size):
+    return os.path.join(cache, calver, str(obs_id), inputs, f'cell{cell_size}_{cell[0]}_{cell[1]}')
+
+
+def cell_commands(evt, bpix, cell, cell_size, wcs, outroot):
+    """specextract for the response at the centre of one grid cell."""
+    from reg_convert import format_ra, format_dec
+
+    x = (cell[0] + 0.5) * cell_size
+    y = (cell[1] + 0.5) * cell_size
+    ra, dec = wcs.all_pix2world([x], [y], 1)
+    side = cell_size * np.sqrt(abs(np.linalg.det(wcs.pixel_scale_matrix))) * 3600.0
+    ra_s, dec_s = format_ra(ra)[0], format_dec(dec)[0]
+    region = f'box({ra_s},{dec_s},{side:.3f}",{side:.3f}",0)'
+    return [
+        'punlearn ardlib',
+        f'acis_set_ardlib {bpix}',
+        'punlearn specextract',
+        f'specextract infile="{evt}[sky=region({region})]" outroot={outroot} bkgfile=none '
+        f'weight=no correctpsf=no refcoord="{ra_s} {dec_s}" grouptype=NONE binspec=NONE '
+        f'tmpdir=$ASCDS_WORK_PATH clobber=yes',
+    ]
+
+
+def have_cell(outroot):
+    return os.path.exists(outroot + '.arf') and os.path.exists(outroot + '.rmf')
+
+
+def read_arf(path):
+    from astropy.io import fits
+    with fits.open(path) as hdul:
+        return np.asarray(hdul['SPECRESP'].data['SPECRESP'], dtype=float)
+
+
+def read_rmf(path):
+    """Dense (n_energy, n_channel) response matrix and the channel offset of the file."""
+    from astropy.io import fits
+    with fits.open(path) as hdul:
+        matrix = hdul['MATRIX'].data
+        first = int(hdul['EBOUNDS'].data['CHANNEL'][0])
+        nchan = len(hdul['EBOUNDS'].data)
+        dense = np.zeros((len(matrix), nchan), dtype=np.float32)
+        for row, (ngrp, fchan, nch, values) in enumerate(zip(matrix['N_GRP'], matrix['F_CHAN'],
+                                                             matrix['N_CHAN'], matrix['MATRIX'])):
+            fchan = np.atleast_1d(fchan)
+            nch = np.atleast_1d(nch)
+            pos = 0
+            for g in range(int(ngrp)):
+                lo = int(fchan[g]) - first
+                dense[row, lo:lo + int(nch[g])] = values[pos:pos + int(nch[g])]
+                pos += int(nch[g])
+        return dense, first
+
+
+@functools.lru_cache(maxsize=64)
+def load_cell(outroot):
+    """(ARF, dense RMF, first channel) of a cached cell, kept for the next bins on the same cell."""
+    dense, first = read_rmf(outroot + '.rmf')
+    return read_arf(outroot + '.arf'), dense, first
+
+
+def write_arf(template, path, specresp):
+    from astropy.io import fits
+    with fits.open(template) as hdul:
+        hdul['SPECRESP'].data['SPECRESP'] = specresp
+        hdul.writeto(path, overwrite=True)
+
+
+def write_rmf(template, path, dense, first):
+    """Write a dense matrix as an RMF with one channel group per energy row."""
+    from astropy.io import fits
+    with fits.open(template) as hdul:
+        old = hdul['MATRIX']
+        nchan = dense.shape[1]
+        cols = [fits.Column(name='ENERG_LO', format='E', unit='keV', array=old.data['ENERG_LO']),
+                fits.Column(name='ENERG_HI', format='E', unit='keV', array=old.data['ENERG_HI']),
+                fits.Column(name='N_GRP', format='I', array=np.ones(len(dense), dtype=np.int16)),
+                fits.Column(name='F_CHAN', format='J', array=np.full(len(dense), first, dtype=np.int32)),
+                fits.Column(name='N_CHAN', format='J', array=np.full(len(dense), nchan, dtype=np.int32)),
+                fits.Column(name='MATRIX', format=f'{nchan}E', array=dense.astype(np.float32))]
+        matrix = fits.BinTableHDU.from_columns(cols, name='MATRIX')
+        for card in old.header.cards:
+            if card.keyword and not card.keyword.startswith(_TABLE_KEYS) and card.keyword not in matrix.header:
+                matrix.header.append(card)
+        hdul[hdul.index_of('MATRIX')] = matrix
+        hdul.writeto(path, overwrite=True)
+
+
+def combine(cell_roots, weights, outroot, tolerance=TOLERANCE):
+    """
+    Weighted ARF/RMF of a bin from its cells' responses, written to outroot.arf/.rmf.
+    Cells without a response (off chip for this observation) are dropped.
+    Returns False, writing nothing, when the cell ARFs deviate from their mean by more than tolerance.
+    """
+    pairs = [(root, w) for root, w in zip(cell_roots, weights) if w > 0 and have_cell(root)]
+    if not pairs:
+        return False
+    w = np.array([p[1] for p in pairs], dtype=float)
+    w /= w.sum()
+    cells = [load_cell(root) for root, _ in pairs]
+    arfs = np.array([c[0] for c in cells])
+    arf = (w[:, None] * arfs).sum(axis=0)
+    peak = arf.max()
+    if peak <= 0 or np.abs(arfs - arf).max() / peak > tolerance:
+        return False
+
+    dense = sum(weight * c[1] for weight, c in zip(w, cells))
+    first = cells[0][2]
+
+    write_arf(pairs[0][0] + '.arf', outroot + '.arf', arf)
+    write_rmf(pairs[0][0] + '.rmf', outroot + '.rmf', dense, first)
+    return True
+
+
+def combine_chunk(tasks, tolerance=TOLERANCE):
+    """combine() for a list of (cell_roots, weights, outroot); returns one bool per task."""
+    return [combine(roots, weights, outroot, tolerance) for roots, weights, outroot in tasks]
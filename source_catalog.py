@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+'''
+Master point-source catalog from the per-observation wavdetect lists.
+
+step3 runs wavdetect on every observation ({obs_id}_src_0.5-7.fits) and
+step6 runs it again on the merged image, so a bright AGN is detected once
+per observation plus once more, and every per-observation region file is
+checked by hand.  This script puts the per-observation lists on the merged
+image instead:
+
+  * every source's RA/Dec is converted to the physical pixels of the merged
+    image (broad_thresh.img), its ellipse axes from the observation's sky
+    pixels to the merged pixels (Chandra sky frames are north-up, so the
+    angle carries over, as in regions.to_physical);
+  * sources of all observations are cross-matched with a KD-tree
+    (spatial_index.py): detections within --match-arcsec of each other,
+    transitively, are one source;
+  * a matched source is placed at the significance-weighted mean position,
+    with the ellipse of its largest detection grown by the spread of the
+    detections, so it covers each of them.
+
+Sources inside the --exclude region (the cluster emission,
+src_0.5-7-nps-noem.reg) are dropped, as the merged-image detection runs on
+the image with that region removed.  The catalog (SRCLIST with N_DETECT and
+OBS_IDS per source) and a region file of its ellipses are written; the
+region file can replace step6's wavdetect output broad_src_0.5-7.reg.
+
+Usage:
+    python3 source_catalog.py IMAGE SRCLIST [SRCLIST ...] --regfile REG [--outfile CATALOG]
+                              [--match-arcsec 2] [--min-detections 1] [--exclude noem.reg]
+'''
+import argparse
+import os
+
+import numpy as np
+
+from regions import contains, event_wcs, parse_region_file, physical_wcs, to_physical
+from spatial_index import KDTree, friends_of_friends
+from tiled_wavdetect import write_region
+
+MATCH_ARCSEC = 2.0
+ACIS_PIXEL_ARCSEC = 0.492
+COLUMNS = ['RA', 'DEC', 'X', 'Y', 'R', 'ROTANG', 'SRC_SIGNIFICANCE', 'N_DETECT', 'OBS_IDS']
+
+
+def _pixel_arcsec(wcs):
+    return float(np.sqrt(abs(np.linalg.det(wcs.pixel_scale_matrix)))) * 3600.0
+
+
+def read_sources(path):
+    """{obs_id, ra, dec, r0, r1, angle, significance} of a wavdetect source list (axes in arcsec)."""
+    from astropy.io import fits
+
+    with fits.open(path) as hdul:
+        table = hdul['SRCLIST']
+        data = table.data
+        try:
+            scale = _pixel_arcsec(event_wcs(table.header, 'x', 'y'))
+        except KeyError:
+            scale = ACIS_PIXEL_ARCSEC
+        n = len(data) if data is not None else 0
+        r = np.asarray(data['R'], dtype=float).reshape(n, -1) if n else np.zeros((0, 2))
+        return {
+            'obs_id': os.path.basename(path).split('_')[0],
+            'ra': np.asarray(data['RA'], dtype=float) if n else np.zeros(0),
+            'dec': np.asarray(data['DEC'], dtype=float) if n else np.zeros(0),
+            'r0': r[:, 0] * scale,
+            'r1': r[:, -1] * scale,
+            'angle': np.asarray(data['ROTANG'], dtype=float) if n else np.zeros(0),
+            'significance': np.asarray(data['SRC_SIGNIFICANCE'], dtype=float) if n else np.zeros(0),
+        }
+
+
+def _empty_table():
+    from astropy.table import Column, Table
+
+    return Table([Column(name=name, length=0, dtype=dtype, shape=shape) for name, dtype, shape in
+                  zip(COLUMNS, [float] * 4 + [float, float, float, int, str], [()] * 4 + [(2,)] + [()] * 4)])
+
+
+def build_catalog(image, srclists, match_arcsec=MATCH_ARCSEC, min_detections=1, exclude=None):
+    """Cross-matched sources of srclists on the physical pixels of image, as an astropy Table."""
+    from astropy.io import fits
+    from astropy.table import Table
+
+    wcs = physical_wcs(fits.getheader(image))
+    scale = _pixel_arcsec(wcs)
+    lists = [read_sources(path) for path in srclists]
+    obs = np.concatenate([[s['obs_id']] * len(s['ra']) for s in lists] or [[]]).astype(str)
+    cat = {key: np.concatenate([s[key] for s in lists]) if lists else np.zeros(0)
+           for key in ('ra', 'dec', 'r0', 'r1', 'angle', 'significance')}
+    if not len(obs):
+        return _empty_table()
+
+    x, y = wcs.all_world2pix(cat['ra'], cat['dec'], 1)
+    xy = np.column_stack([x, y])
+    groups = friends_of_friends(xy, match_arcsec / scale, KDTree(xy))
+
+    rows = []
+    for g in range(groups.max() + 1):
+        members = np.flatnonzero(groups == g)
+        ids = sorted(set(obs[members]))
+        if len(ids) < min_detections:
+            continue
+        weight = np.maximum(cat['significance'][members], 1e-6)
+        cx, cy = np.average(x[members], weights=weight), np.average(y[members], weights=weight)
+        spread = float(np.max(np.hypot(x[members] - cx, y[members] - cy)))
+        largest = members[np.argmax(cat['r0'][members] * cat['r1'][members])]
+        r = [cat['r0'][largest] / scale + spread, cat['r1'][largest] / scale + spread]
+        ra, dec = wcs.all_pix2world([cx], [cy], 1)
+        rows.append((float(ra[0]), float(dec[0]), cx, cy, r, cat['angle'][largest],
+                     float(cat['significance'][members].max()), len(ids), ','.join(ids)))
+    table = Table(rows=rows, names=COLUMNS) if rows else _empty_table()
+
+    if exclude and len(table):
+        shapes = to_physical(parse_region_file(exclude), wcs)
+        # keep what lies outside the excluded region
+        inside = contains([dict(s, exclude=False) for s in shapes], np.asarray(table['X']), np.asarray(table['Y']))
+        table = table[~inside]
+    return table
+
+
+def write_catalog(table, path):
+    from astropy.io import fits
+
+    hdu = fits.table_to_hdu(table)
+    hdu.name = 'SRCLIST'
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-match per-observation source lists into one catalog.')
+    parser.add_argument('image', help='merged image defining the output pixels (broad_thresh.img)')
+    parser.add_argument('srclists', nargs='+', help='per-observation wavdetect lists ({obs_id}_src_0.5-7.fits)')
+    parser.add_argument('--regfile', required=True, help='output region file (physical ellipses)')
+    parser.add_argument('--outfile', default=None, help='output catalog (FITS)')
+    parser.add_argument('--match-arcsec', type=float, default=MATCH_ARCSEC,
+                        help='detections closer than this are the same source')
+    parser.add_argument('--min-detections', type=int, default=1,
+                        help='keep sources detected in at least this many observations')
+    parser.add_argument('--exclude', default=None, help='drop sources inside this region (cluster emission)')
+    args = parser.parse_args()
+
+    srclists = [path for path in args.srclists if os.path.exists(path)]
+    for path in sorted(set(args.srclists) - set(srclists)):
+        print(f'Warning: {path} not found, skipped')
+    table = build_catalog(args.image, srclists, args.match_arcsec, args.min_detections, args.exclude)
+    write_region(table, args.regfile)
+    if args.outfile:
+        write_catalog(table, args.outfile)
+    multiple = int(np.sum(np.asarray(table['N_DETECT']) > 1)) if len(table) else 0
+    print(f'{len(table)} sources from {len(srclists)} observations ({multiple} detected more than once)')
+
+
+if __name__ == '__main__':
+    main()
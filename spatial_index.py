@@ -0,0 +1,115 @@
+'''
+KD-tree over 2-D (or k-D) points, for cross-matching source lists.
+
+tiled_wavdetect.py matches the sources of overlapping tiles and
+source_catalog.py the sources of different observations.  Both need "which
+points lie within r of this one" for a few thousand points; a brute-force
+pairwise distance matrix grows as N^2, this tree answers each query in
+O(log N + matches).
+
+The tree is built once with median splits on the widest axis; leaves hold up
+to `leafsize` points and every node keeps the bounding box of its points, so
+a query skips any node whose box is farther than r.
+
+    tree = KDTree(points)                  # points: (N, k) array
+    tree.query_ball_point(p, r)            # indices within r of p
+    tree.query_pairs(r)                    # {(i, j), i < j} closer than r
+    friends_of_friends(points, r)          # group label per point
+'''
+import numpy as np
+
+
+class KDTree:
+    """Static KD-tree; node arrays are indexed by node number, leaves have left == -1."""
+
+    def __init__(self, points, leafsize=16):
+        self.points = np.asarray(points, dtype=np.float64)
+        if self.points.ndim != 2:
+            raise ValueError('points must be an (N, k) array')
+        self.leafsize = max(int(leafsize), 1)
+        self.index = np.arange(len(self.points))
+        self.start, self.end, self.left, self.right = [], [], [], []
+        self.lo, self.hi = [], []
+        if len(self.points):
+            self._build()
+
+    def _new_node(self, start, end):
+        pts = self.points[self.index[start:end]]
+        self.start.append(start)
+        self.end.append(end)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.lo.append(pts.min(axis=0))
+        self.hi.append(pts.max(axis=0))
+        return len(self.start) - 1
+
+    def _build(self):
+        stack = [self._new_node(0, len(self.points))]
+        while stack:
+            node = stack.pop()
+            start, end = self.start[node], self.end[node]
+            if end - start <= self.leafsize:
+                continue
+            axis = int(np.argmax(self.hi[node] - self.lo[node]))
+            if self.hi[node][axis] == self.lo[node][axis]:
+                continue                    # all points identical: keep as a leaf
+            mid = (start + end) // 2
+            segment = self.index[start:end]
+            order = np.argpartition(self.points[segment, axis], mid - start)
+            self.index[start:end] = segment[order]
+            self.left[node] = self._new_node(start, mid)
+            self.right[node] = self._new_node(mid, end)
+            stack += [self.left[node], self.right[node]]
+
+    def _box_distance(self, node, point):
+        gap = np.maximum(np.maximum(self.lo[node] - point, point - self.hi[node]), 0.0)
+        return float(np.sqrt(np.sum(gap * gap)))
+
+    def query_ball_point(self, point, r):
+        """Indices of the points within distance r of point (sorted)."""
+        point = np.asarray(point, dtype=np.float64)
+        found = []
+        stack = [0] if self.start else []
+        while stack:
+            node = stack.pop()
+            if self._box_distance(node, point) > r:
+                continue
+            if self.left[node] < 0:
+                members = self.index[self.start[node]:self.end[node]]
+                d = np.sqrt(np.sum((self.points[members] - point) ** 2, axis=1))
+                found.append(members[d <= r])
+            else:
+                stack += [self.left[node], self.right[node]]
+        return np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+    def query_pairs(self, r):
+        """Set of index pairs (i, j), i < j, whose points are within distance r."""
+        pairs = set()
+        for i, point in enumerate(self.points):
+            for j in self.query_ball_point(point, r):
+                if j > i:
+                    pairs.add((i, int(j)))
+        return pairs
+
+
+def friends_of_friends(points, r, tree=None):
+    """
+    Group label per point: points closer than r are in the same group, transitively.
+    Labels are 0..n_groups-1 in order of each group's first point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    parent = np.arange(len(points))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in (tree or KDTree(points)).query_pairs(r):
+        a, b = root(i), root(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    roots = np.array([root(i) for i in range(len(points))], dtype=np.intp)
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
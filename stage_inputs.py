@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+'''
+Stage the downloaded evt2.fits.gz files once, uncompressed, in scratch space.
+
+Every astropy open and CIAO tool that reads a primary *evt2.fits.gz inflates
+the gzip stream again from the start, and a gzipped file cannot be
+memory-mapped.  This script decompresses the primary evt2 of every obs_id
+once, in a process pool, into a staging directory that mirrors the download
+tree:
+
+    {staging}/{obs_id}/primary/acisf..._evt2.fits     uncompressed (memmappable)
+    {staging}/{obs_id}/primary/<other files>          symlinks to the download
+    {staging}/{obs_id}/secondary, ...                 symlinks to the download
+
+so the staging directory can stand in for cluster_directory:
+obs_catalog.evt2_path (get_obs_mode, the header index) prefers the staged
+copy, and step2 runs chandra_repro from the staging directory.  A staged
+copy is refreshed when its .gz changes.
+
+With "columns" the EVENTS table keeps only PIPELINE_COLUMNS (smaller, faster
+to scan); such copies serve header and event reads only, so chandra_repro
+keeps reading the download tree.
+
+Before each file is staged, free space on the staging file system must
+cover its uncompressed size plus min_free_gb; otherwise the least recently
+staged observations outside the current set are evicted, and a file that
+still does not fit is left compressed: the .gz is linked into the mirror
+in its place, so chandra_repro still finds an event file for it.
+
+config.json:
+    "staging": true                                   ($TMPDIR/pipeline_staging/{name})
+    "staging": {"path": "/scratch/perseus", "min_free_gb": 20, "columns": true}
+
+Usage:
+    python3 stage_inputs.py [--workers N] [--no-evict]
+'''
+import argparse
+import gzip
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers import abs_path, load_config
+
+# event columns read by the pipeline's own tools (event_filter, deflare_engine, merge_engine, ...)
+PIPELINE_COLUMNS = ['time', 'ccd_id', 'node_id', 'expno', 'chipx', 'chipy', 'tdetx', 'tdety', 'detx', 'dety',
+                    'x', 'y', 'pha', 'energy', 'pi', 'fltgrade', 'grade', 'status']
+MIN_FREE_GB = 5.0
+COPY_CHUNK = 1 << 22
+MANIFEST = 'staged.json'
+
+
+def _settings(config):
+    setting = config.get('staging')
+    if not setting:
+        return None
+    return setting if isinstance(setting, dict) else ({'path': setting} if isinstance(setting, str) else {})
+
+
+def staging_dir(config):
+    """Staging directory of the cluster, or None when staging is off."""
+    settings = _settings(config)
+    if settings is None:
+        return None
+    path = settings.get('path') or os.path.join(tempfile.gettempdir(), 'pipeline_staging',
+                                                config['info_dict']['name'])
+    return abs_path(path)
+
+
+def full_copies(config):
+    """True if the staged event files keep every column (usable by the CIAO tools)."""
+    settings = _settings(config)
+    return settings is not None and not settings.get('columns')
+
+
+def _uncompressed_size(path):
+    """Size recorded in the gzip trailer (modulo 4 GB, so never less than the compressed size)."""
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        isize = struct.unpack('<I', f.read(4))[0]
+    compressed = os.path.getsize(path)
+    while isize < compressed:
+        isize += 1 << 32
+    return isize
+
+
+def _decompress(source, target, columns=None):
+    """Inflate source into target (atomically), keeping only columns of EVENTS when given."""
+    tmp = f'{target}.tmp{os.getpid()}'
+    with gzip.open(source, 'rb') as fin, open(tmp, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, COPY_CHUNK)
+    if columns:
+        from astropy.io import fits
+        pruned = f'{tmp}.pruned'
+        with fits.open(tmp, memmap=True) as hdul:
+            out = []
+            for hdu in hdul:
+                if hdu.name == 'EVENTS':
+                    keep = [c for c in hdu.columns if c.name.lower() in columns]
+                    hdu = fits.BinTableHDU.from_columns(keep, header=hdu.header, name='EVENTS')
+                out.append(hdu)
+            fits.HDUList(out).writeto(pruned, overwrite=True)
+        os.replace(pruned, tmp)
+    os.replace(tmp, target)
+    return target
+
+
+def _mirror(source_dir, target_dir, skip):
+    """Symlink every entry of source_dir into target_dir, except the names in skip."""
+    os.makedirs(target_dir, exist_ok=True)
+    for name in os.listdir(source_dir):
+        link = os.path.join(target_dir, name)
+        if name in skip or os.path.lexists(link):
+            continue
+        os.symlink(os.path.join(source_dir, name), link)
+
+
+def _leave_compressed(staging, source, target):
+    """Link the download's .gz in place of a copy that is not staged, so the mirror stays complete."""
+    if os.path.exists(target):
+        # an older copy of a previous download: the .gz is the current file now
+        os.remove(target)
+    staging.entries.pop(source, None)
+    if not os.path.lexists(f'{target}.gz'):
+        os.symlink(source, f'{target}.gz')
+
+
+class Staging:
+    """The staging directory of one cluster and its manifest {source: {target, size, mtime_ns, columns, used}}."""
+
+    def __init__(self, root, min_free_gb=MIN_FREE_GB):
+        self.root = root
+        self.min_free = min_free_gb * 2**30
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, MANIFEST)
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = f'{self.manifest_path}.tmp{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def current(self, source, columns):
+        entry = self.entries.get(source)
+        if not entry or not os.path.exists(entry['target']):
+            return False
+        st = os.stat(source)
+        return entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns and entry['columns'] == columns
+
+    def free(self):
+        return shutil.disk_usage(self.root).free
+
+    def evict_for(self, needed, keep):
+        """Remove staged observations (least recently staged first, not in keep) until needed bytes fit."""
+        for source, entry in sorted(self.entries.items(), key=lambda item: item[1]['used']):
+            if self.free() >= needed + self.min_free:
+                break
+            if entry['obs_id'] in keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, entry['obs_id']), ignore_errors=True)
+            del self.entries[source]
+            print(f'Evicted staged {entry["obs_id"]}')
+        return self.free() >= needed + self.min_free
+
+
+def stage(config=None, workers=None, evict=True):
+    """
+    Stage the primary evt2 of every obs_id of config. Returns {obs_id: staged path or None}.
+    The EVENTS columns are pruned as config "staging": {"columns": true or [names]} asks.
+    """
+    from obs_catalog import evt2_path
+
+    config = config or load_config()
+    root = staging_dir(config)
+    if root is None:
+        raise SystemExit('Staging is off: set "staging" in config.json')
+    settings = _settings(config)
+    columns = settings.get('columns')
+    if columns:
+        columns = sorted(c.lower() for c in (PIPELINE_COLUMNS if columns is True else columns))
+    else:
+        columns = None
+    staging = Staging(root, float(settings.get('min_free_gb', MIN_FREE_GB)))
+    cluster_dir = abs_path(config['info_dict']['cluster_directory'])
+
+    obs_ids = [str(obs_id) for obs_id in config['info_dict']['obs_ids']]
+    todo, staged = [], {}
+    for obs_id in obs_ids:
+        source = evt2_path(cluster_dir, obs_id)
+        staged[obs_id] = None
+        obs_dir = os.path.join(cluster_dir, obs_id)
+        if source is None:
+            # no evt2.fits.gz to inflate (e.g. downloaded uncompressed): link the observation as it is
+            if os.path.isdir(obs_dir):
+                _mirror(obs_dir, os.path.join(root, obs_id), skip=set())
+            continue
+        source = os.path.abspath(source)
+        target = os.path.join(root, obs_id, 'primary', os.path.basename(source)[:-len('.gz')])
+        _mirror(obs_dir, os.path.join(root, obs_id), skip={'primary'})
+        _mirror(os.path.dirname(source), os.path.dirname(target), skip={os.path.basename(source)})
+        if staging.current(source, columns):
+            staged[obs_id] = target
+            staging.entries[source]['used'] = time.time()
+            continue
+        needed = _uncompressed_size(source)
+        fits = staging.evict_for(needed, set(obs_ids)) if evict else staging.free() >= needed + staging.min_free
+        if not fits:
+            print(f'{obs_id}: not enough free space in {root}, left compressed')
+            _leave_compressed(staging, source, target)
+            continue
+        todo.append((obs_id, source, target))
+
+    if todo:
+        t0 = time.monotonic()
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(todo))) as pool:
+            futures = [(obs_id, source, pool.submit(_decompress, source, target, columns))
+                       for obs_id, source, target in todo]
+            for obs_id, source, future in futures:
+                target = future.result()
+                if os.path.islink(f'{target}.gz'):
+                    os.remove(f'{target}.gz')
+                st = os.stat(source)
+                staging.entries[source] = {'obs_id': obs_id, 'target': target, 'size': st.st_size,
+                                           'mtime_ns': st.st_mtime_ns, 'columns': columns, 'used': time.time()}
+                staged[obs_id] = target
+        print(f'Staged {len(todo)} event files in {time.monotonic() - t0:.1f}s')
+    staging.save()
+    return staged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decompress the primary evt2 files once into scratch space.')
+    parser.add_argument('--workers', type=int, default=None, help='files decompressed in parallel')
+    parser.add_argument('--no-evict', action='store_true', help='never remove other staged observations')
+    args = parser.parse_args()
+
+    # pruning is a config setting only: step2 decides from it whether chandra_repro may read the copies
+    staged = stage(workers=args.workers, evict=not args.no_evict)
+    for obs_id, path in staged.items():
+        print(f'{obs_id:>8} {path or "(not staged)"}')
+
+
+if __name__ == '__main__':
+    main()
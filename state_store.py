@@ -0,0 +1,281 @@
+#! /usr/bin/env python3
+'''
+Pipeline state in SQLite, safe to update from many processes at once.
+
+update_flag.py and the steps used to load config.json, change one value and
+rewrite the whole file, so two steps (or two observations) finishing together
+could lose each other's updates.  The state now lives in pipeline_state.db
+next to config.json (SQLite in WAL mode, every update one short IMMEDIATE
+transaction):
+
+    sections / entries   config.json, one row per top-level section and per key
+    runs                 status and timings per step and obs_id
+    fingerprints         the pipeline_dag.py records of the last successful runs
+
+config.json stays as an exported view, rewritten atomically (inside the
+write transaction, so exports are ordered) after every change, and the
+existing scripts keep reading it.  A config.json edited by hand is noticed
+(its size/mtime differ from the last export) and imported before the next
+change.
+
+save_config(config, base) writes only the keys that differ from base, the
+config as the caller loaded it, so a step saving info_dict does not reset a
+flag another process set meanwhile.
+
+Usage:
+    python3 state_store.py flag FLAG          set a flag (what update_flag.py does)
+    python3 state_store.py status [--step S]  per step/obs status and timings
+    python3 state_store.py export             rewrite config.json from the store
+'''
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from helpers import CONFIG_PATH
+
+TIMEOUT = 60.0
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sections (name TEXT PRIMARY KEY, position INTEGER NOT NULL, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (section TEXT NOT NULL, key TEXT NOT NULL, position INTEGER NOT NULL,
+                                    value TEXT NOT NULL, PRIMARY KEY (section, key));
+CREATE TABLE IF NOT EXISTS runs (step TEXT NOT NULL, obs_id TEXT NOT NULL DEFAULT '', status TEXT NOT NULL,
+                                 started REAL, finished REAL, wall REAL, host TEXT, pid INTEGER, message TEXT,
+                                 PRIMARY KEY (step, obs_id));
+CREATE TABLE IF NOT EXISTS fingerprints (node TEXT PRIMARY KEY, record TEXT NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+'''
+_MISSING = object()
+# one connection per database per process
+_connections = {}
+
+
+def db_path(config_path=None):
+    return os.path.join(os.path.dirname(os.path.abspath(config_path or CONFIG_PATH)), 'pipeline_state.db')
+
+
+def connect(config_path=None):
+    config_path = os.path.abspath(config_path or CONFIG_PATH)
+    conn = _connections.get(config_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path(config_path), timeout=TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        _connections[config_path] = conn
+    return conn, config_path
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error): one writer at a time across processes."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, *exc):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _set_meta(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+
+def read_config(conn):
+    """The config dict held in the store (sections and keys in their original order)."""
+    config = {}
+    for name, value in conn.execute('SELECT name, value FROM sections ORDER BY position'):
+        config[name] = json.loads(value) if value is not None else {}
+    for section, key, value in conn.execute('SELECT section, key, value FROM entries ORDER BY section, position'):
+        if isinstance(config.get(section), dict):
+            config[section][key] = json.loads(value)
+    return config
+
+
+def _write(conn, config, base=None):
+    """Store the parts of config that differ from base (everything when base is None)."""
+    base = base if base is not None else {}
+    replace_all = not base
+    if replace_all:
+        conn.execute('DELETE FROM sections')
+        conn.execute('DELETE FROM entries')
+    for name in base:
+        if name not in config:
+            conn.execute('DELETE FROM sections WHERE name = ?', (name,))
+            conn.execute('DELETE FROM entries WHERE section = ?', (name,))
+    next_section = conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM sections').fetchone()[0]
+    for name, value in config.items():
+        old = base.get(name, _MISSING)
+        if isinstance(value, dict):
+            if not isinstance(old, dict):
+                conn.execute('DELETE FROM entries WHERE section = ?', (name,))
+                old = {}
+            conn.execute('INSERT OR IGNORE INTO sections (name, position, value) VALUES (?, ?, NULL)',
+                         (name, next_section))
+            conn.execute('UPDATE sections SET value = NULL WHERE name = ?', (name,))
+            next_section += 1
+            for key in old:
+                if key not in value:
+                    conn.execute('DELETE FROM entries WHERE section = ? AND key = ?', (name, key))
+            position = conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM entries WHERE section = ?',
+                                    (name,)).fetchone()[0]
+            for key, item in value.items():
+                if old.get(key, _MISSING) == item and not replace_all:
+                    continue
+                updated = conn.execute('UPDATE entries SET value = ? WHERE section = ? AND key = ?',
+                                       (json.dumps(item), name, key)).rowcount
+                if not updated:
+                    conn.execute('INSERT INTO entries (section, key, position, value) VALUES (?, ?, ?, ?)',
+                                 (name, key, position, json.dumps(item)))
+                    position += 1
+        elif old != value or replace_all:
+            conn.execute('DELETE FROM entries WHERE section = ?', (name,))
+            updated = conn.execute('UPDATE sections SET value = ? WHERE name = ?',
+                                   (json.dumps(value), name)).rowcount
+            if not updated:
+                conn.execute('INSERT INTO sections (name, position, value) VALUES (?, ?, ?)',
+                             (name, next_section, json.dumps(value)))
+                next_section += 1
+
+
+def _sync_from_json(conn, config_path):
+    """Import config.json if it is not the file this store last exported (new store, or edited by hand)."""
+    stamp = _stamp(config_path)
+    if stamp is None or stamp == _meta(conn, 'export_stamp'):
+        return
+    with open(config_path, 'r') as f:
+        _write(conn, json.load(f))
+    _set_meta(conn, 'export_stamp', stamp)
+
+
+def export(conn, config_path):
+    """Rewrite config.json from the store (atomically) and remember its stamp."""
+    tmp = f'{config_path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(read_config(conn), f, indent=4)
+    os.replace(tmp, config_path)
+    _set_meta(conn, 'export_stamp', _stamp(config_path))
+
+
+def save_config(config, base=None, config_path=None):
+    """Store config (only the keys that differ from base, if given) and export config.json."""
+    conn, config_path = connect(config_path)
+    with _Transaction(conn):
+        _sync_from_json(conn, config_path)
+        _write(conn, config, base)
+        export(conn, config_path)
+
+
+def set_flag(flag, value=True, must_exist=False, config_path=None):
+    """Set one flag in a single transaction. With must_exist, raise KeyError for unknown flags."""
+    conn, config_path = connect(config_path)
+    with _Transaction(conn):
+        _sync_from_json(conn, config_path)
+        updated = conn.execute("UPDATE entries SET value = ? WHERE section = 'flags' AND key = ?",
+                               (json.dumps(value), flag)).rowcount
+        if not updated:
+            if must_exist:
+                raise KeyError(flag)
+            flags = read_config(conn).get('flags', {})
+            _write(conn, {'flags': dict(flags, **{flag: value})}, {'flags': flags})
+        export(conn, config_path)
+
+
+def mark(step, status, obs_id=None, message=None, config_path=None):
+    """
+    Record the status of a step (or of one obs_id within it).  'running' starts the clock;
+    any other status stops it and stores the wall time.
+    """
+    conn, _ = connect(config_path)
+    now = time.time()
+    obs_id = str(obs_id or '')
+    with _Transaction(conn):
+        if status == 'running':
+            conn.execute('INSERT OR REPLACE INTO runs (step, obs_id, status, started, finished, wall, host, pid, '
+                         'message) VALUES (?, ?, ?, ?, NULL, NULL, ?, ?, ?)',
+                         (step, obs_id, status, now, socket.gethostname(), os.getpid(), message))
+            return
+        row = conn.execute('SELECT started FROM runs WHERE step = ? AND obs_id = ?', (step, obs_id)).fetchone()
+        started = row[0] if row and row[0] is not None else now
+        conn.execute('INSERT OR REPLACE INTO runs (step, obs_id, status, started, finished, wall, host, pid, '
+                     'message) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (step, obs_id, status, started, now, now - started, socket.gethostname(), os.getpid(),
+                      message))
+
+
+def runs(step=None, config_path=None):
+    """[{step, obs_id, status, started, finished, wall, host, pid, message}] ordered by start time."""
+    conn, _ = connect(config_path)
+    query = 'SELECT step, obs_id, status, started, finished, wall, host, pid, message FROM runs'
+    args = ()
+    if step:
+        query += ' WHERE step = ?'
+        args = (step,)
+    cursor = conn.execute(query + ' ORDER BY started', args)
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+
+def load_fingerprints(config_path=None):
+    """{node: record} as saved by save_fingerprints."""
+    conn, _ = connect(config_path)
+    return {node: json.loads(record) for node, record in conn.execute('SELECT node, record FROM fingerprints')}
+
+
+def save_fingerprints(node, record, config_path=None):
+    conn, _ = connect(config_path)
+    with _Transaction(conn):
+        conn.execute('INSERT OR REPLACE INTO fingerprints (node, record, updated) VALUES (?, ?, ?)',
+                     (node, json.dumps(record), time.time()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pipeline state store (flags, step status, fingerprints).')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_flag = sub.add_parser('flag', help='set a flag to true')
+    p_flag.add_argument('flag')
+    p_status = sub.add_parser('status', help='status and wall time per step and obs_id')
+    p_status.add_argument('--step', default=None)
+    sub.add_parser('export', help='rewrite config.json from the store')
+    args = parser.parse_args()
+
+    if args.command == 'flag':
+        try:
+            set_flag(args.flag, must_exist=True)
+        except KeyError:
+            print(f'Flag {args.flag} not found in config.json')
+            raise SystemExit(1)
+        print(f'Flag {args.flag} updated successfully')
+    elif args.command == 'status':
+        for r in runs(args.step):
+            wall = f"{r['wall']:.1f}s" if r['wall'] is not None else '-'
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['started'])) if r['started'] else '-'
+            print(f"{r['step']:<12} {r['obs_id'] or '-':<8} {r['status']:<8} {started} {wall:>9}"
+                  f"{'  ' + r['message'] if r['message'] else ''}")
+    else:
+        conn, config_path = connect()
+        with _Transaction(conn):
+            _sync_from_json(conn, config_path)
+            export(conn, config_path)
+
+
+if __name__ == '__main__':
+    main()
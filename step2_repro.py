@@ -1,33 +1,61 @@
 import os
 import json
 from helpers import load_config, abs_path, get_obs_mode, REPO_DIR
+from obs_catalog import scan_observations
+from stage_inputs import staging_dir, full_copies
+from cmd_trace import trace_script
 
-config = load_config()
-script_dir = abs_path(config['info_dict']['script_dir'])
-reppro_dir = abs_path(config['info_dict']['reppro_dir'])
-cluster_directory = abs_path(config['info_dict']['cluster_directory'])
-flag_file = os.path.join(REPO_DIR, 'update_flag.py')
-# Compute relative path from cluster_directory to reppro_dir
-# This handles paths correctly regardless of how they're stored (./, absolute, etc.)
-reppro_dir_relative = os.path.relpath(reppro_dir, cluster_directory)
-
-#script: preprocess the data with chandra_repro
-script = open(os.path.join(script_dir, 'preprocess_data.sh'), 'w')
-script.write(f'cd {cluster_directory}\n')
-script.write('source ~/miniforge3/etc/profile.d/conda.sh\n')
-script.write('conda activate ciao\n')
-
-for obs_id in config["info_dict"]["obs_ids"]:
-    script.write(f'rm -rf {reppro_dir}/{obs_id}\n')
+CONDA_SETUP = [
+    'source ~/miniforge3/etc/profile.d/conda.sh',
+    'conda activate ciao',
+]
+
+
+def repro_commands(obs_id, reppro_dir, reppro_dir_relative):
+    """Shell commands that reprocess one obs_id (run from cluster_directory)."""
+    commands = [f'rm -rf {reppro_dir}/{obs_id}']
     mode_obs_id = get_obs_mode(obs_id)
     if mode_obs_id == 'VFAINT':
-        script.write(f'chandra_repro {obs_id} check_vf_pha=yes verbose=1 outdir = {reppro_dir_relative}/{obs_id} clobber = yes\n')
+        commands.append(f'chandra_repro {obs_id} check_vf_pha=yes verbose=1 outdir = {reppro_dir_relative}/{obs_id} clobber = yes')
     else:
-        script.write(f'chandra_repro {obs_id} verbose=1 outdir = {reppro_dir_relative}/{obs_id} clobber = yes\n')
+        commands.append(f'chandra_repro {obs_id} verbose=1 outdir = {reppro_dir_relative}/{obs_id} clobber = yes')
+
+    commands.append('punlearn ardlib')
+    return commands
+
+
+def main():
+    config = load_config()
+    script_dir = abs_path(config['info_dict']['script_dir'])
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    cluster_directory = abs_path(config['info_dict']['cluster_directory'])
+    flag_file = os.path.join(REPO_DIR, 'update_flag.py')
+    staged = staging_dir(config)
+    # chandra_repro reads the uncompressed staged copies (a mirror of cluster_directory) when they are complete
+    input_directory = staged if staged and full_copies(config) else cluster_directory
+    # Compute relative path from the input directory to reppro_dir
+    # This handles paths correctly regardless of how they're stored (./, absolute, etc.)
+    reppro_dir_relative = os.path.relpath(reppro_dir, input_directory)
+
+    #script: preprocess the data with chandra_repro
+    script = open(os.path.join(script_dir, 'preprocess_data.sh'), 'w')
+    if staged:
+        script.write(f'python3 {REPO_DIR}/stage_inputs.py\n')
+    script.write(f'cd {input_directory}\n')
+    for line in CONDA_SETUP:
+        script.write(f'{line}\n')
+
+    # read every observation's header once, in parallel; get_obs_mode then answers from the index
+    scan_observations(config)
+    for obs_id in config["info_dict"]["obs_ids"]:
+        for command in repro_commands(obs_id, reppro_dir, reppro_dir_relative):
+            script.write(f'{command}\n')
 
-    script.write('punlearn ardlib\n')
+        script.write(f'python3 {flag_file} reprocessed\n')
 
-    script.write(f'python3 {flag_file} reprocessed\n')
+    script.close()
+    trace_script(script.name, 'reprocess', config)
 
 
-script.close()
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,59 @@
 import os
 import json
-from helpers import get_obs_mode, load_config, abs_path, REPO_DIR
-
-config = load_config()
-script_dir = abs_path(config['info_dict']['script_dir'])
-reppro_dir = abs_path(config['info_dict']['reppro_dir'])
-
-#script: Extract Light Curves for Deflaring
-script = open(os.path.join(script_dir, 'deflare_point_sources.sh'), 'w')
-script.write(f'cd {reppro_dir}\n')
-
-for folder in os.listdir(reppro_dir):
-    # folder is a string from os.listdir(); use it as the output root as well.
-    obs_id =os.path.basename(folder.rstrip("/"))
-    script.write(f'cd {folder}\n')
-    script.write(f'pwd \n')
-
-    bpix =os.popen(f'ls {reppro_dir}/{folder}/*repro_bpix1*').read().strip()
-
-    script.write(f'punlearn ardlib \nacis_set_ardlib {bpix} \n')
-    script.write(
+from glob import glob
+from helpers import get_obs_mode, load_config, abs_path, use_native, REPO_DIR
+from obs_catalog import scan_observations
+from cmd_trace import trace_script
+from artifact_store import cache_begin, cache_end, store_root
+
+
+def image_cache(obs_id, obs_dir):
+    """
+    Artifact store (inputs, params, outputs) of the fluximage + mkpsfmap products of one observation:
+    they depend on the event, aspect, bad-pixel and mask files, the band and the calibration only
+    (the CALDB version is added when the script runs: cache_begin/cache_end with caldb=True).
+    """
+    obs_dir = os.path.abspath(obs_dir)
+    inputs = []
+    for pattern in (f'acisf{obs_id}_repro_evt2.fits', '*asol1*', '*repro_bpix1*', '*msk1*'):
+        inputs += sorted(glob(os.path.join(obs_dir, pattern)))
+    params = {'bands': '0.5:7:2.3', 'binsize': 1, 'psf_energy': 2.3, 'ecf': 0.9}
+    outputs = [os.path.join(obs_dir, f'{obs_id}_0.5-7_{name}') for name in ('thresh.img', 'thresh.expmap',
+                                                                           'flux.img')]
+    outputs.append(os.path.join(obs_dir, f'{obs_id}_0.5-7.psf'))
+    return inputs, params, outputs
+
+
+def deflare_commands(obs_id, obs_dir, native_deflare=False, native_filter=False, config=None):
+    """
+    Shell commands that deflare one reprocessed observation (run from obs_dir).
+    With native_deflare the dmcopy/dmextract/deflare chain is replaced by deflare_engine.py.
+    With native_filter the dmcopy event filters are done by event_filter.py, the two
+    light-curve inputs in a single pass.
+    With an artifact store in config, fluximage and mkpsfmap are skipped when their
+    products for the same inputs and calibration are in the store.
+    """
+    commands = []
+    commands.append(f'pwd ')
+
+    bpix = glob(os.path.join(obs_dir, '*repro_bpix1*'))
+    bpix = bpix[0] if bpix else ''
+
+    commands.append(f'punlearn ardlib \nacis_set_ardlib {bpix} ')
+    cache = image_cache(obs_id, obs_dir) if config and store_root(config) else None
+    commands.append(
+        (cache_begin(config, 'fluximage', *cache, caldb=True) if cache else '') +
         f'punlearn fluximage\n'
-        f'fluximage ./ ./{obs_id} binsize=1 bands=0.5:7:2.3 clobber=yes\n'
+        f'fluximage ./ ./{obs_id} binsize=1 bands=0.5:7:2.3 clobber=yes'
     )
 
-    script.write(
+    commands.append(
         f'punlearn mkpsfmap\n'
-        f'mkpsfmap ./{obs_id}_0.5-7_thresh.img outfile=./{obs_id}_0.5-7.psf energy=2.3 ecf=0.9 clobber=yes\n'
-
+        f'mkpsfmap ./{obs_id}_0.5-7_thresh.img outfile=./{obs_id}_0.5-7.psf energy=2.3 ecf=0.9 clobber=yes' +
+        ('\n' + cache_end(config, 'fluximage', *cache, caldb=True) if cache else '')
     )
 
-
-
-    script.write(
+    commands.append(
         f"""punlearn wavdetect
 wavdetect infile=./{obs_id}_0.5-7_thresh.img \
 psffile=./{obs_id}_0.5-7.psf \
@@ -50,56 +71,75 @@ clobber=yes\n
 """
     )
 
-    script.write(f'echo "Region made for {obs_id} Make sure to check all the reg files, they might have taken some of the cluster too. So check the files manually and edit them if needed" \n')  
-      
-    script.write(f'echo "Make GTI file for {obs_id}"\n')
+    commands.append(f'echo "Region made for {obs_id} Make sure to check all the reg files, they might have taken some of the cluster too. So check the files manually and edit them if needed" ')
 
-    script.write(f'ls -la *.reg \n')
+    commands.append(f'echo "Make GTI file for {obs_id}"')
 
-    script.write(
+    commands.append(f'ls -la *.reg ')
+
+    if native_deflare:
+        commands.append(
+            f'python3 {REPO_DIR}/deflare_engine.py acisf{obs_id}_repro_evt2.fits ./{obs_id}_0.5-7.gti '
+            f'--exclude {obs_id}_src_0.5-7-noem.reg --lc ./{obs_id}_0.5-7.lc'
+        )
+    elif native_filter:
+        commands.append(
+            f'python3 {REPO_DIR}/event_filter.py acisf{obs_id}_repro_evt2.fits '
+            f'--out "[exclude sky=region({obs_id}_src_0.5-7-noem.reg)]" ./{obs_id}_nosources.evt '
+            f'--out "[exclude sky=region({obs_id}_src_0.5-7-noem.reg)][energy=500:7000]" ./{obs_id}_0.5-7_nosources.evt'
+        )
+    else:
+        commands.append(
 f"""
 punlearn dmcopy 
 dmcopy "acisf{obs_id}_repro_evt2.fits[exclude sky=region({obs_id}_src_0.5-7-noem.reg)]" \
 ./{obs_id}_nosources.evt option=all clobber=yes
 """
-    )
+        )
 
-    script.write(
+        commands.append(
 f"""
 punlearn dmcopy
 dmcopy "./{obs_id}_nosources.evt[energy=500:7000]" ./{obs_id}_0.5-7_nosources.evt option=all clobber=yes
 """
-    )
+        )
 
-    script.write(
+    if not native_deflare:
+        commands.append(
 f"""
 punlearn dmextract
 dmextract "./{obs_id}_0.5-7_nosources.evt[bin time=::259.28]" ./{obs_id}_0.5-7.lc opt=ltc1 clobber=yes
 """
-    )
+        )
 
-    script.write(
+        commands.append(
 f"""
 punlearn deflare
 deflare ./{obs_id}_0.5-7.lc ./{obs_id}_0.5-7.gti method=clean
 """
-    )
+        )
 
-    script.write(
+    if native_filter:
+        commands.append(
+            f'python3 {REPO_DIR}/event_filter.py ./acisf{obs_id}_repro_evt2.fits '
+            f'--out "[@./{obs_id}_0.5-7.gti]" ./acisf{obs_id}_clean_evt.fits'
+        )
+    else:
+        commands.append(
 f"""
 punlearn dmcopy
 dmcopy "./acisf{obs_id}_repro_evt2.fits[@./{obs_id}_0.5-7.gti]" ./acisf{obs_id}_clean_evt.fits opt=all clobber=yes
 """
-    )
+        )
 
-    script.write(
+    commands.append(
 f"""
 echo "Make GTI file for {obs_id}" \n
 """
     )
 
     if get_obs_mode(obs_id) == 'VFAINT':
-        script.write(
+        commands.append(
             f"""punlearn blanksky
 blanksky evtfile="./acisf{obs_id}_repro_evt2.fits[@./{obs_id}_0.5-7.gti]" outfile=./{obs_id}_vfbackground_clean.evt tmpdir=./ clobber=yes
 punlearn dmcopy
@@ -107,30 +147,60 @@ dmcopy "./{obs_id}_vfbackground_clean.evt[status=0]" ./{obs_id}_background_clean
 """
             )
     else:
-        script.write(
+        commands.append(
             f"""punlearn blanksky
 blanksky evtfile="./acisf{obs_id}_repro_evt2.fits[@./{obs_id}_0.5-7.gti]" outfile=./{obs_id}_background_clean.evt tmpdir=./ clobber=yes
 """
         )
-    
-    script.write(
+
+    commands.append(
         f"""
 dmhedit infile="./{obs_id}_background_clean.evt" filelist=none key="OBS_ID" value="{obs_id}" operation="add"
 """
     )
 
-    script.write(
+    commands.append(
         f"""
 blanksky_image bkgfile=./{obs_id}_background_clean.evt outroot=./{obs_id}_blank imgfile=./{obs_id}_0.5-7_thresh.img tmpdir=./ clobber=yes
 """
     )
+    return commands
+
+
+def obs_folders(reppro_dir):
+    """Reprocessed observation folders (one per obs_id) inside reppro_dir."""
+    return [folder for folder in os.listdir(reppro_dir)
+            if os.path.isdir(os.path.join(reppro_dir, folder))]
+
+
+def main():
+    config = load_config()
+    script_dir = abs_path(config['info_dict']['script_dir'])
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+
+    #script: Extract Light Curves for Deflaring
+    script = open(os.path.join(script_dir, 'deflare_point_sources.sh'), 'w')
+    script.write(f'cd {reppro_dir}\n')
+
+    scan_observations(config)
+    for folder in obs_folders(reppro_dir):
+        # folder is a string from os.listdir(); use it as the output root as well.
+        obs_id =os.path.basename(folder.rstrip("/"))
+        script.write(f'cd {folder}\n')
+        for command in deflare_commands(obs_id, os.path.join(reppro_dir, folder),
+                                        use_native(config, 'deflare'), use_native(config, 'filter'), config):
+            script.write(command if command.endswith('\n') else f'{command}\n')
+        script.write(f'cd ../\n')
+
 
-    script.write(f'cd ../\n')
+        script.write("#-----------------------------------------------------------\n")
 
+    script.write(f'python3 {REPO_DIR}/update_flag.py flare_filtered\n')
 
-    script.write("#-----------------------------------------------------------\n")
+    print(f"Script created successfully: {script.name}")
+    script.close()
+    trace_script(script.name, 'deflare', config)
 
-script.write(f'python3 {REPO_DIR}/update_flag.py flare_filtered\n')
 
-print(f"Script created successfully: {script.name}")
-script.close()
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,71 @@
-from helpers import load_config, abs_path, REPO_DIR, get_ccd_filter
+from helpers import load_config, abs_path, use_native, REPO_DIR, get_ccd_filter
+from obs_catalog import headers
+from cmd_trace import trace_script
+from artifact_store import cache_begin, cache_end
 import os
 from glob import glob
 
-print(REPO_DIR)
-config = load_config()
-script_dir = abs_path(config['info_dict']['script_dir'])
-reppro_dir = abs_path(config['info_dict']['reppro_dir'])
-merge_dir = abs_path(config['info_dict']['merge_dir'])
 
-# Build merge list with ccd_id filter so only selected chips (ACIS-I or ACIS-S) are merged;
-# chip gaps and the other array are excluded (no chip marks in merged image).
-list_path = os.path.join(reppro_dir, 'clean_evt.list')
-with open(list_path, 'w') as f_list:
-    for obs_id in config['info_dict']['obs_ids']:
-        obs_dir = os.path.join(reppro_dir, str(obs_id))
-        repro_evt = glob(os.path.join(obs_dir, 'acisf*_repro_evt2.fits'))
-        clean_evt = glob(os.path.join(obs_dir, 'acisf*clean*'))
-        if not repro_evt:
-            continue
-        ccd_filter = get_ccd_filter(repro_evt[0])
-        # Use clean evt path if it exists (after step3), else expected name for when step3 is run
-        if clean_evt:
-            evt_path = os.path.abspath(clean_evt[0])
-        else:
-            evt_path = os.path.abspath(os.path.join(obs_dir, f'acisf{obs_id}_clean_evt.fits'))
-        f_list.write(f'{evt_path}[ccd_id={ccd_filter}]\n')
+def main():
+    """Write merge_data.sh (and clean_evt.list) for the configured cluster."""
+    print(REPO_DIR)
+    config = load_config()
+    script_dir = abs_path(config['info_dict']['script_dir'])
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    merge_dir = abs_path(config['info_dict']['merge_dir'])
 
-# Script: merge the data (merge_obs reads the list we built above with ccd_id filter)
-script = open(os.path.join(script_dir, 'merge_data.sh'), 'w')
-script.write(f'cd {reppro_dir}\n')
-script.write(f'pwd\n')
-script.write(f'punlearn merge_obs\nmerge_obs @clean_evt.list {merge_dir}/ bin=1 bands=broad clobber=yes\n')
-script.write(f'python3 {os.path.abspath(REPO_DIR)}/update_flag.py merge_data\n')
-script.write(f'echo "Merging data for {config["info_dict"]["name"]}"\n') 
+    # Build merge list with ccd_id filter so only selected chips (ACIS-I or ACIS-S) are merged;
+    # chip gaps and the other array are excluded (no chip marks in merged image).
+    list_path = os.path.join(reppro_dir, 'clean_evt.list')
+    native_merge = use_native(config, 'merge')
+    # artifact store key: what the merge reads, by content, and how (merge_dir differs per sn/smoothness)
+    cache_inputs = []
+    cache_params = {'tool': 'merge_engine' if native_merge else 'merge_obs', 'bin': 1, 'bands': 'broad'}
+    # index all repro headers in one parallel pass before get_ccd_filter asks for them
+    headers(glob(os.path.join(reppro_dir, '*', 'acisf*_repro_evt2.fits')), config=config)
+    with open(list_path, 'w') as f_list:
+        for obs_id in config['info_dict']['obs_ids']:
+            obs_dir = os.path.join(reppro_dir, str(obs_id))
+            repro_evt = glob(os.path.join(obs_dir, 'acisf*_repro_evt2.fits'))
+            clean_evt = glob(os.path.join(obs_dir, 'acisf*clean*'))
+            if not repro_evt:
+                continue
+            ccd_filter = get_ccd_filter(repro_evt[0])
+            # Use clean evt path if it exists (after step3), else expected name for when step3 is run
+            if clean_evt:
+                evt_path = os.path.abspath(clean_evt[0])
+            else:
+                evt_path = os.path.abspath(os.path.join(obs_dir, f'acisf{obs_id}_clean_evt.fits'))
+            f_list.write(f'{evt_path}[ccd_id={ccd_filter}]\n')
+            cache_inputs.append(evt_path)
+            cache_params[f'ccd_id{len(cache_inputs)}'] = ccd_filter
+            if native_merge:
+                cache_inputs += sorted(glob(os.path.join(obs_dir, '*_0.5-7_thresh.expmap')) +
+                                       glob(os.path.join(obs_dir, '*broad_thresh.expmap')))[:1]
+            else:
+                for pattern in ('*asol1.fits', '*bpix1.fits', '*msk1.fits'):
+                    cache_inputs += sorted(glob(os.path.join(obs_dir, pattern)))
+    cache_outputs = [os.path.join(merge_dir, name) for name in ('broad_thresh.img', 'broad_thresh.expmap',
+                                                                'broad_flux.img')]
+
+    # Script: merge the data (merge_obs or merge_engine.py reads the list we built above with ccd_id filter)
+    script = open(os.path.join(script_dir, 'merge_data.sh'), 'w')
+    script.write(f'cd {reppro_dir}\n')
+    script.write(f'pwd\n')
+    script.write(cache_begin(config, 'merge', cache_inputs, cache_params, cache_outputs))
+    if native_merge:
+        # same list and outputs, reprojected and binned per observation in parallel; only observations
+        # added, dropped or changed since the last merge are binned again
+        script.write(f'python3 {os.path.abspath(REPO_DIR)}/merge_engine.py --list {list_path} --outdir {merge_dir} '
+                     f'--incremental\n')
+    else:
+        script.write(f'punlearn merge_obs\nmerge_obs @clean_evt.list {merge_dir}/ bin=1 bands=broad clobber=yes\n')
+    script.write(cache_end(config, 'merge', cache_inputs, cache_params, cache_outputs))
+    script.write(f'python3 {os.path.abspath(REPO_DIR)}/update_flag.py merge_data\n')
+    script.write(f'echo "Merging data for {config["info_dict"]["name"]}"\n') 
+    script.close()
+    trace_script(script.name, 'merge', config)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,103 @@
 #! /usr/bin/env python3
-from helpers import REPO_DIR, load_config
-from astropy.io import fits
+'''
+Scale the merged flux image into count-like units for contour binning:
+
+    scaled_broad_flux = 2.5 * broad_flux * (threshav / fluxav)
+
+The images are memory-mapped and read in blocks of rows: one pass collects
+the counts sum, a second pass writes scaled_broad_flux.fits tile by tile, so memory
+stays bounded on wide mosaics.  Use --float32 to keep the output in single
+precision.
+
+With "artifact_store" in config.json the scaled map is taken from the store
+when the same merged images were scaled before (another S/N or smoothing).
+
+Usage:
+    python3 step5_merge_data_flux.py [--float32] [--tile-rows N]
+'''
+from helpers import load_config, abs_path, set_flag, peak_rss_mb
+from artifact_store import ArtifactStore, store_root
 import numpy as np
+import argparse
 import os
-import json
-def _mkmap(input, output, head):
-    fits.writeto(output, input, head, overwrite=True)
-config = load_config()
-PARENT_DIR = os.path.join(REPO_DIR, config['info_dict']['parent_directory'])
 
-fluxim =fits.open(os.path.join(PARENT_DIR, config['info_dict']['merge_dir'], 'broad_flux.img'))
-fluxhdr = fluxim[0].header
-fluximdata = fluxim[0].data
+TILE_ROWS = 512
+
+
+def scale_factor(fluximdata, threshimdata, tile_rows=TILE_ROWS):
+    """2.5 * threshav / fluxav, with the counts summed in one pass over row blocks."""
+    threshsum = 0.0
+    for start in range(0, threshimdata.shape[0], tile_rows):
+        threshsum += np.sum(threshimdata[start:start + tile_rows], dtype=np.float64)
+
+    threshav = threshsum / len(threshimdata)
+    # fluxsum / mean(flux), as in the original full-array expression; that is just the pixel count,
+    # and writing it out keeps an all-zero flux image from dividing by zero
+    fluxav = float(fluximdata.size)
+    return 2.5 * (threshav / fluxav)
+
+
+def scale_flux(merge_dir, dtype=np.float64, tile_rows=TILE_ROWS):
+    """Write scaled_broad_flux.fits from broad_flux.img and broad_thresh.img. Returns the factor."""
+    from astropy.io import fits
+
+    dtype = np.dtype(dtype)
+    output = os.path.join(merge_dir, 'scaled_broad_flux.fits')
+    with fits.open(os.path.join(merge_dir, 'broad_flux.img'), memmap=True) as fluxim, \
+            fits.open(os.path.join(merge_dir, 'broad_thresh.img'), memmap=True) as threshim:
+        fluximdata = fluxim[0].data
+        factor = scale_factor(fluximdata, threshim[0].data, tile_rows)
+
+        fluxhdr = fluxim[0].header.copy()
+        fluxhdr['BITPIX'] = -32 if dtype == np.float32 else -64
+        for key in ('BSCALE', 'BZERO', 'BLANK'):
+            fluxhdr.remove(key, ignore_missing=True)
+
+        if os.path.exists(output):
+            os.remove(output)
+        stream = fits.StreamingHDU(output, fluxhdr)
+        try:
+            for start in range(0, fluximdata.shape[0], tile_rows):
+                tile = np.asarray(fluximdata[start:start + tile_rows], dtype=dtype) * dtype.type(factor)
+                stream.write(tile.astype(dtype, copy=False))
+        finally:
+            stream.close()
+    return factor
 
-threshim = fits.open(os.path.join(PARENT_DIR, config['info_dict']['merge_dir'], 'broad_thresh.img'))
-threshimdata = threshim[0].data
 
-expoim = fits.open(os.path.join(PARENT_DIR, config['info_dict']['merge_dir'], 'broad_thresh.expmap'))
-expohd = expoim[0].header
-expoimdata = expoim[0].data
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scale the merged flux map for contour binning.')
+    parser.add_argument('--float32', action='store_true', help='write the scaled map in single precision')
+    parser.add_argument('--tile-rows', type=int, default=TILE_ROWS, help='image rows processed per block')
+    args = parser.parse_args(argv)
 
-threshsum = np.sum(threshimdata)
-fluxsum = np.sum(fluximdata)
-threshav = threshsum/ len(threshimdata)
+    config = load_config()
+    merge_dir = abs_path(config['info_dict']['merge_dir'])
 
-fluxav = fluxsum/np.mean(fluximdata)
-scaledflux = (2.5*fluximdata*(threshav/fluxav))
+    dtype = np.float32 if args.float32 else np.float64
+    root = store_root(config)
+    if root is None:
+        factor = scale_flux(merge_dir, dtype, args.tile_rows)
+        print(f'Scale factor {factor:.6g}, peak RSS {peak_rss_mb():.1f} MB')
+    else:
+        store = ArtifactStore(root)
+        inputs = [os.path.join(merge_dir, 'broad_flux.img'), os.path.join(merge_dir, 'broad_thresh.img')]
+        outputs = [os.path.join(merge_dir, 'scaled_broad_flux.fits')]
+        params = {'dtype': np.dtype(dtype).name}
+        key = store.key('flux', inputs, params)
+        if store.restore(key, outputs):
+            print('scaled_broad_flux.fits restored from the artifact store')
+        else:
+            # an earlier product may be a link to a stored object: write a new file, not through the link
+            for path in outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+            factor = scale_flux(merge_dir, dtype, args.tile_rows)
+            store.save(key, 'flux', outputs, params)
+            print(f'Scale factor {factor:.6g}, peak RSS {peak_rss_mb():.1f} MB')
 
-_mkmap(scaledflux, os.path.join(PARENT_DIR, config['info_dict']['merge_dir'], 'scaled_broad_flux.fits'), fluxhdr)
+    set_flag('flux_maps')
 
 
-config = load_config()
-config['flags']['flux_maps'] = True
-with open(os.path.join(REPO_DIR, 'config.json'), 'w') as f:
-    json.dump(config, f, indent=4)
+if __name__ == '__main__':
+    main()
@@ -22,40 +22,83 @@ save these three region files to /regionfiles
 
 '''
 
-from helpers import load_config, abs_path, REPO_DIR
+from helpers import load_config, abs_path, use_native, REPO_DIR
+from cmd_trace import trace_script
+from artifact_store import cache_begin, cache_end
 import os
 import re
-config = load_config()
-map_file_dir = abs_path(config['info_dict']['map_file_dir'])
-region_file_dir = abs_path(config['info_dict']['region_file_dir'])
-min_xy_file = os.path.join(region_file_dir, 'min_xy.reg')
-
-with open(min_xy_file, 'r') as f:
-    for line in f:
-        if line.startswith('box'):
-            box_line = line.strip()
-            break
-values = re.findall(r'[+-]?\d*\.\d+', box_line)
-x_center, y_center, width, height = map(float, values[:4])
-x_min = x_center - (width/2)
-y_min = y_center - (height/2)
-print(x_min, y_min, width, height)
-
-script_dir = abs_path(config['info_dict']['script_dir'])
-merge_dir = abs_path(config['info_dict']['merge_dir'])
-
-script = open(os.path.join(script_dir, 'crop_data.sh'), 'w')
-script.write(f'echo "Cropping data"\n')
-script.write(f'cd {merge_dir}\n')
-
-
-# remove cluster emission for deflaring / scaling
-script.write(
-f'dmcopy "broad_thresh.img[exclude sky=region({os.path.join(region_file_dir, "src_0.5-7-nps-noem.reg")})]" broad_thresh_noem.img clobber=yes\n\n'
-)
-
-script.write(
-f"""
+
+
+def main():
+    """Write crop_data.sh for the configured cluster."""
+    config = load_config()
+    map_file_dir = abs_path(config['info_dict']['map_file_dir'])
+    region_file_dir = abs_path(config['info_dict']['region_file_dir'])
+    min_xy_file = os.path.join(region_file_dir, 'min_xy.reg')
+
+    with open(min_xy_file, 'r') as f:
+        for line in f:
+            if line.startswith('box'):
+                box_line = line.strip()
+                break
+    values = re.findall(r'[+-]?\d*\.\d+', box_line)
+    x_center, y_center, width, height = map(float, values[:4])
+    x_min = x_center - (width/2)
+    y_min = y_center - (height/2)
+    print(x_min, y_min, width, height)
+
+    script_dir = abs_path(config['info_dict']['script_dir'])
+    merge_dir = abs_path(config['info_dict']['merge_dir'])
+
+    script = open(os.path.join(script_dir, 'crop_data.sh'), 'w')
+    script.write(f'echo "Cropping data"\n')
+    script.write(f'cd {merge_dir}\n')
+
+
+    native_masking = use_native(config, 'masking')
+    mask_cache = os.path.join(merge_dir, 'mask_cache')
+    square_reg = os.path.join(region_file_dir, 'square.reg')
+    noem_reg = os.path.join(region_file_dir, 'src_0.5-7-nps-noem.reg')
+    use_catalog = bool(config.get('source_catalog', False))
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    srclists = [os.path.join(reppro_dir, str(obs_id), f'{obs_id}_src_0.5-7.fits')
+                for obs_id in config['info_dict']['obs_ids']]
+
+    # artifact store: the crop depends on the scaled and merged maps and the region files only
+    cache_inputs = [os.path.join(merge_dir, name) for name in ('scaled_broad_flux.fits', 'broad_thresh.img',
+                                                               'broad_thresh.expmap')]
+    cache_inputs += [path for path in (noem_reg, square_reg) if os.path.exists(path)]
+    if use_catalog:
+        cache_inputs += [path for path in srclists if os.path.exists(path)]
+    cache_params = {'native_masking': native_masking, 'square': os.path.exists(square_reg),
+                    'tiled_wavdetect': bool(config.get('tiled_wavdetect', False)), 'source_catalog': use_catalog}
+    cache_outputs = [os.path.join(merge_dir, 'scaled_broad_flux_final.fits'),
+                     os.path.join(region_file_dir, 'broad_src_0.5-7.reg')]
+    script.write(cache_begin(config, 'crop', cache_inputs, cache_params, cache_outputs))
+
+    if use_catalog:
+        # the per-observation wavdetect lists of step3, cross-matched on the merged image, replace the
+        # detection on the merged image; sources in the cluster emission are dropped as before
+        script.write(f'python3 {REPO_DIR}/source_catalog.py broad_thresh.img {" ".join(srclists)} '
+                     f'--exclude {noem_reg} --outfile src_0.5-7.fits --regfile {region_file_dir}/broad_src_0.5-7.reg\n')
+    else:
+        # remove cluster emission for deflaring / scaling
+        if native_masking:
+            script.write(
+            f'python3 {REPO_DIR}/regions.py crop broad_thresh.img broad_thresh_noem.img --exclude {os.path.join(region_file_dir, "src_0.5-7-nps-noem.reg")} --cache-dir {mask_cache}\n\n'
+            )
+        else:
+            script.write(
+            f'dmcopy "broad_thresh.img[exclude sky=region({os.path.join(region_file_dir, "src_0.5-7-nps-noem.reg")})]" broad_thresh_noem.img clobber=yes\n\n'
+            )
+
+        if config.get('tiled_wavdetect', False):
+            # same detection on overlapping tiles in parallel, duplicates in the overlaps merged
+            script.write(f'python3 {REPO_DIR}/tiled_wavdetect.py broad_thresh_noem.img broad_thresh.expmap '
+                         f'--outfile src_0.5-7.fits --regfile {region_file_dir}/broad_src_0.5-7.reg\n')
+        else:
+            script.write(
+            f"""
 wavdetect infile=broad_thresh_noem.img \
 psffile=none \
 expfile=broad_thresh.expmap \
@@ -67,18 +110,30 @@ regfile={region_file_dir}/broad_src_0.5-7.reg \
 scales="1 2 4 8 16 32" \
 maxiter=3 sigthresh=5e-6 ellsigma=5.0 clobber=yes
 """
-)
+            )
+
+
+    if native_masking:
+        # point source exclusion and cropping in one in-memory pass
+        include = f' --include {square_reg}' if os.path.exists(square_reg) else ''
+        script.write(f'python3 {REPO_DIR}/regions.py crop scaled_broad_flux.fits scaled_broad_flux_final.fits --exclude {region_file_dir}/broad_src_0.5-7.reg{include} --cache-dir {mask_cache}\n')
+    else:
+        script.write(f'dmcopy "scaled_broad_flux.fits[exclude sky=region({region_file_dir}/broad_src_0.5-7.reg)]" scaled_broad_flux_cropped.fits clobber=yes\n')
 
+        #point sources are now removed.
 
-script.write(f'dmcopy "scaled_broad_flux.fits[exclude sky=region({region_file_dir}/broad_src_0.5-7.reg)]" scaled_broad_flux_cropped.fits clobber=yes\n')
+        if os.path.exists(square_reg):
+            script.write(f'dmcopy "scaled_broad_flux_cropped.fits[sky=region({square_reg})]" scaled_broad_flux_final.fits clobber=yes\n')
+        else:
+            script.write(f'mv scaled_broad_flux_cropped.fits scaled_broad_flux_final.fits\n')
+    script.write(cache_end(config, 'crop', cache_inputs, cache_params, cache_outputs))
 
-#point sources are now removed.
+    # -f: a copy of a restored (read-only) product is read-only too
+    script.write(f'cp -f scaled_broad_flux_final.fits {map_file_dir}/scaled_broad_flux_final.fits\n')
+    script.write(f'python3 {REPO_DIR}/update_flag.py remove_point_source\n')
+    script.close()
+    trace_script(script.name, 'crop', config)
 
-square_reg = os.path.join(region_file_dir, 'square.reg')
-if os.path.exists(square_reg):
-    script.write(f'dmcopy "scaled_broad_flux_cropped.fits[sky=region({square_reg})]" scaled_broad_flux_final.fits clobber=yes\n')
-else:
-    script.write(f'mv scaled_broad_flux_cropped.fits scaled_broad_flux_final.fits\n')
 
-script.write(f'cp scaled_broad_flux_final.fits {map_file_dir}/scaled_broad_flux_final.fits\n')
-script.write(f'python3 {REPO_DIR}/update_flag.py remove_point_source\n')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
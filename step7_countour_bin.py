@@ -1,37 +1,57 @@
 #! /usr/bin/env python3
-from astropy.io import fits
 import re
-from helpers import load_config, abs_path, REPO_DIR
+from helpers import load_config, abs_path, use_native, REPO_DIR
+from cmd_trace import trace_script
 import os
-config = load_config()
-
-hdul = fits.open(os.path.join(abs_path(config['info_dict']['map_file_dir']), 'scaled_broad_flux_final.fits'))
-region = hdul[0].header['DSVAL1']
-hdul.close()
-numbers = [float(x) for x in re.findall(r'-?\d+\.?\d*', region)]
-
-center_x, center_y, width, height = numbers[:4]
-min_x, min_y = center_x-(width/2), center_y-(height/2)
-
-print(f"Region: {region}")
-print(f"Parsed values: center_x={center_x}, center_y={center_y}, width={width}, height={height}")
-print(f"min_x: {min_x}, min_y: {min_y}")
-
-script = open(os.path.join(abs_path(config['info_dict']['script_dir']), 'contour_binning.sh'), 'w')
-
-script.write(f"cd {abs_path(config['info_dict']['spec_file_dir'])}\n")
-
-contbin = 'contbin --sn=' + str(config['info_dict']['sn_per_region']) + \
-          ' --smoothsn=' + str(config['info_dict']['reg_smoothness']) + \
-          f" --constrainfill --constrainval=3. {os.path.join(abs_path(config['info_dict']['map_file_dir']), 'scaled_broad_flux_final.fits')}\n" + \
-          'mkdir contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n' + \
-          'mkdir contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '/outreg\n' + \
-          'mv bin_signal_stats.qdp bin_sn_stats.qdp contbin_binmap.fits contbin_mask.fits ' + \
-          'contbin_out.fits contbin_sn.fits contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n' + \
-          'cd contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n'
-script.write(contbin)
-
-mkregions = f'make_region_files --minx={min_x} --miny={min_y} --bin=1 --outdir=outreg contbin_binmap.fits\n'
-script.write(mkregions)
-script.write(f'python3 {REPO_DIR}/update_flag.py contour_binning\n')
-script.close()
\ No newline at end of file
+
+
+def main():
+    """Write contour_binning.sh for the configured cluster."""
+    from astropy.io import fits
+
+    config = load_config()
+
+    hdul = fits.open(os.path.join(abs_path(config['info_dict']['map_file_dir']), 'scaled_broad_flux_final.fits'))
+    region = hdul[0].header['DSVAL1']
+    hdul.close()
+    numbers = [float(x) for x in re.findall(r'-?\d+\.?\d*', region)]
+
+    center_x, center_y, width, height = numbers[:4]
+    min_x, min_y = center_x-(width/2), center_y-(height/2)
+
+    print(f"Region: {region}")
+    print(f"Parsed values: center_x={center_x}, center_y={center_y}, width={width}, height={height}")
+    print(f"min_x: {min_x}, min_y: {min_y}")
+
+    script = open(os.path.join(abs_path(config['info_dict']['script_dir']), 'contour_binning.sh'), 'w')
+
+    script.write(f"cd {abs_path(config['info_dict']['spec_file_dir'])}\n")
+
+    if use_native(config, 'contbin'):
+        # in-process contour binning writes its products straight into the output directory
+        out_dir = 'contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness'])
+        contbin = f"python3 {REPO_DIR}/contbin.py --sn={config['info_dict']['sn_per_region']} " + \
+                  f"--smoothsn={config['info_dict']['reg_smoothness']} --constrainfill --constrainval=3. " + \
+                  f"--outdir={out_dir} {os.path.join(abs_path(config['info_dict']['map_file_dir']), 'scaled_broad_flux_final.fits')}\n" + \
+                  f'mkdir -p {out_dir}/outreg\n' + \
+                  f'cd {out_dir}\n'
+    else:
+        contbin = 'contbin --sn=' + str(config['info_dict']['sn_per_region']) + \
+                  ' --smoothsn=' + str(config['info_dict']['reg_smoothness']) + \
+                  f" --constrainfill --constrainval=3. {os.path.join(abs_path(config['info_dict']['map_file_dir']), 'scaled_broad_flux_final.fits')}\n" + \
+                  'mkdir contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n' + \
+                  'mkdir contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '/outreg\n' + \
+                  'mv bin_signal_stats.qdp bin_sn_stats.qdp contbin_binmap.fits contbin_mask.fits ' + \
+                  'contbin_out.fits contbin_sn.fits contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n' + \
+                  'cd contbin_sn' + str(config['info_dict']['sn_per_region']) + '_smooth' + str(config['info_dict']['reg_smoothness']) + '\n'
+    script.write(contbin)
+
+    mkregions = f'make_region_files --minx={min_x} --miny={min_y} --bin=1 --outdir=outreg contbin_binmap.fits\n'
+    script.write(mkregions)
+    script.write(f'python3 {REPO_DIR}/update_flag.py contour_binning\n')
+    script.close()
+    trace_script(script.name, 'contbin', config)
+
+
+if __name__ == '__main__':
+    main()
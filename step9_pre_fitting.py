@@ -1 +1,253 @@
-import
\ No newline at end of file
+#! /usr/bin/env python3
+'''
+Extract spectra for every contour bin from every observation.
+
+For each (bin, obs_id) pair specextract is run on the clean event file with
+the WCS region outreg/sex/xaf_N.reg, using the blank-sky background
+{obs_id}_background_clean.evt from step3.  The pairs run through
+job_runner.run_jobs, so every worker has its own PFILES (ardlib) and tmp dir.
+Observations with the largest event files are scheduled first so the longest
+jobs don't end up at the tail of the run.
+
+By default the responses are not made per pair: response_cache.py builds one
+ARF/RMF per (obs_id, grid cell), cached across runs, and every bin gets the
+count-weighted average of the cells it covers.  The spectra themselves are
+then extracted with dmextract only.  Bins whose cells disagree by more than
+response_tolerance, and all bins when exact_responses is set in config.json,
+get a full per-bin specextract instead.
+
+The stage can be resumed: a pair is skipped when its .pi/.arf/.rmf already
+exist and are newer than the region, event and background files.
+
+Outputs go to {spec_file_dir}/contbin_sn{sn}_smooth{smooth}/spectra/{obs_id}/xaf_N*.
+
+Usage:
+    python3 step9_pre_fitting.py [--workers N] [--force]
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import repeat
+
+from helpers import load_config, abs_path, set_flag
+from job_runner import make_job, run_jobs
+from cmd_trace import trace_commands
+from reg_convert import region_files
+import response_cache
+
+PRODUCTS = ('.pi', '.arf', '.rmf')
+
+
+def contbin_dir(config):
+    info = config['info_dict']
+    return os.path.join(abs_path(info['spec_file_dir']),
+                        f"contbin_sn{info['sn_per_region']}_smooth{info['reg_smoothness']}")
+
+
+def obs_inputs(config):
+    """(obs_id, obs_dir, clean evt, background evt, bad pixel file) for every obs_id, largest first."""
+    reppro_dir = abs_path(config['info_dict']['reppro_dir'])
+    observations = []
+    for obs_id in config['info_dict']['obs_ids']:
+        obs_dir = os.path.join(reppro_dir, str(obs_id))
+        evt = os.path.join(obs_dir, f'acisf{obs_id}_clean_evt.fits')
+        bkg = os.path.join(obs_dir, f'{obs_id}_background_clean.evt')
+        bpix = os.path.join(obs_dir, f'acisf{obs_id}_repro_bpix1.fits')
+        if not os.path.exists(evt):
+            print(f'No clean event file for {obs_id}, skipping it')
+            continue
+        observations.append((str(obs_id), obs_dir, evt, bkg, bpix))
+    return sorted(observations, key=lambda o: os.path.getsize(o[2]), reverse=True)
+
+
+def response_inputs(obs_dir, evt, bpix):
+    """Fingerprint of the files the cell responses of one observation are made from."""
+    return response_cache.input_fingerprint([evt, bpix] + sorted(glob(os.path.join(obs_dir, '*asol1*'))))
+
+
+def up_to_date(outroot, inputs):
+    """True if every product of outroot exists and is newer than all inputs."""
+    try:
+        oldest = min(os.path.getmtime(outroot + ext) for ext in PRODUCTS)
+    except OSError:
+        return False
+    return all(os.path.getmtime(path) <= oldest for path in inputs if os.path.exists(path))
+
+
+def extract_commands(evt, bkg, bpix, reg, outroot):
+    """specextract for one region of one observation."""
+    return [
+        'punlearn ardlib',
+        f'acis_set_ardlib {bpix}',
+        'punlearn specextract',
+        f'specextract infile="{evt}[sky=region({reg})]" outroot={outroot} '
+        f'bkgfile="{bkg}[sky=region({reg})]" bkgresp=no weight=yes correctpsf=no '
+        f'grouptype=NUM_CTS binspec=1 tmpdir=$ASCDS_WORK_PATH clobber=yes',
+    ]
+
+
+def grid_commands(evt, bkg, reg, outroot):
+    """Source and background spectra only; the responses come from the cell cache."""
+    name = os.path.basename(outroot)
+    return [
+        'punlearn dmextract',
+        f'dmextract infile="{evt}[sky=region({reg})][bin pi]" outfile={outroot}.pi opt=pha1 clobber=yes',
+        f'dmextract infile="{bkg}[sky=region({reg})][bin pi]" outfile={outroot}_bkg.pi opt=pha1 clobber=yes',
+        'punlearn dmhedit',
+        f'dmhedit infile={outroot}.pi filelist=none operation=add key=BACKFILE value={name}_bkg.pi',
+        f'dmhedit infile={outroot}.pi filelist=none operation=add key=RESPFILE value={name}.rmf',
+        f'dmhedit infile={outroot}.pi filelist=none operation=add key=ANCRFILE value={name}.arf',
+        'punlearn dmgroup',
+        f'dmgroup infile={outroot}.pi outfile={outroot}_grp.pi grouptype=NUM_CTS grouptypeval=1 '
+        f'binspec="" xcolumn=channel ycolumn=counts clobber=yes',
+    ]
+
+
+def bin_weights(config, cell_size):
+    """Grid cells and weights of every bin, from the bin map and the merged counts image."""
+    info = config['info_dict']
+    merge_dir = abs_path(info['merge_dir'])
+    return response_cache.bin_cell_weights(os.path.join(contbin_dir(config), 'contbin_binmap.fits'),
+                                           os.path.join(merge_dir, 'broad_thresh.img'), cell_size)
+
+
+def cell_jobs(config, weights, cell_size):
+    """specextract jobs for the (obs_id, cell) responses not yet in the cache."""
+    from astropy.io import fits
+    import regions
+
+    info = config['info_dict']
+    merge_dir = abs_path(info['merge_dir'])
+    wcs = regions.physical_wcs(fits.getheader(os.path.join(merge_dir, 'broad_thresh.img')))
+    cache = response_cache.cache_dir(config)
+    calver = response_cache.caldb_version()
+    cells = sorted({tuple(c) for cells, _ in weights.values() for c in cells})
+
+    jobs = []
+    for obs_id, obs_dir, evt, bkg, bpix in obs_inputs(config):
+        inputs = response_inputs(obs_dir, evt, bpix)
+        for cell in cells:
+            outroot = response_cache.cell_root(cache, calver, obs_id, inputs, cell, cell_size)
+            if response_cache.have_cell(outroot):
+                continue
+            os.makedirs(os.path.dirname(outroot), exist_ok=True)
+            commands = response_cache.cell_commands(evt, bpix, cell, cell_size, wcs, outroot)
+            jobs.append(make_job(f'cell_{cell[0]}_{cell[1]}_{obs_id}',
+                                 trace_commands(commands, 'spectra', obs_id, config), obs_dir))
+    return jobs
+
+
+def grid_spectrum_jobs(config, weights, cell_size, tolerance, force=False, workers=None):
+    """
+    Like spectrum_jobs, but combines the cached cell responses for each pair first (in a process
+    pool, COMBINE_CHUNK pairs of one observation per task) and only falls back to specextract
+    when the cells disagree. Returns (jobs, skipped, exact).
+    """
+    regions_dir = os.path.join(contbin_dir(config), 'outreg', 'sex')
+    spectra_dir = os.path.join(contbin_dir(config), 'spectra')
+    cache = response_cache.cache_dir(config)
+    calver = response_cache.caldb_version()
+    regs = region_files(regions_dir)
+    pairs = []
+    chunks = []
+    skipped = 0
+    for obs_id, obs_dir, evt, bkg, bpix in obs_inputs(config):
+        out_dir = os.path.join(spectra_dir, obs_id)
+        os.makedirs(out_dir, exist_ok=True)
+        inputs = response_inputs(obs_dir, evt, bpix)
+        tasks = []
+        for reg in regs:
+            name = os.path.splitext(os.path.basename(reg))[0]
+            outroot = os.path.join(out_dir, name)
+            if not force and up_to_date(outroot, [reg, evt, bkg]):
+                skipped += 1
+                continue
+            cells, w = weights.get(int(name.split('_')[1]), ([], []))
+            roots = [response_cache.cell_root(cache, calver, obs_id, inputs, c, cell_size) for c in cells]
+            tasks.append((roots, w, outroot))
+            pairs.append((name, obs_id, obs_dir, evt, bkg, bpix, reg, outroot))
+        chunks += [tasks[i:i + response_cache.COMBINE_CHUNK]
+                   for i in range(0, len(tasks), response_cache.COMBINE_CHUNK)]
+
+    combined = []
+    if chunks:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(chunks))) as pool:
+            for done in pool.map(response_cache.combine_chunk, chunks, repeat(tolerance)):
+                combined += done
+
+    jobs = []
+    exact = 0
+    for (name, obs_id, obs_dir, evt, bkg, bpix, reg, outroot), ok in zip(pairs, combined):
+        if ok:
+            commands = grid_commands(evt, bkg, reg, outroot)
+        else:
+            commands = extract_commands(evt, bkg, bpix, reg, outroot)
+            exact += 1
+        jobs.append(make_job(f'{name}_{obs_id}', trace_commands(commands, 'spectra', obs_id, config), obs_dir))
+    return jobs, skipped, exact
+
+
+def spectrum_jobs(config, force=False):
+    """Jobs for every (obs, bin) pair that still needs extracting; returns (jobs, skipped)."""
+    regions_dir = os.path.join(contbin_dir(config), 'outreg', 'sex')
+    spectra_dir = os.path.join(contbin_dir(config), 'spectra')
+    regs = region_files(regions_dir)
+    jobs = []
+    skipped = 0
+    for obs_id, obs_dir, evt, bkg, bpix in obs_inputs(config):
+        out_dir = os.path.join(spectra_dir, obs_id)
+        os.makedirs(out_dir, exist_ok=True)
+        for reg in regs:
+            name = os.path.splitext(os.path.basename(reg))[0]
+            outroot = os.path.join(out_dir, name)
+            if not force and up_to_date(outroot, [reg, evt, bkg]):
+                skipped += 1
+                continue
+            commands = trace_commands(extract_commands(evt, bkg, bpix, reg, outroot), 'spectra', obs_id, config)
+            jobs.append(make_job(f'{name}_{obs_id}', commands, obs_dir))
+    return jobs, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract spectra for every contour bin and observation.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='maximum number of concurrent specextract jobs (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='re-extract spectra that are up to date')
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    log_dir = os.path.join(abs_path(config['info_dict']['script_dir']), 'logs', 'spectra')
+    exact_responses, cell_size, tolerance = response_cache.settings(config)
+    t0 = time.monotonic()
+
+    if exact_responses:
+        jobs, skipped = spectrum_jobs(config, args.force)
+        print(f'{len(jobs)} spectra to extract, {skipped} up to date')
+    else:
+        weights = bin_weights(config, cell_size)
+        jobs = cell_jobs(config, weights, cell_size)
+        print(f'{len(jobs)} cell responses to make')
+        if jobs:
+            # a cell off the chips of an observation has no response; its bins use the other cells
+            cells = run_jobs(jobs, workers=args.workers, log_dir=os.path.join(log_dir, 'cells'))
+            missing = sum(r['returncode'] != 0 for r in cells)
+            if missing:
+                print(f'{missing} cell responses could not be made (off chip?), see {log_dir}/cells')
+        jobs, skipped, exact = grid_spectrum_jobs(config, weights, cell_size, tolerance, args.force,
+                                                 args.workers)
+        print(f'{len(jobs)} spectra to extract ({exact} with exact responses), {skipped} up to date')
+
+    results = run_jobs(jobs, workers=args.workers, log_dir=log_dir) if jobs else []
+    failed = [r['name'] for r in results if r['returncode'] != 0]
+    print(f'{len(results)} jobs finished in {time.monotonic() - t0:.1f}s')
+
+    if failed:
+        print(f'{len(failed)} extractions failed (see logs in {log_dir}); rerun to retry them')
+        raise SystemExit(1)
+    set_flag('extract_spectra')
+
+
+if __name__ == '__main__':
+    main()
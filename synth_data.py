@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+'''
+Deterministic synthetic Chandra-like dataset for benchmarks.
+
+Writes an evt2-like event list with the columns and header keywords the
+pipeline reads (time, ccd_id, x, y, energy, pi, status; sky WCS in TC*
+keywords; DATAMODE, DETNAM, EXPOSURE, ...) and a GTI extension, made of
+
+    - a beta-model cluster (rc, beta) with a temperature rising outwards,
+    - point sources with a power-law brightness distribution,
+    - a flat particle background with flares in time.
+
+Events are generated time slice by time slice and streamed to disk with
+fits_stream.TableWriter, so 10^8 events need no more memory than one slice.
+The counts image is accumulated on the way; alongside the event file the
+generator writes the merged-image products step5 onwards expects
+(broad_thresh.img, broad_thresh.expmap, broad_flux.img), the point source
+exclusion region sources.reg and the field box field.reg, all in CIAO region
+format and physical coordinates.  The same --seed gives the same files.
+
+Usage:
+    python3 synth_data.py outdir [--events N] [--image-size PIX] [--seed S]
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from fits_stream import TableWriter
+
+RA, DEC = 258.1115, -23.3634        # pointing (Ophiuchus)
+PIXEL_DEG = 0.492 / 3600.0          # ACIS sky pixel
+CENTRE = 4096.5                     # sky x/y of the pointing
+TSTART = 5.0e8
+EXPOSURE = 50000.0
+ENERGY_BAND = (500.0, 7000.0)
+TIME_SLICES = 2000
+CHUNK_ROWS = 2_000_000
+OBS_ID = '99999'
+
+EVENT_COLUMNS = [
+    ('time', 'D', 's'),
+    ('ccd_id', 'I', None),
+    ('x', 'E', 'pixel'),
+    ('y', 'E', 'pixel'),
+    ('energy', 'E', 'eV'),
+    ('pi', 'J', 'chan'),
+    ('status', 'J', None),
+]
+
+
+def default_image_size(n_events):
+    return 512 if n_events <= 2e5 else 1024 if n_events <= 2e6 else 2048
+
+
+def field(image_size):
+    """Physical x/y of the lower-left corner of the image (pixel edges)."""
+    return CENTRE - image_size / 2.0
+
+
+def event_header(n_events, x_index=3, y_index=4):
+    header = {
+        'HDUCLASS': 'OGIP', 'HDUCLAS1': 'EVENTS',
+        'TELESCOP': 'CHANDRA', 'INSTRUME': 'ACIS', 'DETNAM': 'ACIS-0123',
+        'DATAMODE': 'VFAINT', 'OBS_ID': OBS_ID, 'OBJECT': 'SYNTHETIC',
+        'TSTART': TSTART, 'TSTOP': TSTART + EXPOSURE,
+        'EXPOSURE': EXPOSURE, 'ONTIME': EXPOSURE, 'LIVETIME': EXPOSURE,
+        'RA_NOM': RA, 'DEC_NOM': DEC, 'MJDREF': 50814.0, 'TIMESYS': 'TT',
+        'SYNTHEVT': (n_events, 'requested number of events'),
+    }
+    for idx, axis, crval, cdelt in ((x_index, 'RA---TAN', RA, -PIXEL_DEG), (y_index, 'DEC--TAN', DEC, PIXEL_DEG)):
+        header.update({f'TCTYP{idx}': axis, f'TCRVL{idx}': crval, f'TCRPX{idx}': CENTRE,
+                       f'TCDLT{idx}': cdelt, f'TLMIN{idx}': 0.5, f'TLMAX{idx}': 8192.5})
+    return header
+
+
+def image_header(image_size):
+    """Sky WCS plus the physical (LTV/LTM) transform of an image covering the field."""
+    from astropy.io import fits
+
+    x0 = field(image_size)
+    ltv = 0.5 - x0
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+    header['CRVAL1'], header['CRVAL2'] = RA, DEC
+    header['CRPIX1'] = header['CRPIX2'] = CENTRE + ltv
+    header['CDELT1'], header['CDELT2'] = -PIXEL_DEG, PIXEL_DEG
+    header['CUNIT1'] = header['CUNIT2'] = 'deg'
+    header['LTM1_1'], header['LTM2_2'] = 1.0, 1.0
+    header['LTV1'], header['LTV2'] = ltv, ltv
+    header['WCSNAMEP'] = 'PHYSICAL'
+    header['CTYPE1P'], header['CTYPE2P'] = 'x', 'y'
+    header['CRPIX1P'] = header['CRPIX2P'] = 0.5
+    header['CRVAL1P'] = header['CRVAL2P'] = x0
+    header['CDELT1P'] = header['CDELT2P'] = 1.0
+    header['OBS_ID'] = OBS_ID
+    header['EXPOSURE'] = EXPOSURE
+    return header
+
+
+def chip_mask(image_size):
+    """2x2 ACIS-I layout: the field with a 4 pixel gap through the middle."""
+    mask = np.ones((image_size, image_size), dtype=bool)
+    mid = image_size // 2
+    mask[mid - 2:mid + 2, :] = False
+    mask[:, mid - 2:mid + 2] = False
+    return mask
+
+
+def rate_curve(rng, n_flares=2):
+    """(quiescent, flare) relative background rates per time slice."""
+    t = (np.arange(TIME_SLICES) + 0.5) / TIME_SLICES
+    flare = np.zeros(TIME_SLICES)
+    for _ in range(n_flares):
+        centre, width, height = rng.uniform(0.1, 0.9), rng.uniform(0.005, 0.03), rng.uniform(3.0, 10.0)
+        flare += height * np.exp(-0.5 * ((t - centre) / width) ** 2)
+    return np.ones(TIME_SLICES), flare
+
+
+class Model:
+    """Source model; all positions in physical pixels."""
+
+    def __init__(self, rng, image_size, n_sources=30, rc=None, beta=2.0 / 3.0):
+        self.size = image_size
+        self.x0 = field(image_size)
+        self.cx = CENTRE + rng.uniform(-0.05, 0.05) * image_size
+        self.cy = CENTRE + rng.uniform(-0.05, 0.05) * image_size
+        self.rc = rc or image_size / 16.0
+        self.beta = beta
+        self.rmax = image_size / 2.0 * np.sqrt(2.0)
+        margin = image_size * 0.05
+        self.src = rng.uniform(self.x0 + margin, self.x0 + image_size - margin, size=(n_sources, 2))
+        brightness = rng.pareto(1.5, size=n_sources) + 1.0
+        self.src_weight = brightness / brightness.sum()
+
+    def cluster(self, rng, n):
+        # surface brightness (1 + r^2/rc^2)^(-a), a = 3 beta - 1/2; inverse CDF in x = r^2/rc^2
+        a = 3.0 * self.beta - 0.5
+        umax = 1.0 - (1.0 + (self.rmax / self.rc) ** 2) ** (1.0 - a)
+        x = (1.0 - rng.uniform(0, umax, n)) ** (1.0 / (1.0 - a)) - 1.0
+        r = self.rc * np.sqrt(x)
+        phi = rng.uniform(0, 2 * np.pi, n)
+        kt = 2.0 + 4.0 * r / (r + 2.0 * self.rc)       # cool core
+        energy = 300.0 + rng.gamma(1.2, kt * 1000.0 / 1.2)
+        return self.cx + r * np.cos(phi), self.cy + r * np.sin(phi), energy
+
+    def sources(self, rng, n):
+        which = rng.choice(len(self.src), size=n, p=self.src_weight)
+        xy = self.src[which] + rng.normal(0, 1.5, size=(n, 2))
+        energy = 500.0 + rng.exponential(2000.0, n)
+        return xy[:, 0], xy[:, 1], energy
+
+    def background(self, rng, n):
+        x = rng.uniform(self.x0, self.x0 + self.size, n)
+        y = rng.uniform(self.x0, self.x0 + self.size, n)
+        return x, y, rng.uniform(300.0, 12000.0, n)
+
+
+def write_region(path, shapes):
+    with open(path, 'w') as f:
+        f.write('# Region file format: CIAO version 1.0\n')
+        for shape in shapes:
+            f.write(shape + '\n')
+
+
+def generate(outdir, n_events, image_size=None, seed=1, fractions=(0.55, 0.1, 0.35), n_sources=30):
+    """Write the dataset into outdir. Returns a manifest dict (also saved as manifest.json)."""
+    from astropy.io import fits
+
+    t0 = time.monotonic()
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    image_size = image_size or default_image_size(n_events)
+    model = Model(rng, image_size, n_sources)
+    mask = chip_mask(image_size)
+    quiet, flare = rate_curve(rng)
+
+    # expected events per slice: cluster and sources are steady, the background flares
+    f_cluster, f_src, f_bkg = fractions
+    bkg_rate = f_bkg * (quiet + flare) / quiet.sum()
+    steady = (f_cluster + f_src) / TIME_SLICES
+    weights = steady + bkg_rate
+    per_slice = rng.multinomial(n_events, weights / weights.sum())
+    edges = TSTART + EXPOSURE * np.arange(TIME_SLICES + 1) / TIME_SLICES
+
+    counts = np.zeros(image_size * image_size, dtype=np.int64)
+    evt_path = os.path.join(outdir, f'acisf{OBS_ID}_repro_evt2.fits')
+    written = 0
+    with TableWriter(evt_path, EVENT_COLUMNS, 'EVENTS', event_header(n_events)) as writer:
+        pending = []
+        for k, n in enumerate(per_slice):
+            if n == 0:
+                continue
+            p = np.array([f_cluster, f_src, 0.0]) / TIME_SLICES
+            p[2] = bkg_rate[k]
+            parts = rng.multinomial(n, p / p.sum())
+            xs, ys, es = zip(model.cluster(rng, parts[0]), model.sources(rng, parts[1]),
+                             model.background(rng, parts[2]))
+            x, y, energy = np.concatenate(xs), np.concatenate(ys), np.concatenate(es)
+            order = rng.permutation(n)
+            x, y, energy = x[order], y[order], energy[order]
+            t = np.sort(rng.uniform(edges[k], edges[k + 1], n))
+
+            i = np.floor(x - model.x0).astype(np.int64)
+            j = np.floor(y - model.x0).astype(np.int64)
+            on = (i >= 0) & (i < image_size) & (j >= 0) & (j < image_size)
+            on[on] = mask[j[on], i[on]]
+            mid = image_size // 2
+            ccd = (i[on] >= mid).astype(np.int16) + 2 * (j[on] >= mid).astype(np.int16)
+            energy = np.minimum(energy[on], 13000.0)
+            chunk = {
+                'time': t[on], 'ccd_id': ccd, 'x': x[on], 'y': y[on], 'energy': energy,
+                'pi': np.minimum((energy / 14.6).astype(np.int32) + 1, 1024),
+                # a few flagged events so status filters have something to remove
+                'status': np.where(rng.random(on.sum()) < 0.01, 1 << 16, 0).astype(np.int32),
+            }
+            band = (energy >= ENERGY_BAND[0]) & (energy <= ENERGY_BAND[1])
+            counts += np.bincount((j[on] * image_size + i[on])[band], minlength=counts.size)
+            pending.append(chunk)
+            if sum(len(c['time']) for c in pending) >= CHUNK_ROWS:
+                writer.write({name: np.concatenate([c[name] for c in pending]) for name, _, _ in EVENT_COLUMNS})
+                written += sum(len(c['time']) for c in pending)
+                pending = []
+        if pending:
+            writer.write({name: np.concatenate([c[name] for c in pending]) for name, _, _ in EVENT_COLUMNS})
+            written += sum(len(c['time']) for c in pending)
+
+    gti = fits.BinTableHDU.from_columns([fits.Column(name='START', format='D', unit='s', array=[TSTART]),
+                                         fits.Column(name='STOP', format='D', unit='s', array=[TSTART + EXPOSURE])],
+                                        name='GTI')
+    gti.header['HDUCLAS1'] = 'GTI'
+    gti.header['CCD_ID'] = 0
+    fits.append(evt_path, gti.data, gti.header)
+
+    # merged-image products as merge_obs would write them
+    header = image_header(image_size)
+    thresh = counts.reshape(image_size, image_size).astype(np.float32)
+    yy, xx = np.mgrid[0:image_size, 0:image_size]
+    r = np.hypot(xx + model.x0 + 0.5 - CENTRE, yy + model.x0 + 0.5 - CENTRE)
+    expmap = (400.0 * EXPOSURE * (1.0 - 0.3 * (r / model.rmax) ** 2) * mask).astype(np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flux = np.where(expmap > 0, thresh / expmap, 0.0).astype(np.float32)
+    fits.writeto(os.path.join(outdir, 'broad_thresh.img'), thresh, header, overwrite=True)
+    fits.writeto(os.path.join(outdir, 'broad_thresh.expmap'), expmap, header, overwrite=True)
+    fits.writeto(os.path.join(outdir, 'broad_flux.img'), flux, header, overwrite=True)
+
+    write_region(os.path.join(outdir, 'sources.reg'),
+                 [f'circle({x:.2f},{y:.2f},6)' for x, y in model.src])
+    margin = image_size * 0.05
+    side = image_size - 2 * margin
+    write_region(os.path.join(outdir, 'field.reg'), [f'box({CENTRE:.2f},{CENTRE:.2f},{side:.2f},{side:.2f},0)'])
+
+    manifest = {
+        'events_requested': int(n_events), 'events_written': int(written), 'image_size': int(image_size),
+        'seed': seed, 'n_sources': n_sources, 'fractions': list(fractions), 'exposure': EXPOSURE,
+        'event_file': os.path.basename(evt_path), 'seconds': round(time.monotonic() - t0, 3),
+    }
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Chandra-like dataset.')
+    parser.add_argument('outdir', help='directory for the dataset')
+    parser.add_argument('--events', type=float, default=1e6, help='number of events (default 1e6)')
+    parser.add_argument('--image-size', type=int, default=None, help='image side in pixels (default from --events)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    manifest = generate(args.outdir, int(args.events), args.image_size, args.seed)
+    print(f"{manifest['events_written']} events, {manifest['image_size']}^2 images in {manifest['seconds']}s "
+          f"-> {args.outdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+'''
+wavdetect on a large merged image, tile by tile in parallel.
+
+step6 runs one wavdetect over the whole broad_thresh_noem.img, and
+wavdetect's time grows steeply with image size.  This script cuts the image
+and its exposure map into tiles of --tile pixels, each padded on every side
+by an overlap of OVERLAP_SIGMAS times the largest wavelet scale, so every
+pixel of a tile's core sees the same neighbourhood as in the full image.
+The tiles are detected in a process pool (job_runner.run_jobs, a private
+PFILES directory per worker) with the step6 parameters.
+
+A source is kept from the tile whose core contains its position; sources
+of different tiles closer than --match-radius pixels (the same source found
+near a core boundary) are merged with a KD-tree cross-match, keeping the
+most significant detection.  Close sources of the same tile are never
+merged, since the single-image run keeps them apart too.  The output is the region file step6 uses and
+the merged source list:
+
+    broad_src_0.5-7.reg     ellipse(x,y,r0,r1,angle) in physical pixels
+    src_0.5-7.fits          SRCLIST of the kept sources
+
+Each tile estimates its own background map, so marginal detections far
+below the threshold can differ from a single-image run; with the default
+overlap the source list is otherwise the same.  Images smaller than one tile
+are detected in a single call.
+
+Usage:
+    python3 tiled_wavdetect.py IMAGE EXPMAP --regfile REG [--outfile SRC] [--workdir DIR]
+                               [--tile N] [--workers N] [--scales "1 2 4 8 16 32"]
+'''
+import argparse
+import os
+import shutil
+
+import numpy as np
+
+from regions import crop_header, physical_to_image
+from spatial_index import KDTree
+
+SCALES = '1 2 4 8 16 32'
+WAVDETECT_ARGS = 'maxiter=3 sigthresh=5e-6 ellsigma=5.0'
+TILE = 1024
+OVERLAP_SIGMAS = 4
+MATCH_RADIUS = 2.0
+
+
+def overlap_for(scales):
+    """Tile padding in pixels for a wavdetect scales string."""
+    return int(np.ceil(OVERLAP_SIGMAS * max(float(s) for s in scales.split())))
+
+
+def tile_grid(ny, nx, tile, overlap):
+    """
+    Tiles covering an (ny, nx) image: {name, core, box}, where core and box are
+    (j0, j1, i0, i1) array index ranges; cores partition the image, boxes add the overlap.
+    """
+    tiles = []
+    for j0 in range(0, ny, tile):
+        for i0 in range(0, nx, tile):
+            j1, i1 = min(j0 + tile, ny), min(i0 + tile, nx)
+            box = (max(j0 - overlap, 0), min(j1 + overlap, ny), max(i0 - overlap, 0), min(i1 + overlap, nx))
+            tiles.append({'name': f'tile_{j0 // tile:03d}_{i0 // tile:03d}', 'core': (j0, j1, i0, i1), 'box': box})
+    return tiles
+
+
+def write_tiles(image, expmap, tiles, workdir):
+    """Write each tile's image and exposure map; tiles without exposure are dropped. Returns the kept tiles."""
+    from astropy.io import fits
+
+    kept = []
+    with fits.open(image, memmap=True) as img, fits.open(expmap, memmap=True) as exp:
+        if img[0].data.shape != exp[0].data.shape:
+            raise ValueError(f'{image} and {expmap} are not on the same grid')
+        for tile in tiles:
+            j0, j1, i0, i1 = tile['box']
+            exposure = exp[0].data[j0:j1, i0:i1]
+            if not np.any(exposure > 0):
+                continue
+            tile = dict(tile, image=os.path.join(workdir, f'{tile["name"]}.img'),
+                        expmap=os.path.join(workdir, f'{tile["name"]}.expmap'),
+                        srclist=os.path.join(workdir, f'{tile["name"]}_src.fits'))
+            fits.writeto(tile['image'], np.asarray(img[0].data[j0:j1, i0:i1]),
+                         crop_header(img[0].header, i0, j0, i1 - i0, j1 - j0), overwrite=True)
+            fits.writeto(tile['expmap'], np.asarray(exposure),
+                         crop_header(exp[0].header, i0, j0, i1 - i0, j1 - j0), overwrite=True)
+            kept.append(tile)
+    return kept
+
+
+def wavdetect_commands(tile, scales=SCALES):
+    name = tile['name']
+    return ['punlearn wavdetect',
+            f'wavdetect infile={tile["image"]} psffile=none expfile={tile["expmap"]} outfile={tile["srclist"]} '
+            f'scellfile={name}_scell.fits imagefile={name}_imgfile.fits defnbkgfile={name}_nbkg.fits '
+            f'regfile={name}.reg scales="{scales}" {WAVDETECT_ARGS} clobber=yes']
+
+
+def core_sources(tile, header):
+    """Rows of a tile's source list whose position lies in the tile's core (header: the full image)."""
+    from astropy.table import Table
+
+    sources = Table.read(tile['srclist'], hdu='SRCLIST')
+    if not len(sources):
+        return sources
+    i, j = physical_to_image(header, np.asarray(sources['X']), np.asarray(sources['Y']))
+    # image pixel k is centred on k and stored at array index k-1
+    col, row = np.floor(i - 0.5), np.floor(j - 0.5)
+    j0, j1, i0, i1 = tile['core']
+    return sources[(col >= i0) & (col < i1) & (row >= j0) & (row < j1)]
+
+
+def merge_sources(tables, radius=MATCH_RADIUS):
+    """
+    One source list from the tiles' core sources (one table per tile).  A source within radius of a
+    more significant source of another tile is the same source found near a core boundary and is
+    dropped; sources of the same tile are kept apart, as in a single-image run.
+    """
+    from astropy.table import vstack
+
+    tile = np.concatenate([np.full(len(t), k) for k, t in enumerate(tables)]) if tables else np.zeros(0)
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return None
+    sources = vstack(tables, metadata_conflicts='silent')
+    xy = np.column_stack([np.asarray(sources['X'], dtype=float), np.asarray(sources['Y'], dtype=float)])
+    tree = KDTree(xy)
+    significance = np.asarray(sources['SRC_SIGNIFICANCE'], dtype=float)
+    kept = np.zeros(len(sources), dtype=bool)
+    for i in np.argsort(-significance, kind='stable'):
+        near = tree.query_ball_point(xy[i], radius)
+        kept[i] = not np.any(kept[near] & (tile[near] != tile[i]))
+    return sources[kept]
+
+
+def write_region(sources, path):
+    """wavdetect-style CIAO region file: one ellipse per source, physical pixels."""
+    with open(path, 'w') as f:
+        f.write('# Region file format: CIAO version 1.0\n')
+        if sources is None:
+            return
+        for row in sources:
+            r0, r1 = np.ravel(row['R'])[:2]
+            f.write(f"ellipse({row['X']:.10g},{row['Y']:.10g},{r0:.10g},{r1:.10g},{row['ROTANG']:.10g})\n")
+
+
+def tiled_wavdetect(image, expmap, regfile, outfile=None, workdir='wavdetect_tiles', tile=TILE, workers=None,
+                    scales=SCALES, radius=MATCH_RADIUS, keep_tiles=False):
+    """Detect sources on image in tiles; writes regfile (and outfile). Returns the number of sources."""
+    from astropy.io import fits
+    from job_runner import make_job, run_jobs
+
+    header = fits.getheader(image)
+    ny, nx = header['NAXIS2'], header['NAXIS1']
+    os.makedirs(workdir, exist_ok=True)
+    workdir = os.path.abspath(workdir)
+    tiles = write_tiles(image, expmap, tile_grid(ny, nx, tile, overlap_for(scales)), workdir)
+    print(f'{len(tiles)} tiles of {tile} px (+{overlap_for(scales)} px overlap) with exposure')
+
+    jobs = [make_job(t['name'], wavdetect_commands(t, scales), workdir) for t in tiles]
+    results = run_jobs(jobs, workers, os.path.join(workdir, 'logs'))
+    failed = [r['name'] for r in results if r['returncode'] != 0]
+    if failed:
+        raise RuntimeError(f'wavdetect failed on {", ".join(failed)} (logs in {workdir}/logs)')
+
+    sources = merge_sources([core_sources(t, header) for t in tiles], radius)
+    write_region(sources, regfile)
+    if outfile:
+        hdu = fits.table_to_hdu(sources) if sources is not None else fits.BinTableHDU()
+        hdu.name = 'SRCLIST'
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(outfile, overwrite=True)
+    if not keep_tiles:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if sources is None else len(sources)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run wavdetect on overlapping tiles in parallel.')
+    parser.add_argument('image', help='image to detect on (broad_thresh_noem.img)')
+    parser.add_argument('expmap', help='exposure map on the same grid (broad_thresh.expmap)')
+    parser.add_argument('--regfile', required=True, help='output region file')
+    parser.add_argument('--outfile', default=None, help='output source list')
+    parser.add_argument('--workdir', default='wavdetect_tiles', help='directory for the tiles (removed after)')
+    parser.add_argument('--keep-tiles', action='store_true', help='keep the tiles and their wavdetect output')
+    parser.add_argument('--tile', type=int, default=TILE, help='tile core size in pixels')
+    parser.add_argument('--workers', type=int, default=None, help='parallel wavdetect runs (default: all cores)')
+    parser.add_argument('--scales', default=SCALES, help='wavelet scales in pixels')
+    parser.add_argument('--match-radius', type=float, default=MATCH_RADIUS,
+                        help='sources of different tiles closer than this (pixels) are one source')
+    args = parser.parse_args()
+
+    n = tiled_wavdetect(args.image, args.expmap, args.regfile, args.outfile, args.workdir, args.tile,
+                        args.workers, args.scales, args.match_radius, args.keep_tiles)
+    print(f'{n} sources written to {args.regfile}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,16 @@
 import sys
-import json
-import helpers
-
-config = helpers.load_config()
+import state_store
 
 if len(sys.argv) != 2:
     print("Usage: python3 update_flag.py <flag>")
     sys.exit(1)
 
 flag = sys.argv[1]
-if flag not in config['flags']:
+try:
+    # one transaction in the state store; config.json is re-exported from it
+    state_store.set_flag(flag, must_exist=True)
+except KeyError:
     print(f"Flag {flag} not found in config.json")
     sys.exit(1)
 
-config['flags'][flag] = True
-with open(helpers.CONFIG_PATH, 'w') as f:
-    json.dump(config, f, indent=4)
-
-print(f"Flag {flag} updated successfully")
\ No newline at end of file
+print(f"Flag {flag} updated successfully")
@@ -0,0 +1,361 @@
+#! /usr/bin/env python3
+'''
+Fit an absorbed APEC to the spectra of every contour bin.
+
+A fixed pool of long-lived worker processes is started once; each worker
+loads its fitting backend (PyXspec, models, abundance table) a single time and
+then fits the bins the parent hands it, one at a time over its own pipe, so
+the interpreter and XSPEC start-up cost is paid per worker instead of per
+bin.  A bin is all of its spectra
+(spectra/{obs_id}/xaf_N_grp.pi from step9) fitted together.
+
+Failed fits are retried (with a different starting temperature) up to
+--retries times; a worker that dies in the middle of a fit (an XSPEC crash)
+is noticed at once (its process sentinel) and replaced, and the bin it was
+given requeued; a crash only breaks that worker's pipe, never a lock shared
+with the others.  If every fit fails the flags
+are not set and the exit code is 1.  All results are collected into one columnar FITS table,
+fit_results.fits, next to the spectra:
+
+    BIN, KT, KT_LO, KT_HI, Z, Z_LO, Z_HI, NORM, NORM_LO, NORM_HI,
+    CSTAT, DOF, NSPEC, ATTEMPTS, STATUS (0 = fitted, 1 = failed)
+
+Backends implement setup(settings) and fit(task); "fake" is a pure NumPy model
+that lets the scheduling, retries and result collection run without XSPEC.
+
+Config keys (info_dict, optional): nh (1e22 cm^-2, default 0.1), redshift
+(default 0), abundance_table (default "angr"), fit_band (default [0.5, 7.0]).
+
+Usage:
+    python3 xspec_fit.py [--workers N] [--backend pyxspec|fake] [--retries N] [--output file]
+'''
+import argparse
+import math
+import multiprocessing as mp
+import multiprocessing.connection as mp_connection
+import os
+import re
+import time
+import traceback
+from collections import deque
+from glob import glob
+
+import numpy as np
+
+from helpers import load_config, set_flag
+
+PARAMS = ('kt', 'z', 'norm')
+COLUMNS = ('KT', 'KT_LO', 'KT_HI', 'Z', 'Z_LO', 'Z_HI', 'NORM', 'NORM_LO', 'NORM_HI', 'CSTAT')
+START_KT = (3.0, 8.0, 1.0, 15.0)
+STATUS_OK = 0
+STATUS_FAILED = 1
+
+
+class PyXspecBackend:
+    """phabs*apec with nH and redshift frozen, fitted with C-stat through PyXspec."""
+
+    def setup(self, settings):
+        import xspec
+        self.xspec = xspec
+        self.settings = settings
+        xspec.Xset.chatter = 0
+        xspec.Xset.logChatter = 0
+        xspec.Xset.abund = settings['abundance_table']
+        xspec.Fit.statMethod = 'cstat'
+        xspec.Fit.query = 'yes'
+        xspec.Fit.nIterations = 100
+
+    def fit(self, task):
+        xspec = self.xspec
+        lo, hi = self.settings['band']
+        xspec.AllData.clear()
+        xspec.AllModels.clear()
+        xspec.AllData(' '.join(f'{i}:{i} {path}' for i, path in enumerate(task['spectra'], 1)))
+        xspec.AllData.ignore(f'bad **-{lo} {hi}-**')
+
+        model = xspec.Model('phabs*apec')
+        model.phabs.nH.values = self.settings['nh']
+        model.phabs.nH.frozen = True
+        model.apec.Redshift.values = self.settings['redshift']
+        model.apec.kT.values = START_KT[task['attempt'] % len(START_KT)]
+        model.apec.Abundanc.frozen = False
+
+        xspec.Fit.perform()
+        # 90% errors on kT, abundance and norm (parameters 2, 3, 5)
+        xspec.Fit.error('maximum 50 2.706 2 3 5')
+
+        result = {}
+        for name, par in zip(PARAMS, (model.apec.kT, model.apec.Abundanc, model.apec.norm)):
+            result[name] = par.values[0]
+            result[name + '_lo'], result[name + '_hi'] = par.error[0], par.error[1]
+        result['cstat'] = xspec.Fit.statistic
+        result['dof'] = xspec.Fit.dof
+        return result
+
+
+class FakeBackend:
+    """
+    Pure NumPy stand-in: fits an exponential to the counts of each spectrum, or makes up
+    a deterministic result when the file doesn't exist.  fail_every=N makes the first
+    attempt of every Nth bin raise, to exercise the retries; crash_every=N makes it kill
+    the worker, to exercise the restarts.
+    """
+
+    def __init__(self, fail_every=0, delay=0.0, crash_every=0):
+        self.fail_every = fail_every
+        self.delay = delay
+        self.crash_every = crash_every
+
+    def setup(self, settings):
+        self.settings = settings
+        self.grid = np.linspace(0.5, 15.0, 300)
+
+    def _counts(self, path):
+        try:
+            from astropy.io import fits
+            with fits.open(path) as hdul:
+                data = hdul['SPECTRUM'].data
+                return np.asarray(data['CHANNEL'], float) * 0.0146, np.asarray(data['COUNTS'], float)
+        except (OSError, KeyError):
+            return None
+
+    def fit(self, task):
+        if self.crash_every and task['bin'] % self.crash_every == 0 and task['attempt'] == 0:
+            os._exit(139)
+        if self.fail_every and task['bin'] % self.fail_every == 0 and task['attempt'] == 0:
+            raise RuntimeError(f'fake failure for bin {task["bin"]}')
+        if self.delay:
+            time.sleep(self.delay)
+
+        energy, counts = [], []
+        for path in task['spectra']:
+            spectrum = self._counts(path)
+            if spectrum is not None:
+                energy.append(spectrum[0])
+                counts.append(spectrum[1])
+        if energy:
+            energy, counts = np.concatenate(energy), np.concatenate(counts)
+            lo, hi = self.settings['band']
+            keep = (energy >= lo) & (energy <= hi)
+            energy, counts = energy[keep], counts[keep]
+        else:
+            rng = np.random.default_rng(task['bin'])
+            energy = np.linspace(0.5, 7.0, 400)
+            counts = rng.poisson(50 * np.exp(-energy / (2 + task['bin'] % 7))).astype(float)
+
+        # C-stat of norm * exp(-E / kT) on a temperature grid, norm at its analytic optimum
+        shape = np.exp(-energy[None, :] / self.grid[:, None])
+        norm = counts.sum() / shape.sum(axis=1)
+        model = np.maximum(norm[:, None] * shape, 1e-30)
+        terms = model - counts + counts * (np.log(np.maximum(counts, 1e-30)) - np.log(model))
+        cstat = 2.0 * terms.sum(axis=1)
+        best = int(np.argmin(cstat))
+        inside = self.grid[cstat <= cstat[best] + 2.706]
+        n = max(counts.sum(), 1.0)
+        return {'kt': self.grid[best], 'kt_lo': inside.min(), 'kt_hi': inside.max(),
+                'z': 0.3, 'z_lo': 0.3 * (1 - 1 / math.sqrt(n)), 'z_hi': 0.3 * (1 + 1 / math.sqrt(n)),
+                'norm': norm[best], 'norm_lo': norm[best] * (1 - 1 / math.sqrt(n)),
+                'norm_hi': norm[best] * (1 + 1 / math.sqrt(n)),
+                'cstat': float(cstat[best]), 'dof': len(energy) - 2}
+
+
+BACKENDS = {
+    'pyxspec': PyXspecBackend,
+    'fake': FakeBackend,
+}
+
+
+def fit_settings(config):
+    info = config['info_dict']
+    return {
+        'nh': float(info.get('nh', 0.1)),
+        'redshift': float(info.get('redshift', 0.0)),
+        'abundance_table': info.get('abundance_table', 'angr'),
+        'band': tuple(info.get('fit_band', (0.5, 7.0))),
+    }
+
+
+def _worker(worker_id, backend, options, settings, conn):
+    """Load the backend once, then fit the bins sent over conn until the None sentinel."""
+    try:
+        fitter = BACKENDS[backend](**options)
+        fitter.setup(settings)
+    except Exception:
+        conn.send(('dead', worker_id, None, traceback.format_exc()))
+        return
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        try:
+            conn.send(('ok', worker_id, task, fitter.fit(task)))
+        except Exception:
+            conn.send(('error', worker_id, task, traceback.format_exc()))
+
+
+def bin_spectra(spectra_dir):
+    """{bin: [spectrum per obs_id]} from spectra/{obs_id}/xaf_N[_grp].pi."""
+    bins = {}
+    for obs_dir in sorted(glob(os.path.join(spectra_dir, '*'))):
+        for path in glob(os.path.join(obs_dir, 'xaf_*.pi')):
+            match = re.search(r'xaf_(\d+)\.pi$', path)
+            if not match:
+                continue
+            grouped = path[:-3] + '_grp.pi'
+            bins.setdefault(int(match.group(1)), []).append(grouped if os.path.exists(grouped) else path)
+    return bins
+
+
+def run_fits(bins, backend='pyxspec', settings=None, workers=None, retries=2, options=None, log=print):
+    """
+    Fit every bin in a pool of warm workers. Returns {bin: result dict}; failed bins carry
+    an 'error' entry instead of parameters. Bins with the most spectra are queued first.
+    """
+    settings = settings or {'nh': 0.1, 'redshift': 0.0, 'abundance_table': 'angr', 'band': (0.5, 7.0)}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(bins) or 1))
+    ctx = mp.get_context('spawn')
+
+    def start(worker_id):
+        conn, child = ctx.Pipe()
+        proc = ctx.Process(target=_worker, args=(worker_id, backend, options or {}, settings, child), daemon=True)
+        proc.start()
+        child.close()
+        return proc, conn
+
+    # the parent decides which worker fits which bin, so a bin is always pending, busy or done
+    pending = deque({'bin': b, 'spectra': list(bins[b]), 'attempt': 0}
+                    for b in sorted(bins, key=lambda b: (-len(bins[b]), b)))
+    procs = {w: start(w) for w in range(workers)}
+    busy = {}
+    done = {}
+    next_id = workers
+    restarts, max_restarts = 0, 4 * workers + retries * len(bins)
+    t0 = time.monotonic()
+
+    def failed(task, error):
+        if task['attempt'] < retries:
+            pending.append(dict(task, attempt=task['attempt'] + 1))
+            return
+        done[task['bin']] = {'error': error, 'attempts': task['attempt'] + 1}
+        log(f'bin {task["bin"]} failed after {task["attempt"] + 1} attempts')
+
+    try:
+        while len(done) < len(bins):
+            for worker_id, (_, conn) in procs.items():
+                if worker_id not in busy and pending:
+                    busy[worker_id] = pending.popleft()
+                    try:
+                        conn.send(busy[worker_id])
+                    except OSError:
+                        pass        # the worker just died: its sentinel requeues the bin below
+
+            by_conn = {conn: w for w, (_, conn) in procs.items()}
+            by_sentinel = {proc.sentinel: w for w, (proc, _) in procs.items()}
+            ready = mp_connection.wait(list(by_conn) + list(by_sentinel))
+            dead = {by_sentinel[r] for r in ready if r in by_sentinel}
+            for conn in (r for r in ready if r in by_conn):
+                try:
+                    kind, worker_id, task, payload = conn.recv()
+                except (EOFError, OSError):
+                    dead.add(by_conn[conn])
+                    continue
+                if kind == 'dead':
+                    raise RuntimeError(f'{backend} backend could not be loaded:\n{payload}')
+                del busy[worker_id]
+                if kind == 'error':
+                    failed(task, payload)
+                    continue
+                done[task['bin']] = dict(payload, attempts=task['attempt'] + 1)
+                if len(done) % 100 == 0:
+                    log(f'{len(done)}/{len(bins)} bins fitted in {time.monotonic() - t0:.1f}s')
+
+            # replace crashed workers and retry the bin each was given
+            for worker_id in dead:
+                proc, conn = procs.pop(worker_id)
+                proc.join()
+                conn.close()
+                restarts += 1
+                if restarts > max_restarts:
+                    raise RuntimeError(f'fitting workers keep exiting (last exit code {proc.exitcode})')
+                procs[next_id] = start(next_id)
+                next_id += 1
+                if worker_id in busy:
+                    failed(busy.pop(worker_id), f'worker exited with code {proc.exitcode}')
+    finally:
+        for proc, conn in procs.values():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for proc, conn in procs.values():
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+            conn.close()
+    return done
+
+
+def write_results(path, bins, results):
+    """One row per bin, in bin order."""
+    from astropy.io import fits
+
+    order = sorted(results)
+    data = {name: np.full(len(order), np.nan) for name in COLUMNS}
+    dof = np.zeros(len(order), dtype=np.int32)
+    status = np.zeros(len(order), dtype=np.int16)
+    for row, b in enumerate(order):
+        result = results[b]
+        if 'error' in result:
+            status[row] = STATUS_FAILED
+            continue
+        dof[row] = result['dof']
+        for name in COLUMNS:
+            data[name][row] = result[name.lower()]
+
+    cols = [fits.Column(name='BIN', format='J', array=np.array(order, dtype=np.int32))]
+    units = {'KT': 'keV', 'Z': 'solar'}
+    for name in COLUMNS:
+        cols.append(fits.Column(name=name, format='D', unit=units.get(name.split('_')[0]), array=data[name]))
+    cols += [fits.Column(name='DOF', format='J', array=dof),
+             fits.Column(name='NSPEC', format='I', array=np.array([len(bins[b]) for b in order], dtype=np.int16)),
+             fits.Column(name='ATTEMPTS', format='I',
+                         array=np.array([results[b]['attempts'] for b in order], dtype=np.int16)),
+             fits.Column(name='STATUS', format='I', array=status)]
+    table = fits.BinTableHDU.from_columns(cols, name='FIT_RESULTS')
+    table.header['MODEL'] = ('phabs*apec', 'fitted model')
+    table.header['STAT'] = ('cstat', 'fit statistic')
+    table.writeto(path, overwrite=True)
+
+
+def main(argv=None):
+    from step9_pre_fitting import contbin_dir
+
+    parser = argparse.ArgumentParser(description='Fit every contour bin with a pool of warm XSPEC workers.')
+    parser.add_argument('--workers', type=int, default=None, help='number of fitting processes (default: CPUs)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='pyxspec', help='fitting backend')
+    parser.add_argument('--retries', type=int, default=2, help='extra attempts for a failed fit')
+    parser.add_argument('--output', default=None, help='results table (default: fit_results.fits in the contbin dir)')
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    spectra_dir = os.path.join(contbin_dir(config), 'spectra')
+    output = args.output or os.path.join(contbin_dir(config), 'fit_results.fits')
+    bins = bin_spectra(spectra_dir)
+    if not bins:
+        raise SystemExit(f'No spectra found in {spectra_dir}; run step9_pre_fitting.py first')
+
+    t0 = time.monotonic()
+    results = run_fits(bins, args.backend, fit_settings(config), args.workers, args.retries)
+    failed = sum('error' in r for r in results.values())
+    print(f'{len(results)} bins fitted in {time.monotonic() - t0:.1f}s, {failed} failed')
+
+    write_results(output, bins, results)
+    print(f'Results written to {output}')
+    if failed == len(results):
+        raise SystemExit(f'Every fit failed (STATUS column of {output}); flags not set')
+    set_flag('xspec_fitting')
+    set_flag('parse_results')
+
+
+if __name__ == '__main__':
+    main()